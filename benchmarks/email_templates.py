@@ -0,0 +1,82 @@
+"""
+Throughput of rendering and enqueuing emails.
+
+    python -m benchmarks.email_templates --recipients 100000
+    python -m benchmarks.email_templates --recipients 100000 --database
+
+Without --database the outbox rows are only built, with it they are inserted
+into email_outbox inside a transaction that is rolled back at the end.
+"""
+import argparse
+import asyncio
+import time
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.mail_templates import email_templates, queue_bulk_email
+
+
+def recipients(count: int):
+    for i in range(count):
+        yield f"user{i}@example.com"
+
+
+def bench_render(count: int, name: str, locale: str, unique: bool) -> float:
+    """
+    Messages per second rendered and turned into outbox rows. With `unique`
+    every recipient gets its own link and its own render, otherwise the email
+    is rendered once for all of them.
+    """
+    if unique:
+        messages = (
+            (recipient, *email_templates.render(name, locale, link=f"http://localhost/verify/{i}"))
+            for i, recipient in enumerate(recipients(count))
+        )
+    else:
+        messages = email_templates.render_bulk(name, recipients(count), locale, link="http://localhost/verify")
+
+    start = time.perf_counter()
+    rows = 0
+    for recipient, subject, body in messages:
+        row = {"recipient": recipient, "subject": subject, "body": body}
+        rows += 1
+    return rows / (time.perf_counter() - start)
+
+
+async def bench_database(count: int, name: str, locale: str, chunk_size: int) -> float:
+    from src.db.main import engine
+
+    async with AsyncSession(engine) as session:
+        start = time.perf_counter()
+        queued = await queue_bulk_email(session, recipients(count), name, locale, chunk_size=chunk_size)
+        elapsed = time.perf_counter() - start
+        await session.rollback()
+    await engine.dispose()
+    return queued / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recipients", type=int, default=50000)
+    parser.add_argument("--template", default="verify_email")
+    parser.add_argument("--locale", default="en")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--database", action="store_true")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    email_templates.precompile()
+    print(f"precompiled {len(email_templates.locales)} locales in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    shared = bench_render(args.recipients, args.template, args.locale, unique=False)
+    print(f"render + enqueue, shared context:   {shared:>12,.0f} msg/s")
+    unique = bench_render(args.recipients, args.template, args.locale, unique=True)
+    print(f"render + enqueue, per user context: {unique:>12,.0f} msg/s")
+
+    if args.database:
+        inserted = asyncio.run(bench_database(args.recipients, args.template, args.locale, args.chunk_size))
+        print(f"render + insert into email_outbox:  {inserted:>12,.0f} msg/s")
+
+
+if __name__ == "__main__":
+    main()
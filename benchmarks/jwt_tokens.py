@@ -0,0 +1,85 @@
+"""
+Sign and verify throughput of access tokens per algorithm.
+
+    python -m benchmarks.jwt_tokens --count 5000
+
+"HS256 before" is the previous path, jwt.encode / jwt.decode with the
+secret string. The keyring rows sign and verify with the key objects
+loaded once; "EdDSA from PEM" parses the PEM on every call, which is what
+passing PEM strings to PyJWT would cost.
+"""
+import argparse
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import jwt
+from cryptography.hazmat.primitives import serialization
+
+from src.auth.keys import KeyRing, generate_private_key
+
+SECRET = "benchmark-secret-benchmark-secret"
+
+
+def make_payload() -> dict:
+    return {
+        "user": {
+            "email": "user1@bench.local", "user_uid": str(uuid.uuid4()),
+            "role": "user", "verified": True, "pv": 0,
+        },
+        "exp": datetime.now(timezone.utc) + timedelta(hours=1),
+        "jti": str(uuid.uuid4()),
+        "refresh": False,
+        "sid": str(uuid.uuid4()),
+    }
+
+
+def measure(fn, count: int) -> float:
+    fn()
+    start = time.perf_counter()
+    for _ in range(count):
+        fn()
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=5000)
+    args = parser.parse_args()
+
+    payload = make_payload()
+    ed_pem = generate_private_key("EdDSA")
+    es_pem = generate_private_key("ES256")
+    rings = {
+        "HS256 keyring": KeyRing(SECRET, "HS256", {}, {}),
+        "EdDSA keyring": KeyRing(SECRET, "HS256", {"ed1": ed_pem}, {}),
+        "ES256 keyring": KeyRing(SECRET, "HS256", {"es1": es_pem}, {}),
+    }
+
+    def ed_pem_sign():
+        return jwt.encode(payload, ed_pem, algorithm="EdDSA")
+
+    ed_public_pem = serialization.load_pem_private_key(ed_pem.encode(), None).public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    ed_token = ed_pem_sign()
+    hs_token = jwt.encode(payload, SECRET, algorithm="HS256")
+
+    cases = [
+        ("HS256 before",
+         lambda: jwt.encode(payload, SECRET, algorithm="HS256"),
+         lambda: jwt.decode(hs_token, SECRET, algorithms=["HS256"])),
+        ("EdDSA from PEM", ed_pem_sign,
+         lambda: jwt.decode(ed_token, ed_public_pem, algorithms=["EdDSA"])),
+    ]
+    for name, ring in rings.items():
+        token = ring.sign(payload)
+        cases.append((name, lambda ring=ring: ring.sign(payload), lambda ring=ring, token=token: ring.verify(token)))
+
+    print(f"{'':<16} {'sign/s':>10} {'verify/s':>10}")
+    for name, sign, verify in cases:
+        print(f"{name:<16} {measure(sign, args.count):10.0f} {measure(verify, args.count):10.0f}")
+
+
+if __name__ == "__main__":
+    main()
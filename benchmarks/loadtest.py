@@ -0,0 +1,411 @@
+"""
+Load test: seed a database, boot the API and drive a mixed workload.
+
+    docker compose -f benchmarks/docker-compose.yml up -d
+    python -m benchmarks.loadtest --seed-data --duration 60 --concurrency 32 --output results.json
+
+Without --url the API is started by `benchmarks.serve` in a subprocess,
+add --fake-redis / --mail-sink to use the in-memory stand-ins instead of the
+Redis container. With --url an already running server is targeted, it must
+use the same database since the ids and accounts are read from it.
+
+Each virtual user logs in as a seeded account and then loops over
+operations picked by weight from the workload (see WORKLOADS). Latencies
+are recorded per route template after --warmup seconds and reported with
+the throughput, error rate and p50/p95/p99.
+
+    --save-baseline baseline.json   record this run as the baseline
+    --baseline baseline.json        fail (exit 1) when this run regressed;
+                                    without the file the check is skipped
+                                    with a warning, unless --require-baseline
+
+A route regressed when its p95 grew by more than --tolerance (and by more
+than --min-delta-ms, to ignore noise on fast routes), when the total
+throughput dropped by more than --tolerance, or when its error rate grew by
+more than one point.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import httpx
+
+from benchmarks.serve import add_arguments as add_server_arguments, benchmark_environment
+
+API = "/api/v1"
+
+
+@dataclass
+class Operation:
+    name: str
+    route: str
+    request: Callable[["VirtualUser"], tuple]
+    admin: bool = False
+
+
+def _book_detail(vu):
+    return "GET", f"{API}/books/{vu.rng.choice(vu.data['books'])}", None
+
+
+def _book_list(vu):
+    return "GET", f"{API}/books/", None
+
+
+def _user_books(vu):
+    return "GET", f"{API}/books/user/{vu.rng.choice(vu.data['users'])}", None
+
+
+def _create_book(vu):
+    return "POST", f"{API}/books/", {
+        "title": f"Load test {uuid.uuid4().hex}", "author": f"Author {uuid.uuid4().hex[:8]}",
+        "publisher": "Bench Press", "published_date": "2024-01-01", "page_count": 200, "language": "en",
+    }
+
+
+def _update_book(vu):
+    return "PATCH", f"{API}/books/{vu.rng.choice(vu.data['books'])}", {
+        "title": f"Updated {uuid.uuid4().hex}", "author": "Updated Author", "publisher": "Bench Press",
+        "page_count": vu.rng.randint(80, 900), "language": "en",
+    }
+
+
+def _review_detail(vu):
+    return "GET", f"{API}/review/{vu.rng.choice(vu.data['reviews'])}", None
+
+
+def _review_list(vu):
+    return "GET", f"{API}/review/", None
+
+
+def _create_review(vu):
+    return "POST", f"{API}/review/book/{vu.rng.choice(vu.data['books'])}", {
+        "rating": vu.rng.randint(0, 4), "review_text": "load test review",
+    }
+
+
+def _tag_list(vu):
+    return "GET", f"{API}/tags/", None
+
+
+def _me(vu):
+    return "GET", f"{API}/auth/me", None
+
+
+def _login(vu):
+    return "POST", f"{API}/auth/login", {"email": vu.email, "password": vu.password}
+
+
+OPERATIONS = {operation.name: operation for operation in (
+    Operation("book_detail", "GET /books/{book_id}", _book_detail),
+    Operation("book_list", "GET /books/", _book_list),
+    Operation("user_books", "GET /books/user/{user_uid}", _user_books),
+    Operation("create_book", "POST /books/", _create_book),
+    Operation("update_book", "PATCH /books/{book_id}", _update_book),
+    Operation("review_detail", "GET /review/{review_uid}", _review_detail),
+    Operation("review_list", "GET /review/", _review_list, admin=True),
+    Operation("create_review", "POST /review/book/{book_uid}", _create_review),
+    Operation("tag_list", "GET /tags/", _tag_list),
+    Operation("me", "GET /auth/me", _me),
+    Operation("login", "POST /auth/login", _login),
+)}
+
+# operation name -> weight
+WORKLOADS: Dict[str, Dict[str, int]] = {
+    "mixed": {
+        "book_detail": 35, "book_list": 4, "user_books": 10, "create_book": 2, "update_book": 3,
+        "review_detail": 15, "review_list": 1, "create_review": 6, "tag_list": 8, "me": 12, "login": 4,
+    },
+    "read": {
+        "book_detail": 50, "book_list": 5, "user_books": 10, "review_detail": 20, "tag_list": 10, "me": 5,
+    },
+    "write": {
+        "create_book": 25, "update_book": 25, "create_review": 40, "login": 10,
+    },
+}
+
+
+class Recorder:
+    def __init__(self, warmup_until: float):
+        self.warmup_until = warmup_until
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.started: Optional[float] = None
+
+    def record(self, route: str, status_code: int, latency: float) -> None:
+        now = time.monotonic()
+        if now < self.warmup_until:
+            return
+        if self.started is None:
+            self.started = now
+        self.latencies.setdefault(route, []).append(latency)
+        if status_code >= 400:
+            self.errors[route] = self.errors.get(route, 0) + 1
+
+
+class VirtualUser:
+    def __init__(self, client: httpx.AsyncClient, data: dict, email: str, password: str, seed: int):
+        self.client = client
+        self.data = data
+        self.email = email
+        self.password = password
+        self.rng = random.Random(seed)
+        self.headers: Dict[str, str] = {}
+
+    async def login(self) -> None:
+        response = await self.client.post(
+            f"{API}/auth/login", json={"email": self.email, "password": self.password}
+        )
+        response.raise_for_status()
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    async def run(self, operations: List[Operation], weights: List[int], recorder: Recorder, until: float,
+                  think_time: float) -> None:
+        while time.monotonic() < until:
+            operation = self.rng.choices(operations, weights)[0]
+            method, path, body = operation.request(self)
+            start = time.perf_counter()
+            try:
+                response = await self.client.request(method, path, json=body, headers=self.headers)
+                status_code = response.status_code
+            except httpx.HTTPError:
+                status_code = 599
+            recorder.record(operation.route, status_code, time.perf_counter() - start)
+            if think_time:
+                await asyncio.sleep(self.rng.expovariate(1 / think_time))
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    rank = math.ceil(q / 100 * len(values))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def summarize(recorder: Recorder, elapsed: float) -> dict:
+    routes = {}
+    total = 0
+    total_errors = 0
+    for route, latencies in sorted(recorder.latencies.items()):
+        latencies.sort()
+        errors = recorder.errors.get(route, 0)
+        total += len(latencies)
+        total_errors += errors
+        routes[route] = {
+            "requests": len(latencies),
+            "throughput": round(len(latencies) / elapsed, 2),
+            "error_rate": round(errors / len(latencies), 4),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        }
+    return {
+        "duration": round(elapsed, 1),
+        "requests": total,
+        "throughput": round(total / elapsed, 2) if elapsed else 0.0,
+        "error_rate": round(total_errors / total, 4) if total else 0.0,
+        "routes": routes,
+    }
+
+
+def print_summary(summary: dict) -> None:
+    print(f"{'route':<34}{'requests':>9}{'req/s':>9}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for route, stats in summary["routes"].items():
+        print(
+            f"{route:<34}{stats['requests']:>9}{stats['throughput']:>9.1f}{stats['error_rate']:>8.1%}"
+            f"{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}"
+        )
+    print(
+        f"total: {summary['requests']} requests in {summary['duration']}s, "
+        f"{summary['throughput']:.1f} req/s, {summary['error_rate']:.1%} errors"
+    )
+
+
+def compare(summary: dict, baseline: dict, tolerance: float, min_delta_ms: float) -> List[str]:
+    """
+    Returns:
+        the regressions of `summary` against `baseline`, empty when there is none
+    """
+    regressions = []
+    if summary["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(f"throughput {summary['throughput']} req/s, baseline {baseline['throughput']} req/s")
+    for route, base in baseline["routes"].items():
+        current = summary["routes"].get(route)
+        if current is None:
+            continue
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance) and current["p95_ms"] - base["p95_ms"] > min_delta_ms:
+            regressions.append(f"{route}: p95 {current['p95_ms']}ms, baseline {base['p95_ms']}ms")
+        if current["error_rate"] > base["error_rate"] + 0.01:
+            regressions.append(f"{route}: error rate {current['error_rate']:.1%}, baseline {base['error_rate']:.1%}")
+    return regressions
+
+
+async def load_ids(limit: int = 20000) -> dict:
+    from sqlalchemy import text
+
+    from src.db.main import engine
+
+    async with engine.connect() as conn:
+        data = {}
+        for name, query in (
+            ("books", "SELECT uid FROM books LIMIT :limit"),
+            ("reviews", "SELECT uid FROM reviews LIMIT :limit"),
+            ("users", "SELECT uid FROM user_accounts LIMIT :limit"),
+            ("emails", "SELECT email FROM user_accounts WHERE email LIKE 'user%@bench.local' LIMIT :limit"),
+        ):
+            result = await conn.execute(text(query), {"limit": limit})
+            data[name] = [str(row[0]) for row in result]
+    await engine.dispose()
+    if not data["books"] or not data["emails"]:
+        raise SystemExit("The database has no seeded data, run with --seed-data or python -m benchmarks.seed")
+    return data
+
+
+async def wait_for_server(client: httpx.AsyncClient, timeout: float = 30) -> None:
+    until = time.monotonic() + timeout
+    while True:
+        try:
+            await client.get("/")
+            return
+        except httpx.TransportError:
+            if time.monotonic() > until:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def run(args, data: dict) -> dict:
+    from benchmarks.seed import ADMIN_EMAIL, SEED_PASSWORD
+
+    weights_by_name = WORKLOADS[args.workload]
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.request_timeout) as client:
+        await wait_for_server(client)
+        rng = random.Random(args.seed)
+        users = []
+        for i in range(args.concurrency):
+            users.append(VirtualUser(client, data, rng.choice(data["emails"]), SEED_PASSWORD, args.seed + i))
+        admin = VirtualUser(client, data, ADMIN_EMAIL, SEED_PASSWORD, args.seed - 1)
+        await asyncio.gather(*(user.login() for user in users + [admin]))
+
+        user_operations = [OPERATIONS[name] for name in weights_by_name if not OPERATIONS[name].admin]
+        admin_operations = [OPERATIONS[name] for name in weights_by_name if OPERATIONS[name].admin]
+
+        start = time.monotonic()
+        until = start + args.warmup + args.duration
+        recorder = Recorder(warmup_until=start + args.warmup)
+        runs = [
+            user.run(user_operations, [weights_by_name[op.name] for op in user_operations], recorder, until,
+                     args.think_time)
+            for user in users
+        ]
+        if admin_operations:
+            runs.append(admin.run(
+                admin_operations, [weights_by_name[op.name] for op in admin_operations], recorder, until,
+                args.think_time
+            ))
+        await asyncio.gather(*runs)
+        elapsed = time.monotonic() - (recorder.started or until)
+
+    summary = summarize(recorder, elapsed)
+    summary["config"] = {
+        "workload": args.workload, "concurrency": args.concurrency, "duration": args.duration,
+        "think_time": args.think_time, "books": len(data["books"]),
+    }
+    return summary
+
+
+def start_server(args) -> subprocess.Popen:
+    command = [
+        sys.executable, "-m", "benchmarks.serve", "--port", str(args.port),
+        "--database-url", args.database_url, "--redis-host", args.redis_host,
+        "--redis-port", str(args.redis_port), "--mail-port", str(args.mail_port),
+    ]
+    for flag in ("fake_redis", "mail_sink", "rate_limits"):
+        if getattr(args, flag):
+            command.append("--" + flag.replace("_", "-"))
+    return subprocess.Popen(command)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="target a running server instead of starting one")
+    parser.add_argument("--port", type=int, default=8001)
+    add_server_arguments(parser)
+    parser.add_argument("--seed-data", action="store_true", help="seed the database before the run")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--books", type=int, default=2000)
+    parser.add_argument("--reviews-per-book", type=int, default=5)
+    parser.add_argument("--tags", type=int, default=50)
+    parser.add_argument("--workload", choices=sorted(WORKLOADS), default="mixed")
+    parser.add_argument("--concurrency", type=int, default=32, help="number of virtual users")
+    parser.add_argument("--duration", type=float, default=60, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=10, help="seconds run before measuring")
+    parser.add_argument("--think-time", type=float, default=0, help="mean pause between requests of a user")
+    parser.add_argument("--request-timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", type=Path, help="write the results as json")
+    parser.add_argument("--save-baseline", type=Path)
+    parser.add_argument("--baseline", type=Path)
+    parser.add_argument("--require-baseline", action="store_true", help="fail when the baseline does not exist")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--min-delta-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    # the harness reads the database directly, with the same settings as the server
+    os.environ.update(benchmark_environment(
+        args.database_url, args.redis_host, args.redis_port, args.mail_port, args.rate_limits
+    ))
+
+    if args.seed_data:
+        from benchmarks.seed import seed
+
+        counts = asyncio.run(seed(args.users, args.books, args.reviews_per_book, args.tags, args.seed, reset=True))
+        print("seeded", ", ".join(f"{count} {name}" for name, count in counts.items()))
+    data = asyncio.run(load_ids())
+
+    server = None
+    if args.url is None:
+        args.url = f"http://127.0.0.1:{args.port}"
+        server = start_server(args)
+    try:
+        summary = asyncio.run(run(args, data))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    print_summary(summary)
+    if args.output:
+        args.output.write_text(json.dumps(summary, indent=2))
+    if args.save_baseline:
+        args.save_baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.save_baseline.write_text(json.dumps(summary, indent=2))
+        print(f"baseline saved to {args.save_baseline}")
+    if args.baseline:
+        if not args.baseline.exists():
+            message = f"no baseline at {args.baseline}, record one with --save-baseline"
+            if args.require_baseline:
+                raise SystemExit(message)
+            print(f"warning: {message}; the regression check is skipped", file=sys.stderr)
+            return
+        regressions = compare(summary, json.loads(args.baseline.read_text()), args.tolerance, args.min_delta_ms)
+        if regressions:
+            print("regressions against the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            raise SystemExit(1)
+        print("no regression against the baseline")
+
+
+if __name__ == "__main__":
+    main()
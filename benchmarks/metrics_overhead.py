@@ -0,0 +1,28 @@
+"""
+Cost of recording the metrics of one request.
+
+    python -m benchmarks.metrics_overhead
+"""
+import timeit
+
+from src.db.main import QueryStats
+from src.metrics import record_request
+
+
+def main():
+    stats = QueryStats()
+    stats.count, stats.duration = 3, 0.004
+    routes = ["/api/v1/books/", "/api/v1/books/{book_id}", "/api/v1/review/", "/api/v1/tags/"]
+    statuses = [200, 200, 200, 201, 404]
+
+    def record(i=[0]):
+        i[0] += 1
+        record_request("GET", routes[i[0] % 4], statuses[i[0] % 5], 0.0123, stats)
+
+    number = 200000
+    best = min(timeit.repeat(record, number=number, repeat=5))
+    print(f"record_request: {best / number * 1e6:.2f}us per request")
+
+
+if __name__ == "__main__":
+    main()
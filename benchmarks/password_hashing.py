@@ -0,0 +1,73 @@
+"""
+Password hashing throughput per policy.
+
+    python -m benchmarks.password_hashing --seconds 3
+
+For each policy: the latency of one hash, the hashes per second of one
+thread, and the hashes per second per core with one thread per core, which
+is what a busy login endpoint gets out of each core. "calibrated" rows are
+the cost PasswordPolicy picks on this machine for --target-ms.
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.auth.passwords import PasswordPolicy, build_context
+
+PASSWORD = "benchpass123"
+
+
+def fixed_policies():
+    return [
+        ("bcrypt rounds=10", build_context("bcrypt", 10, 2, 65536, 2)),
+        ("bcrypt rounds=12", build_context("bcrypt", 12, 2, 65536, 2)),
+        ("argon2id t=2 m=19MiB p=1", build_context("argon2", 12, 2, 19 * 1024, 1)),
+        ("argon2id t=2 m=64MiB p=2", build_context("argon2", 12, 2, 64 * 1024, 2)),
+        ("argon2id t=3 m=64MiB p=4", build_context("argon2", 12, 3, 64 * 1024, 4)),
+    ]
+
+
+def calibrated_policies(target_ms: float):
+    policies = []
+    for scheme in ("bcrypt", "argon2"):
+        policy = PasswordPolicy(scheme=scheme, target_ms=target_ms, bcrypt_rounds=10, argon2_time_cost=1)
+        settings = policy.calibrate()
+        label = " ".join(f"{k}={v}" for k, v in settings.items())
+        policies.append((f"calibrated {scheme} {label}", policy.context))
+    return policies
+
+
+def hashes_during(context, seconds: float) -> int:
+    count = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        context.hash(PASSWORD)
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=3, help="duration of each measurement")
+    parser.add_argument("--target-ms", type=float, default=250)
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    print(f"{args.threads} threads")
+    print(f"{'policy':<60} {'latency':>9} {'1 thread/s':>11} {'per core/s':>11}")
+    for name, context in fixed_policies() + calibrated_policies(args.target_ms):
+        hash = context.hash(PASSWORD)
+        start = time.perf_counter()
+        context.verify(PASSWORD, hash)
+        latency = time.perf_counter() - start
+
+        single = hashes_during(context, args.seconds) / args.seconds
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            counts = pool.map(lambda _: hashes_during(context, args.seconds), range(args.threads))
+            total = sum(counts) / args.seconds
+        print(f"{name:<60} {latency * 1000:7.0f}ms {single:11.1f} {total / args.threads:11.1f}")
+
+
+if __name__ == "__main__":
+    main()
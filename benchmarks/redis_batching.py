@@ -0,0 +1,83 @@
+"""
+Round trips saved by the Redis auto-batcher under concurrent load.
+
+    python -m benchmarks.redis_batching --concurrency 200 --seconds 5
+    python -m benchmarks.redis_batching --fake-redis
+
+Each virtual request does what authenticating a token does: check its
+session (HEXISTS) and read the token version of its user (GET), for one of
+--users users. The same load runs with the batcher on and off, against the
+Redis from benchmarks/docker-compose.yml or fakeredis; fakeredis has no
+network, so only its round trip counts are meaningful.
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+
+from benchmarks.serve import DEFAULT_DATABASE_URL, benchmark_environment
+
+
+async def run(concurrency: int, seconds: float, users: int, batched: bool) -> dict:
+    from src.db import redis
+
+    redis.batcher = redis.RedisBatcher(redis.token_blocklist, enabled=batched)
+    rng = random.Random(42)
+    deadline = time.perf_counter() + seconds
+    requests = 0
+
+    async def virtual_request() -> None:
+        nonlocal requests
+        while time.perf_counter() < deadline:
+            user_uid = f"bench-{rng.randrange(users)}"
+            await asyncio.gather(redis.session_active(user_uid, "session"), redis.token_in_blocklist(user_uid))
+            requests += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(virtual_request() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests/s": requests / elapsed,
+        "commands/s": redis.batcher.commands / elapsed,
+        "round trips/s": redis.batcher.round_trips / elapsed,
+    }
+
+
+async def main(args) -> None:
+    if args.fake_redis:
+        import fakeredis.aioredis
+
+        from src.db import redis
+        redis.use_client(fakeredis.aioredis.FakeRedis())
+
+    results = {}
+    for name, batched in (("unbatched", False), ("batched", True)):
+        results[name] = await run(args.concurrency, args.seconds, args.users, batched)
+
+    print(f"{args.concurrency} concurrent requests, {args.users} users")
+    print(f"{'':<10} {'requests/s':>12} {'commands/s':>12} {'round trips/s':>14}")
+    for name, result in results.items():
+        print(f"{name:<10} " + " ".join(f"{result[k]:{w}.0f}" for k, w in (
+            ("requests/s", 12), ("commands/s", 12), ("round trips/s", 14)
+        )))
+    batched = results["batched"]
+    saved = batched["commands/s"] - batched["round trips/s"]
+    print(f"round trips saved: {saved:.0f}/s, "
+          f"{batched['commands/s'] / max(batched['round trips/s'], 1):.1f} commands per round trip")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--redis-host", default="localhost")
+    parser.add_argument("--redis-port", type=int, default=6380)
+    parser.add_argument("--fake-redis", action="store_true", help="use fakeredis instead of a Redis server")
+    args = parser.parse_args()
+    os.environ.update(benchmark_environment(
+        os.environ.get("BENCH_DATABASE_URL", DEFAULT_DATABASE_URL),
+        args.redis_host, args.redis_port, 8025
+    ))
+    asyncio.run(main(args))
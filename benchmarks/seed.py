@@ -0,0 +1,144 @@
+"""
+Seed a database with synthetic users, books, reviews and tags.
+
+    python -m benchmarks.seed --users 200 --books 2000 --reviews-per-book 5 --tags 50
+
+The schema is created from the models when it does not exist, so the
+target is meant to be a throwaway database such as the one from
+benchmarks/docker-compose.yml. Every user has the password SEED_PASSWORD
+and is verified; the first one is an admin. The password is hashed once
+for all users, hashing it per user would dominate the seeding time, with
+the cost the server calibrates to at startup: a hash below it would be
+upgraded, and written back, on the first login of every user, which would
+make the login latency depend on the order of the runs.
+"""
+import argparse
+import asyncio
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, text
+from sqlmodel import SQLModel
+
+from src.auth.passwords import password_policy
+from src.auth.utils import get_hashed_password
+from src.db.main import engine
+from src.db.models import Book, BookTags, Review, Tag, User
+from src.review_archive import ensure_partitions
+
+SEED_PASSWORD = "benchpass123"
+ADMIN_EMAIL = "admin0@bench.local"
+BATCH_SIZE = 1000
+
+WORDS = (
+    "river night garden stone silver winter empire shadow glass letter "
+    "ocean forest memory city crown storm orchard lantern harbor machine"
+).split()
+
+
+def user_email(i: int) -> str:
+    return ADMIN_EMAIL if i == 0 else f"user{i}@bench.local"
+
+
+def make_title(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS).title() for _ in range(rng.randint(2, 5)))
+
+
+def make_uid(rng: random.Random) -> uuid.UUID:
+    return uuid.UUID(int=rng.getrandbits(128), version=4)
+
+
+async def insert_rows(conn, table, rows) -> None:
+    for start in range(0, len(rows), BATCH_SIZE):
+        await conn.execute(insert(table), rows[start:start + BATCH_SIZE])
+
+
+async def seed(users: int, books: int, reviews_per_book: int, tags: int, seed_value: int = 42, reset: bool = False):
+    """
+    Insert the synthetic data set. The pooled connections are closed at the
+    end, so that the caller may run the next step on another event loop.
+    Returns:
+        dict with the number of rows inserted per table
+    """
+    rng = random.Random(seed_value)
+    now = datetime.now()
+    await asyncio.to_thread(password_policy.calibrate)
+    password_hash = await get_hashed_password(SEED_PASSWORD)
+
+    user_rows = [
+        {
+            "uid": make_uid(rng), "username": f"u{i}"[:8], "email": user_email(i),
+            "first_name": "Bench", "last_name": f"User{i}", "role": "admin" if i == 0 else "user",
+            "is_verified": True, "password_hash": password_hash, "created_at": now,
+        }
+        for i in range(users)
+    ]
+    tag_rows = [{"uid": make_uid(rng), "name": f"tag-{i}", "created_at": now} for i in range(tags)]
+    book_rows = []
+    for i in range(books):
+        created = now - timedelta(minutes=books - i)
+        book_rows.append({
+            "uid": make_uid(rng), "title": f"{make_title(rng)} {i}", "author": f"Author {rng.randint(1, books // 4 + 1)}",
+            "publisher": f"Publisher {rng.randint(1, 50)}", "published_date": f"{rng.randint(1950, 2024)}-01-01",
+            "page_count": rng.randint(80, 900), "language": rng.choice(["en", "en", "en", "es", "fr"]),
+            "user_uid": rng.choice(user_rows)["uid"], "created_at": created, "updated_at": created,
+        })
+    review_rows = [
+        {
+            "uid": make_uid(rng), "rating": rng.randint(0, 4), "review_text": " ".join(rng.choices(WORDS, k=12)),
+            "user_uid": rng.choice(user_rows)["uid"], "book_uid": book["uid"],
+            "created_at": book["created_at"], "update_at": book["created_at"],
+        }
+        for book in book_rows
+        for _ in range(reviews_per_book)
+    ]
+    book_tag_rows = [
+        {"book_uid": book["uid"], "tag_uid": tag["uid"]}
+        for book in book_rows
+        for tag in rng.sample(tag_rows, min(len(tag_rows), 3))
+    ]
+
+    try:
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+            if reset:
+                await conn.execute(text(
+                    "TRUNCATE booktags, reviews, books, tags, user_accounts, email_outbox CASCADE"
+                ))
+            # monthly partitions must exist before the rows, the default one
+            # can not give rows away to a partition created later
+            await ensure_partitions(conn, (now - timedelta(minutes=books)).date(), now.date())
+            for table, rows in (
+                (User, user_rows), (Tag, tag_rows), (Book, book_rows), (Review, review_rows), (BookTags, book_tag_rows)
+            ):
+                await insert_rows(conn, table, rows)
+    finally:
+        await engine.dispose()
+
+    return {
+        "users": len(user_rows), "tags": len(tag_rows), "books": len(book_rows),
+        "reviews": len(review_rows), "book_tags": len(book_tag_rows),
+    }
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--books", type=int, default=2000)
+    parser.add_argument("--reviews-per-book", type=int, default=5)
+    parser.add_argument("--tags", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42, help="random seed, the same seed gives the same rows and uids")
+    parser.add_argument("--reset", action="store_true", help="empty the tables first")
+
+
+async def main(args) -> None:
+    start = time.perf_counter()
+    counts = await seed(args.users, args.books, args.reviews_per_book, args.tags, args.seed, args.reset)
+    print(", ".join(f"{count} {name}" for name, count in counts.items()), f"in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,102 @@
+"""
+Serialization throughput of a list of books with their reviews.
+
+    python -m benchmarks.serialization --books 1000
+
+"before" is what FastAPI does for `response_model=List[BookDetailModel]`:
+validate the ORM objects, convert them to python json types and encode them
+with the stdlib json module. "after" are the paths used by the routes now.
+"""
+import argparse
+import json
+import time
+import uuid
+from datetime import datetime
+from types import SimpleNamespace
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+
+from src.books.schema import book_detail_list_adapter
+
+
+def make_books(count: int, reviews_per_book: int):
+    now = datetime.now()
+    books = []
+    for i in range(count):
+        book_uid = uuid.uuid4()
+        reviews = [
+            SimpleNamespace(
+                uid=uuid.uuid4(), rating=j % 5, review_text=f"review {j} of book {i}",
+                user_uid=uuid.uuid4(), book_uid=book_uid, created_at=now
+            )
+            for j in range(reviews_per_book)
+        ]
+        books.append(SimpleNamespace(
+            uid=book_uid, title=f"Book {i}", author=f"Author {i}", publisher="Publisher",
+            published_date="2024-01-01", page_count=300, language="en", reviews=reviews
+        ))
+    return books
+
+
+def as_rows(books):
+    return [
+        {
+            "uid": b.uid, "title": b.title, "author": b.author, "publisher": b.publisher,
+            "published_date": b.published_date, "page_count": b.page_count, "language": b.language,
+            "reviews": [dict(vars(r)) for r in b.reviews],
+        }
+        for b in books
+    ]
+
+
+def before(books) -> bytes:
+    validated = book_detail_list_adapter.validate_python(books, from_attributes=True)
+    content = jsonable_encoder(book_detail_list_adapter.dump_python(validated, mode="json"))
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def adapter_path(books) -> bytes:
+    return book_detail_list_adapter.dump_json(
+        book_detail_list_adapter.validate_python(books, from_attributes=True)
+    )
+
+
+def rows_path(rows) -> bytes:
+    return orjson.dumps(rows)
+
+
+def measure(fn, arg, repeat: int) -> float:
+    fn(arg)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(arg)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books", type=int, default=1000)
+    parser.add_argument("--reviews", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    books = make_books(args.books, args.reviews)
+    rows = as_rows(books)
+    size = len(rows_path(rows))
+    print(f"{args.books} books, {args.reviews} reviews each, {size / 1024:.0f}KiB of json")
+
+    baseline = measure(before, books, args.repeat)
+    for name, fn, arg in (
+        ("before: validate + jsonable_encoder + json", before, books),
+        ("after: TypeAdapter validate + dump_json", adapter_path, books),
+        ("after: rows + orjson", rows_path, rows),
+    ):
+        elapsed = measure(fn, arg, args.repeat)
+        print(f"{name:<45} {elapsed * 1000:8.2f}ms  {1 / elapsed:8.0f} payloads/s  x{baseline / elapsed:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Throughput and latency of the job worker.
+
+    python -m benchmarks.task_throughput --tasks 5000 --concurrency 4
+    python -m benchmarks.task_throughput --broker memory
+    python -m benchmarks.task_throughput --broker eager
+
+Queues --tasks `ping` jobs at once and waits for all their results, then
+sends --round-trips jobs one at a time to measure the latency of a single
+job. With the Redis from benchmarks/docker-compose.yml (the default) a
+worker runs as a subprocess with --concurrency prefork processes, so the
+numbers include the broker, the result backend and the pool. "memory" runs
+a solo worker thread in this process against the in memory broker and
+"eager" runs the jobs inline; the difference with the Redis numbers is what
+the broker and the pool cost per job.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from benchmarks.serve import DEFAULT_DATABASE_URL, benchmark_environment
+
+
+def start_worker(args):
+    from src.worker import celery_app
+
+    if args.broker == "redis":
+        return subprocess.Popen([
+            sys.executable, "-m", "celery", "-A", "src.worker", "worker", "-Q", "default",
+            "-c", str(args.concurrency), "--loglevel", "WARNING", "--without-mingle", "--without-gossip",
+        ])
+    if args.broker == "memory":
+        # the in memory transport polls its queues, once a second by default
+        celery_app.conf.broker_transport_options["polling_interval"] = 0.001
+        worker = celery_app.Worker(
+            pool="solo", queues=["default"], loglevel="WARNING", quiet=True, redirect_stdouts=False,
+            without_heartbeat=True, without_mingle=True, without_gossip=True,
+        )
+        threading.Thread(target=worker.start, daemon=True).start()
+    return None
+
+
+def run(args) -> dict:
+    from celery.result import ResultSet
+
+    from src.worker import ping
+
+    # waits for the worker to be up
+    ping.apply_async().get(timeout=60, disable_sync_subtasks=False)
+
+    start = time.perf_counter()
+    results = ResultSet([ping.apply_async((i,)) for i in range(args.tasks)])
+    queued = time.perf_counter() - start
+    # eager results have no backend to wait on
+    join = results.join if args.broker == "eager" else results.join_native
+    join(timeout=600, interval=0.01, disable_sync_subtasks=False)
+    elapsed = time.perf_counter() - start
+
+    latencies = []
+    for i in range(args.round_trips):
+        sent = time.perf_counter()
+        ping.apply_async((i,)).get(timeout=60, interval=0.001, disable_sync_subtasks=False)
+        latencies.append((time.perf_counter() - sent) * 1000)
+    latencies.sort()
+    return {
+        "queued/s": args.tasks / queued,
+        "completed/s": args.tasks / elapsed,
+        "p50 ms": statistics.median(latencies),
+        "p99 ms": latencies[int(len(latencies) * 0.99) - 1],
+    }
+
+
+def main(args) -> None:
+    worker = start_worker(args)
+    try:
+        result = run(args)
+    finally:
+        if worker is not None:
+            worker.terminate()
+            worker.wait()
+
+    concurrency = args.concurrency if args.broker == "redis" else 1
+    print(f"{args.tasks} jobs, broker {args.broker}, {concurrency} worker process(es)")
+    print(" ".join(f"{name:>12}" for name in result))
+    print(" ".join(f"{value:>12.1f}" for value in result.values()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--broker", choices=["redis", "memory", "eager"], default="redis")
+    parser.add_argument("--tasks", type=int, default=2000)
+    parser.add_argument("--round-trips", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--redis-host", default="localhost")
+    parser.add_argument("--redis-port", type=int, default=6380)
+    args = parser.parse_args()
+    os.environ.update(benchmark_environment(
+        os.environ.get("BENCH_DATABASE_URL", DEFAULT_DATABASE_URL),
+        args.redis_host, args.redis_port, 8025
+    ))
+    if args.broker == "memory":
+        os.environ.update(CELERY_BROKER_URL="memory://", CELERY_RESULT_BACKEND="cache+memory://")
+    elif args.broker == "eager":
+        os.environ["CELERY_TASK_ALWAYS_EAGER"] = "true"
+    main(args)
@@ -0,0 +1,38 @@
+"""add user deleted_at and user_uid indexes
+
+Revision ID: 7d2e5b0c41a9
+Revises: 3c6031ce98db
+Create Date: 2026-10-19 14:05:37.512093
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = '7d2e5b0c41a9'
+down_revision: Union[str, None] = '3c6031ce98db'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('user_accounts', sa.Column('deleted_at', postgresql.TIMESTAMP(), nullable=True))
+    # built concurrently, books and reviews stay writable meanwhile
+    with op.get_context().autocommit_block():
+        op.create_index('ix_user_accounts_deleted_at', 'user_accounts', ['deleted_at'], unique=False, postgresql_where=sa.text('deleted_at IS NOT NULL'), postgresql_concurrently=True)
+        op.create_index('ix_books_user_uid', 'books', ['user_uid'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_reviews_user_uid', 'reviews', ['user_uid'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_reviews_book_uid', 'reviews', ['book_uid'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_reviews_book_uid', table_name='reviews', postgresql_concurrently=True)
+        op.drop_index('ix_reviews_user_uid', table_name='reviews', postgresql_concurrently=True)
+        op.drop_index('ix_books_user_uid', table_name='books', postgresql_concurrently=True)
+        op.drop_index('ix_user_accounts_deleted_at', table_name='user_accounts', postgresql_where=sa.text('deleted_at IS NOT NULL'), postgresql_concurrently=True)
+    op.drop_column('user_accounts', 'deleted_at')
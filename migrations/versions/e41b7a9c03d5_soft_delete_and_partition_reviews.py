@@ -0,0 +1,106 @@
+"""soft delete books and reviews, partition reviews by month
+
+Revision ID: e41b7a9c03d5
+Revises: 7d2e5b0c41a9
+Create Date: 2026-10-19 16:21:08.904311
+
+reviews is rebuilt as a table partitioned by month of created_at: the old
+table is renamed, the partitioned one created with one partition per month
+from the oldest review to REVIEW_PARTITION_MONTHS_AHEAD months from now,
+the rows copied and the old table dropped. Reviews without created_at get
+the migration time. The copy holds a lock on reviews, run it when writes
+can wait.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = 'e41b7a9c03d5'
+down_revision: Union[str, None] = '7d2e5b0c41a9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+MONTHS_AHEAD = 3
+
+
+def upgrade() -> None:
+    op.add_column('books', sa.Column('deleted_at', postgresql.TIMESTAMP(), nullable=True))
+    op.create_index('ix_books_created_at_live', 'books', ['created_at'], unique=False, postgresql_where=sa.text('deleted_at IS NULL'))
+
+    op.drop_index('ix_reviews_book_uid', table_name='reviews')
+    op.drop_index('ix_reviews_user_uid', table_name='reviews')
+    op.rename_table('reviews', 'reviews_unpartitioned')
+    op.execute('ALTER TABLE reviews_unpartitioned RENAME CONSTRAINT reviews_pkey TO reviews_unpartitioned_pkey')
+
+    op.execute("""
+        CREATE TABLE reviews (
+            uid UUID NOT NULL,
+            rating INTEGER NOT NULL,
+            review_text VARCHAR NOT NULL,
+            user_uid UUID REFERENCES user_accounts (uid),
+            book_uid UUID REFERENCES books (uid),
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            update_at TIMESTAMP WITHOUT TIME ZONE,
+            deleted_at TIMESTAMP WITHOUT TIME ZONE,
+            PRIMARY KEY (uid, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    op.execute(f"""
+        DO $$
+        DECLARE
+            month DATE := date_trunc('month', COALESCE((SELECT min(created_at) FROM reviews_unpartitioned), now()));
+        BEGIN
+            WHILE month <= date_trunc('month', now()) + interval '{MONTHS_AHEAD} months' LOOP
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF reviews FOR VALUES FROM (%L) TO (%L)',
+                    'reviews_p' || to_char(month, 'YYYY_MM'), month, month + interval '1 month'
+                );
+                month := month + interval '1 month';
+            END LOOP;
+        END
+        $$
+    """)
+    op.execute('CREATE TABLE reviews_default PARTITION OF reviews DEFAULT')
+    op.execute("""
+        INSERT INTO reviews (uid, rating, review_text, user_uid, book_uid, created_at, update_at)
+        SELECT uid, rating, review_text, user_uid, book_uid, COALESCE(created_at, now()), update_at
+        FROM reviews_unpartitioned
+    """)
+    op.drop_table('reviews_unpartitioned')
+
+    op.create_index('ix_reviews_user_uid', 'reviews', ['user_uid'], unique=False)
+    op.create_index('ix_reviews_book_uid_live', 'reviews', ['book_uid', 'created_at'], unique=False, postgresql_where=sa.text('deleted_at IS NULL'))
+    op.create_index('ix_reviews_created_at_live', 'reviews', ['created_at'], unique=False, postgresql_where=sa.text('deleted_at IS NULL'))
+
+
+def downgrade() -> None:
+    # archived partitions are not restored, and soft deleted reviews are dropped
+    op.rename_table('reviews', 'reviews_partitioned')
+    op.create_table('reviews',
+    sa.Column('uid', sa.UUID(), nullable=False),
+    sa.Column('rating', sa.Integer(), nullable=False),
+    sa.Column('review_text', sa.VARCHAR(), nullable=False),
+    sa.Column('user_uid', sa.Uuid(), nullable=True),
+    sa.Column('book_uid', sa.Uuid(), nullable=True),
+    sa.Column('created_at', postgresql.TIMESTAMP(), nullable=True),
+    sa.Column('update_at', postgresql.TIMESTAMP(), nullable=True),
+    sa.ForeignKeyConstraint(['book_uid'], ['books.uid'], ),
+    sa.ForeignKeyConstraint(['user_uid'], ['user_accounts.uid'], ),
+    sa.PrimaryKeyConstraint('uid', name='reviews_unpartitioned_pkey')
+    )
+    op.execute("""
+        INSERT INTO reviews (uid, rating, review_text, user_uid, book_uid, created_at, update_at)
+        SELECT uid, rating, review_text, user_uid, book_uid, created_at, update_at
+        FROM reviews_partitioned WHERE deleted_at IS NULL
+    """)
+    op.drop_table('reviews_partitioned')
+    op.execute('ALTER TABLE reviews RENAME CONSTRAINT reviews_unpartitioned_pkey TO reviews_pkey')
+    op.create_index('ix_reviews_user_uid', 'reviews', ['user_uid'], unique=False)
+    op.create_index('ix_reviews_book_uid', 'reviews', ['book_uid'], unique=False)
+
+    op.drop_index('ix_books_created_at_live', table_name='books', postgresql_where=sa.text('deleted_at IS NULL'))
+    op.drop_column('books', 'deleted_at')
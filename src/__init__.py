@@ -1,11 +1,24 @@
+import asyncio
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 from .books.routes import books_route
-from .auth.routes import user_routes
+from .auth.routes import jwks_router, user_routes
 from .reviews.routes import review_routes
 from .tags.routes import tags_router
+from .jobs.routes import jobs_router
+from .graphql_api.routes import graphql_router
 from contextlib import asynccontextmanager
 from .errors import register_error_handler
 from .middleware import register_middleware
+from .mail_templates import email_templates
+from .access_log import start_access_log, stop_access_log
+from .metrics import metrics_router
+from .profiling import profiler, profiling_router
+from .tracing import setup_tracing, shutdown_tracing
+from .responses import NegotiatedResponse
+from .auth.passwords import password_policy
+from .db.redis import redis_healthy
+from .reviews.stream import review_broadcaster
 
 version = "v1"
 
@@ -20,6 +33,22 @@ This REST API is able to;
 
 version_prefix = f"/api/{version}"
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    email_templates.precompile()
+    await asyncio.to_thread(password_policy.calibrate)
+    start_access_log()
+    profiler.install()
+    setup_tracing()
+    yield
+    await review_broadcaster.close()
+    shutdown_tracing()
+    profiler.uninstall()
+    stop_access_log()
+    password_policy.shutdown()
+
+
 app = FastAPI(
     title="BookStore",
     description=description,
@@ -33,7 +62,9 @@ app = FastAPI(
     terms_of_service="httpS://example.com/tos",
     openapi_url=f"{version_prefix}/openapi.json",
     docs_url=f"{version_prefix}/docs",
-    redoc_url=f"{version_prefix}/redoc"
+    redoc_url=f"{version_prefix}/redoc",
+    lifespan=lifespan,
+    default_response_class=NegotiatedResponse
 )
 
 register_error_handler(app)
@@ -43,6 +74,18 @@ app.include_router(books_route, prefix=f"{version_prefix}/books", tags=['books']
 app.include_router(user_routes, prefix=f"{version_prefix}/auth", tags=['User'])
 app.include_router(review_routes, prefix=f"{version_prefix}/review", tags=['Review'])
 app.include_router(tags_router, prefix=f"{version_prefix}/tags", tags=["tags"]) 
+app.include_router(graphql_router, prefix=f"{version_prefix}/graphql", tags=["graphql"])
+app.include_router(jobs_router, prefix=f"{version_prefix}/jobs", tags=["jobs"])
+app.include_router(profiling_router, prefix=f"{version_prefix}/profiling", tags=["profiling"])
+app.include_router(metrics_router)
+app.include_router(jwks_router)
+
+@app.get("/health", include_in_schema=False)
+async def health():
+    """Readiness: the app answers and Redis is reachable"""
+    if await redis_healthy():
+        return {"status": "ok"}
+    return JSONResponse({"status": "redis unavailable"}, status_code=503)
 
 @app.get("/")
 async def root():
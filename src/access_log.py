@@ -0,0 +1,100 @@
+import json
+import logging
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from fastapi import Request, Response
+
+from src.config import Config
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Format records as one json object per line. Access records carry their
+    fields in `record.access`.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+        }
+        access = getattr(record, "access", None)
+        if access is not None:
+            payload.update(access)
+        else:
+            payload["message"] = record.getMessage()
+        return json.dumps(payload, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Queue handler that leaves the formatting to the listener thread and drops
+    records instead of blocking or raising when the queue is full.
+    """
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+
+access_logger = logging.getLogger("bookstore.access")
+access_logger.setLevel(logging.INFO)
+access_logger.propagate = False
+
+_queue: queue.Queue = queue.Queue(maxsize=Config.ACCESS_LOG_QUEUE_SIZE)
+_stream_handler = logging.StreamHandler(sys.stdout)
+_stream_handler.setFormatter(JSONFormatter())
+access_logger.addHandler(NonBlockingQueueHandler(_queue))
+listener = QueueListener(_queue, _stream_handler, respect_handler_level=True)
+
+
+def start_access_log() -> None:
+    """Start the background thread that writes the access log"""
+    if listener._thread is None:
+        listener.start()
+
+
+def stop_access_log() -> None:
+    """Flush the queued records and stop the background thread"""
+    if listener._thread is not None:
+        listener.stop()
+
+
+def should_log(status_code: int, duration: float) -> bool:
+    """
+    Errors and slow requests are always logged, the rest is sampled
+    """
+    if status_code >= 400 or duration * 1000 >= Config.ACCESS_LOG_SLOW_MS:
+        return True
+    return random.random() < Config.ACCESS_LOG_SAMPLE_RATE
+
+
+def log_access(request: Request, response: Response, duration: float) -> None:
+    """
+    Hand an access record to the queue, the json is built on the listener thread
+    """
+    if not should_log(response.status_code, duration):
+        return
+    client = request.client
+    access_logger.info(
+        "access",
+        extra={
+            "access": {
+                "client": f"{client.host}:{client.port}" if client else None,
+                "method": request.method,
+                "path": request.url.path,
+                "status": response.status_code,
+                "duration_ms": round(duration * 1000, 3),
+            }
+        },
+    )
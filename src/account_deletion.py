@@ -0,0 +1,174 @@
+"""
+Account deletion worker.
+
+Deleting an account only sets `deleted_at` on the user, which hides it from
+logins and lookups right away. This worker then removes the data of marked
+users in bounded batches, each batch one set-based statement in its own
+transaction, and finally the user row. Run it next to the API:
+
+    python -m src.account_deletion
+
+Reviews written by the user are deleted. Books the user added are kept
+without an owner (ACCOUNT_DELETION_BOOKS=anonymize), or deleted with their
+reviews and tag links (ACCOUNT_DELETION_BOOKS=delete).
+
+Every step deletes or updates whatever is left, so a job interrupted at any
+point is simply run again. Progress is kept in Redis (see
+`get_deletion_progress`) and a Redis lease keeps two workers off the same user.
+"""
+import asyncio
+import logging
+import uuid
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy import delete, tuple_, update
+from sqlmodel import select
+
+from src.config import Config
+from src.db.main import engine
+from src.db.models import Book, BookTags, Review, User
+from src.db.redis import acquire_lease, record_deletion_progress, release_lease
+from src.tracing import setup_tracing, shutdown_tracing, traced
+
+logger = logging.getLogger(__name__)
+
+
+def delete_reviews(user_uid: uuid.UUID, limit: int):
+    batch = select(Review.uid).where(Review.user_uid == user_uid).limit(limit)
+    return delete(Review).where(Review.uid.in_(batch))
+
+
+def anonymize_books(user_uid: uuid.UUID, limit: int):
+    batch = select(Book.uid).where(Book.user_uid == user_uid).limit(limit)
+    return update(Book).where(Book.uid.in_(batch)).values(user_uid=None)
+
+
+def delete_book_tags(user_uid: uuid.UUID, limit: int):
+    batch = (
+        select(BookTags.book_uid, BookTags.tag_uid)
+        .join(Book, Book.uid == BookTags.book_uid)
+        .where(Book.user_uid == user_uid)
+        .limit(limit)
+    )
+    return delete(BookTags).where(tuple_(BookTags.book_uid, BookTags.tag_uid).in_(batch))
+
+
+def delete_book_reviews(user_uid: uuid.UUID, limit: int):
+    batch = (
+        select(Review.uid)
+        .join(Book, Book.uid == Review.book_uid)
+        .where(Book.user_uid == user_uid)
+        .limit(limit)
+    )
+    return delete(Review).where(Review.uid.in_(batch))
+
+
+def delete_books(user_uid: uuid.UUID, limit: int):
+    batch = select(Book.uid).where(Book.user_uid == user_uid).limit(limit)
+    return delete(Book).where(Book.uid.in_(batch))
+
+
+def deletion_steps(books: str) -> List[Tuple[str, Callable]]:
+    """
+    (name, statement for one batch) in the order they run
+    """
+    if books == "anonymize":
+        return [("reviews", delete_reviews), ("books_anonymized", anonymize_books)]
+    if books == "delete":
+        return [
+            ("reviews", delete_reviews),
+            ("book_tags", delete_book_tags),
+            ("book_reviews", delete_book_reviews),
+            ("books", delete_books),
+        ]
+    raise ValueError(f"ACCOUNT_DELETION_BOOKS must be anonymize or delete, got {books}")
+
+
+class AccountDeleter:
+    def __init__(self, batch_size: int = Config.ACCOUNT_DELETION_BATCH_SIZE,
+                 books: str = Config.ACCOUNT_DELETION_BOOKS):
+        self.batch_size = batch_size
+        self.steps = deletion_steps(books)
+
+    async def pending_users(self, limit: int) -> List[uuid.UUID]:
+        async with engine.connect() as conn:
+            result = await conn.execute(
+                select(User.uid).where(User.deleted_at.is_not(None)).order_by(User.deleted_at).limit(limit)
+            )
+            return list(result.scalars())
+
+    async def _run_step(self, user_uid: uuid.UUID, name: str, statement: Callable) -> int:
+        total = 0
+        while True:
+            async with engine.begin() as conn:
+                result = await conn.execute(statement(user_uid, self.batch_size))
+            total += result.rowcount
+            await record_deletion_progress(
+                str(user_uid), {"step": name, "updated_at": datetime.now().isoformat()}, {name: result.rowcount}
+            )
+            if result.rowcount < self.batch_size:
+                return total
+
+    async def delete_account(self, user_uid: uuid.UUID) -> bool:
+        """
+        Remove the data of one marked user, then the user
+        Returns:
+            False when another worker holds the user
+        """
+        lease = await acquire_lease(f"account_deletion:{user_uid}", Config.ACCOUNT_DELETION_LEASE_SECONDS)
+        if lease is None:
+            return False
+        try:
+            with traced("account deletion", {"user.uid": str(user_uid)}):
+                await record_deletion_progress(str(user_uid), {"status": "running"})
+                for name, statement in self.steps:
+                    total = await self._run_step(user_uid, name, statement)
+                    logger.info("Account %s: %s rows for %s", user_uid, total, name)
+
+                async with engine.begin() as conn:
+                    await conn.execute(delete(User).where(User.uid == user_uid, User.deleted_at.is_not(None)))
+                await record_deletion_progress(
+                    str(user_uid), {"status": "done", "step": "user", "updated_at": datetime.now().isoformat()}
+                )
+            return True
+        finally:
+            await release_lease(f"account_deletion:{user_uid}", lease)
+
+    async def run_once(self, limit: int = 10) -> int:
+        """
+        Process the oldest marked users
+        Returns:
+            number of accounts deleted
+        """
+        deleted = 0
+        for user_uid in await self.pending_users(limit):
+            try:
+                deleted += await self.delete_account(user_uid)
+            except Exception:
+                logger.exception("Deleting account %s failed, it is retried on the next run", user_uid)
+        return deleted
+
+    async def run_forever(self, stop: Optional[asyncio.Event] = None) -> None:
+        stop = stop or asyncio.Event()
+        while not stop.is_set():
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Account deletion run failed")
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=Config.ACCOUNT_DELETION_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    setup_tracing("bookstore-account-deletion")
+    await AccountDeleter().run_forever()
+    await engine.dispose()
+    shutdown_tracing()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
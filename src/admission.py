@@ -0,0 +1,222 @@
+"""
+Admission control.
+
+At most ADMISSION_MAX_CONCURRENCY requests run at a time, and at most
+ADMISSION_ROUTE_LIMITS[route] for the expensive routes. The others wait in a
+bounded queue, served by priority (cheap reads first) and then in arrival
+order. Long lived routes such as event streams (ADMISSION_EXEMPT_ROUTES)
+are not counted, they would hold a slot for as long as they are connected.
+A request is shed with an immediate 503 when:
+
+- the queue is full (queue_full)
+- it waited longer than it is allowed to (queue_timeout)
+- it is dequeued after waiting more than the target while the queue is
+  standing (queue_delay)
+
+The last two follow CoDel: the queue is standing when it has not been empty
+during the last ADMISSION_QUEUE_INTERVAL_MS. A standing queue is not
+absorbing a burst, it only adds latency, so requests are then allowed to
+wait ADMISSION_QUEUE_TARGET_MS instead of ADMISSION_MAX_WAIT_MS, and the
+server serves the requests it can in time instead of timing everything out.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from prometheus_client import REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from src.config import Config
+from src.deadlines import match_route
+from src.metrics import record_shed
+from src.responses import RawJSONResponse
+
+OVERLOADED_BODY = b'{"message":"Server is overloaded, please retry","error_code":"overloaded"}'
+
+
+class Shed(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class Waiter:
+    __slots__ = ("route", "priority", "future", "enqueued")
+
+    def __init__(self, route: str, priority: int, future: asyncio.Future):
+        self.route = route
+        self.priority = priority
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+class AdmissionController:
+    def __init__(
+            self,
+            max_concurrency: int,
+            queue_size: int,
+            target: float,
+            interval: float,
+            max_wait: float,
+            route_limits: Dict[str, int],
+    ):
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self.target = target
+        self.interval = interval
+        self.max_wait = max_wait
+        self.route_limits = route_limits
+        self.active = 0
+        self.route_active: Dict[str, int] = {}
+        self.queues: Dict[int, Deque[Waiter]] = {}
+        self.queued = 0
+        self._last_empty = time.monotonic()
+
+    def standing(self, now: float) -> bool:
+        """True when the queue has not been empty for a whole interval"""
+        return self.queued > 0 and now - self._last_empty > self.interval
+
+    def _has_capacity(self, route: str) -> bool:
+        if self.active >= self.max_concurrency:
+            return False
+        limit = self.route_limits.get(route)
+        return limit is None or self.route_active.get(route, 0) < limit
+
+    def _start(self, route: str) -> None:
+        self.active += 1
+        self.route_active[route] = self.route_active.get(route, 0) + 1
+
+    async def acquire(self, route: str, priority: int) -> None:
+        """
+        Wait for a slot to run a request of `route`
+        Raises:
+            Shed: when the request has to be rejected
+        """
+        if self.queued == 0:
+            self._last_empty = time.monotonic()
+            if self._has_capacity(route):
+                self._start(route)
+                return
+        if self.queued >= self.queue_size:
+            raise Shed("queue_full")
+
+        now = time.monotonic()
+        timeout = self.target if self.standing(now) else self.max_wait
+        waiter = Waiter(route, priority, asyncio.get_running_loop().create_future())
+        queue = self.queues.get(priority)
+        if queue is None:
+            queue = self.queues[priority] = deque()
+            self.queues = dict(sorted(self.queues.items()))
+        queue.append(waiter)
+        self.queued += 1
+        if self.active < self.max_concurrency:
+            # the requests ahead may all be waiting on their route limit
+            self._dispatch()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except asyncio.TimeoutError:
+            self._abandon(waiter)
+            raise Shed("queue_timeout")
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+
+    def _abandon(self, waiter: Waiter) -> None:
+        if waiter.future.done():
+            if not waiter.future.cancelled() and waiter.future.exception() is None:
+                # granted at the same time it gave up, hand the slot on
+                self.release(waiter.route)
+        else:
+            waiter.future.cancel()
+            self.queues[waiter.priority].remove(waiter)
+            self.queued -= 1
+            if self.queued == 0:
+                self._last_empty = time.monotonic()
+
+    def release(self, route: str) -> None:
+        self.active -= 1
+        self.route_active[route] -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        now = time.monotonic()
+        standing = self.standing(now)
+        for queue in self.queues.values():
+            if self.active >= self.max_concurrency:
+                break
+            skipped: Deque[Waiter] = deque()
+            while queue and self.active < self.max_concurrency:
+                waiter = queue.popleft()
+                if standing and now - waiter.enqueued > self.target:
+                    self.queued -= 1
+                    waiter.future.set_exception(Shed("queue_delay"))
+                    continue
+                if not self._has_capacity(waiter.route):
+                    skipped.append(waiter)
+                    continue
+                self.queued -= 1
+                self._start(waiter.route)
+                waiter.future.set_result(None)
+            skipped.extend(queue)
+            queue.clear()
+            queue.extend(skipped)
+        if self.queued == 0:
+            self._last_empty = now
+
+
+admission_controller = AdmissionController(
+    max_concurrency=Config.ADMISSION_MAX_CONCURRENCY,
+    queue_size=Config.ADMISSION_QUEUE_SIZE,
+    target=Config.ADMISSION_QUEUE_TARGET_MS / 1000,
+    interval=Config.ADMISSION_QUEUE_INTERVAL_MS / 1000,
+    max_wait=Config.ADMISSION_MAX_WAIT_MS / 1000,
+    route_limits=Config.ADMISSION_ROUTE_LIMITS,
+)
+
+
+class AdmissionCollector:
+    """Export the admission control state at scrape time"""
+    def collect(self):
+        yield GaugeMetricFamily(
+            "admission_active_requests", "Requests admitted and running", value=admission_controller.active
+        )
+        yield GaugeMetricFamily(
+            "admission_queued_requests", "Requests waiting for admission", value=admission_controller.queued
+        )
+
+
+REGISTRY.register(AdmissionCollector())
+
+
+class AdmissionControlMiddleware:
+    def __init__(self, app: ASGIApp, controller: AdmissionController = admission_controller):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not Config.ADMISSION_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        route = match_route(scope)
+        method = scope["method"]
+        key = f"{method} {route}"
+        if route is None or key in Config.ADMISSION_EXEMPT_ROUTES:
+            await self.app(scope, receive, send)
+            return
+
+        priority = Config.ADMISSION_PRIORITIES.get(key, Config.ADMISSION_DEFAULT_PRIORITY)
+        try:
+            await self.controller.acquire(key, priority)
+        except Shed as exc:
+            record_shed(method, route, exc.reason)
+            response = RawJSONResponse(OVERLOADED_BODY, status_code=503, headers={"Retry-After": "1"})
+            await response(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(key)
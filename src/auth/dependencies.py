@@ -5,9 +5,10 @@ from fastapi import status, Request, Depends
 from fastapi.security.http import HTTPAuthorizationCredentials
 from sqlalchemy.ext.asyncio.session import AsyncSession
 
-from src.db.redis import token_in_blocklist
+from src.db.redis import get_token_version, session_active, token_in_blocklist
 from src.db.main import get_session 
-from src.db.models import User
+
+from src.tracing import traced
 
 from .utils import decode_token
 from . service import UserService
@@ -27,19 +28,25 @@ class TokenBearer(HTTPBearer):
         super().__init__(auto_error=auto_error)
 
     async def __call__(self, request: Request) -> HTTPAuthorizationCredentials | None:
-        creds = await super().__call__(request)
+        with traced(type(self).__name__):
+            creds = await super().__call__(request)
 
-        token = creds.credentials
+            token = creds.credentials
 
-        token_data = decode_token(token)
+            token_data = decode_token(token)
+
+            if token_data is None:
+                raise InvalidToken()
+
+            self.verify_token_data(token_data)
 
-        if await token_in_blocklist(token_data['jti']):
-            raise InvalidToken()
+            if not await self.session_valid(token_data):
+                raise InvalidToken()
 
-        if not self.token_valid(token):
-            raise InvalidToken()
+            if not await self.claims_current(token_data):
+                raise InvalidToken()
 
-        return token_data
+            return token_data
             
 
     def token_valid(self, token: str) -> bool:
@@ -47,6 +54,26 @@ class TokenBearer(HTTPBearer):
         token_data = decode_token(token)
 
         return token_data is not None
+
+    async def session_valid(self, token_data: dict) -> bool:
+        """
+        False when the session of the token ended (logout, refresh token
+        reuse), or for tokens without a session when the token was blocked
+        """
+        if "sid" in token_data:
+            return await session_active(token_data['user']['user_uid'], token_data['sid'])
+        return not await token_in_blocklist(token_data['jti'])
+
+    async def claims_current(self, token_data: dict) -> bool:
+        """
+        False when the token version of the user was bumped after the token
+        was issued (role change, password reset, deletion)
+        """
+        user = token_data['user']
+        if "pv" not in user:
+            # issued before tokens carried claims
+            return True
+        return user["pv"] >= await get_token_version(user["user_uid"])
     
     def verify_token_data(self, token_data):
         raise NotImplementedError("Implemented this in child class")
@@ -76,19 +103,39 @@ async def get_current_user(
     Retrieve current user from token details"""
     email = token_details['user']['email']
 
-    user = await user_service.get_user_by_email(email, session)
+    with traced("get_current_user"):
+        user = await user_service.get_user_by_email(email, session)
 
     return user
 
 
 class RoleChecker:
+    """
+    Check the role of the user from the claims of its access token, the user
+    is only loaded for tokens issued before they carried claims and for
+    unverified accounts.
+    """
     def __init__(self, access_roles: List[str]) -> None:
         self.access_roles = access_roles
 
-    def __call__(self, current_user: User = Depends(get_current_user)) -> Any:
-        if not current_user.is_verified:
-            raise AccountNotVerified()
-        if current_user.role in self.access_roles:
-            return True
-        
-        raise InsufficientPermission()
+    async def __call__(
+            self,
+            token_details: dict = Depends(AccessTokenBearer()),
+            session: AsyncSession = Depends(get_session)
+            ) -> Any:
+        with traced("RoleChecker", {"roles": self.access_roles}):
+            claims = token_details['user']
+            # unverified claims are checked again, the account may have been
+            # verified since the token was issued
+            if "role" not in claims or not claims["verified"]:
+                user = await user_service.get_user_by_email(claims['email'], session)
+                if user is None:
+                    raise InvalidToken()
+                claims = {"role": user.role, "verified": user.is_verified}
+
+            if not claims["verified"]:
+                raise AccountNotVerified()
+            if claims["role"] in self.access_roles:
+                return True
+            
+            raise InsufficientPermission()
@@ -0,0 +1,130 @@
+"""
+Keys used to sign and verify JWTs.
+
+Tokens are signed with the HMAC secret JWT_SECRET, or with an Ed25519
+(EdDSA) or P-256 (ES256) key once JWT_SIGNING_KEYS is set. Asymmetric keys
+are indexed by the `kid` written in the token header, and their public
+halves are published as a JWKS so that other services verify our tokens
+locally. Keys are parsed once, at import, signing and verifying only look
+them up.
+
+To rotate, add the new key to JWT_SIGNING_KEYS and point JWT_ACTIVE_KID at
+it; keep the old one, or its public key in JWT_VERIFY_KEYS, until the last
+refresh token signed with it has expired.
+"""
+import os
+from typing import Dict, NamedTuple, Optional
+
+import jwt
+import orjson
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+
+from src.config import Config
+
+
+class SigningKey(NamedTuple):
+    kid: Optional[str]
+    algorithm: str
+    private: object
+    public: object
+
+
+def load_pem(value: str) -> bytes:
+    """
+    A PEM given inline, with literal `\\n` allowed for env files, or the path of a PEM file
+    """
+    if "-----BEGIN" in value:
+        return value.replace("\\n", "\n").encode()
+    with open(os.path.expanduser(value), "rb") as f:
+        return f.read()
+
+
+def key_algorithm(key) -> str:
+    if isinstance(key, (ed25519.Ed25519PrivateKey, ed25519.Ed25519PublicKey)):
+        return "EdDSA"
+    if isinstance(key, (ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey)):
+        if key.curve.name != "secp256r1":
+            raise ValueError(f"ES256 needs a P-256 key, got {key.curve.name}")
+        return "ES256"
+    raise ValueError(f"unsupported JWT key type {type(key).__name__}")
+
+
+def generate_private_key(algorithm: str = "EdDSA") -> str:
+    """
+    A new private key as PEM, for JWT_SIGNING_KEYS
+    """
+    if algorithm == "EdDSA":
+        key = ed25519.Ed25519PrivateKey.generate()
+    elif algorithm == "ES256":
+        key = ec.generate_private_key(ec.SECP256R1())
+    else:
+        raise ValueError(f"unsupported algorithm {algorithm}")
+    return key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode()
+
+
+def public_jwk(key: SigningKey) -> dict:
+    jwk = jwt.get_algorithm_by_name(key.algorithm).to_jwk(key.public, as_dict=True)
+    jwk.update({"kid": key.kid, "alg": key.algorithm, "use": "sig"})
+    return jwk
+
+
+class KeyRing:
+    """
+    Signing key and verification keys by kid. Tokens without a kid are
+    verified with the HMAC secret, as long as `accept_secret` is set.
+    """
+    def __init__(self, secret: str, secret_algorithm: str, private_keys: Dict[str, str],
+                 public_keys: Dict[str, str], active_kid: Optional[str] = None, accept_secret: bool = True):
+        self.keys: Dict[str, SigningKey] = {}
+        for kid, pem in private_keys.items():
+            private = serialization.load_pem_private_key(load_pem(pem), password=None)
+            self.keys[kid] = SigningKey(kid, key_algorithm(private), private, private.public_key())
+        for kid, pem in public_keys.items():
+            public = serialization.load_pem_public_key(load_pem(pem))
+            self.keys[kid] = SigningKey(kid, key_algorithm(public), None, public)
+
+        secret_key = SigningKey(None, secret_algorithm, secret.encode(), secret.encode())
+        self.secret_key = secret_key if accept_secret or not private_keys else None
+
+        if private_keys:
+            kid = active_kid or list(private_keys)[-1]
+            if kid not in private_keys:
+                raise ValueError(f"JWT_ACTIVE_KID {kid} is not in JWT_SIGNING_KEYS")
+            self.signing_key = self.keys[kid]
+        else:
+            self.signing_key = secret_key
+
+        self.jwks = orjson.dumps({"keys": [public_jwk(key) for key in self.keys.values()]})
+
+    def sign(self, payload: dict) -> str:
+        key = self.signing_key
+        headers = {"kid": key.kid} if key.kid is not None else None
+        return jwt.encode(payload=payload, key=key.private, algorithm=key.algorithm, headers=headers)
+
+    def verify(self, token: str) -> dict:
+        """
+        Raises:
+            jwt.PyJWTError: when the token is invalid, expired or signed with an unknown key
+        """
+        if self.keys:
+            kid = jwt.get_unverified_header(token).get("kid")
+            key = self.keys.get(kid) if kid is not None else self.secret_key
+        else:
+            kid, key = None, self.secret_key
+        if key is None:
+            raise jwt.InvalidKeyError(f"unknown key id {kid}")
+        # the algorithm comes from the key, never from the token header
+        return jwt.decode(jwt=token, key=key.public, algorithms=[key.algorithm])
+
+
+keyring = KeyRing(
+    Config.JWT_SECRET,
+    Config.JWT_ALGORITHM,
+    Config.JWT_SIGNING_KEYS,
+    Config.JWT_VERIFY_KEYS,
+    Config.JWT_ACTIVE_KID,
+    Config.JWT_ACCEPT_SECRET,
+)
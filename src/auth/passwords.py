@@ -0,0 +1,143 @@
+"""
+Password hashing policy.
+
+Hashes use PASSWORD_SCHEME, bcrypt or argon2 (argon2id). At startup the
+cost is calibrated so that one hash takes about PASSWORD_HASH_TARGET_MS on
+this hardware: bcrypt rounds, or argon2 time cost with the memory and
+parallelism from the settings. BCRYPT_ROUNDS and ARGON2_TIME_COST are floors
+that calibration never goes below.
+
+Hashes of the other scheme, or with a lower cost than the policy, are
+replaced at login (`verify_and_update`). A cost higher than the policy is
+kept, so that workers calibrating slightly differently do not rehash each
+other's passwords back and forth.
+
+Hashing runs on its own thread pool, bcrypt and argon2 release the GIL, so
+logins do not block the event loop and are bounded to one per core.
+"""
+import asyncio
+import logging
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from passlib.context import CryptContext
+
+from src.config import Config
+
+SCHEMES = ("argon2", "bcrypt")
+BCRYPT_MAX_ROUNDS = 16
+ARGON2_MAX_TIME_COST = 32
+CALIBRATION_PASSWORD = "calibration-password"
+
+
+def build_context(scheme: str, bcrypt_rounds: int, argon2_time_cost: int,
+                  argon2_memory_kib: int, argon2_parallelism: int) -> CryptContext:
+    if scheme not in SCHEMES:
+        raise ValueError(f"PASSWORD_SCHEME must be one of {SCHEMES}, got {scheme}")
+    return CryptContext(
+        schemes=list(SCHEMES),
+        default=scheme,
+        deprecated="auto",
+        bcrypt__default_rounds=bcrypt_rounds,
+        bcrypt__min_rounds=bcrypt_rounds,
+        argon2__type="ID",
+        argon2__default_rounds=argon2_time_cost,
+        argon2__min_rounds=argon2_time_cost,
+        argon2__memory_cost=argon2_memory_kib,
+        argon2__parallelism=argon2_parallelism,
+    )
+
+
+def time_hash(context: CryptContext) -> float:
+    start = time.perf_counter()
+    context.hash(CALIBRATION_PASSWORD)
+    return time.perf_counter() - start
+
+
+class PasswordPolicy:
+    def __init__(self, scheme: str = Config.PASSWORD_SCHEME, target_ms: float = Config.PASSWORD_HASH_TARGET_MS,
+                 bcrypt_rounds: int = Config.BCRYPT_ROUNDS, argon2_time_cost: int = Config.ARGON2_TIME_COST,
+                 argon2_memory_kib: int = Config.ARGON2_MEMORY_KIB,
+                 argon2_parallelism: int = Config.ARGON2_PARALLELISM, workers: int = Config.PASSWORD_HASH_WORKERS):
+        self.scheme = scheme
+        self.target_ms = target_ms
+        self.bcrypt_rounds = bcrypt_rounds
+        self.argon2_time_cost = argon2_time_cost
+        self.argon2_memory_kib = argon2_memory_kib
+        self.argon2_parallelism = argon2_parallelism
+        self.workers = workers or os.cpu_count() or 1
+        self.context = self._build()
+        self.calibrated = False
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _build(self) -> CryptContext:
+        return build_context(
+            self.scheme, self.bcrypt_rounds, self.argon2_time_cost, self.argon2_memory_kib, self.argon2_parallelism
+        )
+
+    def settings(self) -> Dict[str, int]:
+        if self.scheme == "bcrypt":
+            return {"rounds": self.bcrypt_rounds}
+        return {
+            "time_cost": self.argon2_time_cost,
+            "memory_kib": self.argon2_memory_kib,
+            "parallelism": self.argon2_parallelism,
+        }
+
+    def calibrate(self) -> Dict[str, int]:
+        """
+        Raise the cost of the current scheme until a hash takes about
+        `target_ms`, measured from one hash at the floor cost. Blocking,
+        takes a few hundred milliseconds.
+        Returns:
+            the cost settings in use
+        """
+        if self.target_ms <= 0 or self.calibrated:
+            return self.settings()
+
+        target = self.target_ms / 1000
+        elapsed = time_hash(self.context)
+        if self.scheme == "bcrypt":
+            # every round doubles the work
+            extra = math.floor(math.log2(target / elapsed)) if elapsed < target else 0
+            self.bcrypt_rounds = min(BCRYPT_MAX_ROUNDS, self.bcrypt_rounds + extra)
+        else:
+            # the time cost is the number of passes over the memory
+            per_pass = elapsed / self.argon2_time_cost
+            self.argon2_time_cost = min(
+                ARGON2_MAX_TIME_COST, max(self.argon2_time_cost, math.floor(target / per_pass))
+            )
+
+        self.context = self._build()
+        self.calibrated = True
+        logging.info(
+            "password hashing calibrated to %s %s, %.0fms at the floor cost",
+            self.scheme, self.settings(), elapsed * 1000
+        )
+        return self.settings()
+
+    def _run(self, fn, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hash")
+        return asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.context.hash, password)
+
+    async def verify_and_update(self, password: str, hash: str) -> Tuple[bool, Optional[str]]:
+        """
+        Returns:
+            (password matches, a new hash to store when the old one is below the policy)
+        """
+        return await self._run(self.context.verify_and_update, password, hash)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+password_policy = PasswordPolicy()
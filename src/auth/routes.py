@@ -1,6 +1,9 @@
-from fastapi import APIRouter, status, Depends, BackgroundTasks
+from fastapi import APIRouter, status, Depends, Request
 from fastapi.responses import JSONResponse
 from datetime import datetime
+import logging
+import time
+import uuid
 from sqlmodel.ext.asyncio.session import AsyncSession
 from datetime import timedelta
 
@@ -15,6 +18,7 @@ from .schemas import (
 )
 from .utils import (
     create_access_token, 
+    user_claims,
     verify_password,
     create_url_safe_token,
     decode_url_safe_token,
@@ -36,30 +40,51 @@ from src.errors import (
 from .service import UserService
 from src.config import Config
 from src.db.main import get_session
-from src.db.redis import add_jti_to_blocklist
-from src.mail import mail, create_message
+from src.db.redis import (
+    add_jti_to_blocklist,
+    create_session,
+    end_all_sessions,
+    end_session,
+    get_deletion_progress,
+    get_token_version,
+    rotate_session
+)
+from src.mail import queue_email
+from src.mail_templates import email_templates, locale_from_header, queue_bulk_email
+from src.rate_limit import RateLimiter
+from src.responses import NegotiatedRoute, RawJSONResponse
+from .keys import keyring
 
 
-user_routes = APIRouter()
+user_routes = APIRouter(route_class=NegotiatedRoute)
+jwks_router = APIRouter()
 user_service = UserService()
 role_checker = RoleChecker(["admin", "user"])
 
 REFRESH_TOKEN_EXPIRY = 2
 
-async def send_email(recipients: list[str], subject: str, body: str):
-    """Send email asynchronously using background task"""
-    message = create_message(recipients, subject, body)
-    await mail.send_message(message)
-    print("Email sent")
+
+def create_refresh_token(claims: dict, session_id: str):
+    """
+    Returns:
+        (refresh token, its jti, its expiry as a unix timestamp)
+    """
+    jti = str(uuid.uuid4())
+    expiry = timedelta(days=REFRESH_TOKEN_EXPIRY)
+    token = create_access_token(
+        user_data=claims, expiry=expiry, refresh=True, session_id=session_id, jti=jti
+    )
+    return token, jti, int(time.time() + expiry.total_seconds())
 
 
 @user_routes.post(
         "/signup", 
-        status_code=status.HTTP_201_CREATED
+        status_code=status.HTTP_201_CREATED,
+        dependencies=[Depends(RateLimiter("signup", account_field="email"))]
     )
 async def create_user_account(
     user_data:UserCreateModel, 
-    background_task: BackgroundTasks,
+    request: Request,
     session:AsyncSession = Depends(get_session)
     ):
     """
@@ -74,20 +99,18 @@ async def create_user_account(
 
     if user_exists:
         raise UserAlreadyExists()
-    
-    new_user = await user_service.create_user(user_data, session)
 
     token = create_url_safe_token({"email": email})
 
     link = f"http://{Config.DOMAIN}/api/v1/auth/verify/{token}"
 
-    html_message = f"""
-    <h>Verify your email</h>
-    <p>Please clink the <a href="{link}">link</a> to verify your email.</p>
-    """
-    background_task.add_task(
-        send_email, [email], "Verify your Email", html_message
-        )
+    subject, html_message = email_templates.render(
+        "verify_email", locale_from_header(request.headers.get("accept-language")), link=link
+    )
+    # queued before create_user so the email is committed with the new user
+    queue_email(session, [email], subject, html_message)
+
+    new_user = await user_service.create_user(user_data, session)
 
     return {
         "message": "Account created, Check your Email to verify your account",
@@ -115,7 +138,7 @@ async def verify_user_account(token, session:AsyncSession = Depends(get_session)
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
     )
 
-@user_routes.post("/login")
+@user_routes.post("/login", dependencies=[Depends(RateLimiter("login", account_field="email"))])
 async def login(user_login: UserLoginModel, session: AsyncSession = Depends(get_session)):
     """
     Authenticate a user
@@ -129,16 +152,15 @@ async def login(user_login: UserLoginModel, session: AsyncSession = Depends(get_
     user = await user_service.get_user_by_email(email, session)
 
     if user is not None:
-        password_valid = verify_password(password, user.password_hash)
+        password_valid, new_hash = await verify_password(password, user.password_hash)
         if password_valid:
-            access_token = create_access_token(
-                user_data = {"email": user.email, "user_uid":str(user.uid)}
-            )
-            refresh_token = create_access_token(
-                user_data = {"email": user.email, "user_uid":str(user.uid)},
-                expiry=timedelta(days=REFRESH_TOKEN_EXPIRY),
-                refresh=True
-            )
+            if new_hash is not None:
+                await user_service.upgrade_password_hash(user, new_hash, session)
+            claims = user_claims(user, await get_token_version(str(user.uid), cached=False))
+            session_id = str(uuid.uuid4())
+            refresh_token, refresh_jti, expires_at = create_refresh_token(claims, session_id)
+            await create_session(str(user.uid), session_id, refresh_jti, expires_at)
+            access_token = create_access_token(user_data=claims, session_id=session_id)
 
             return JSONResponse(
                 content={
@@ -166,47 +188,94 @@ async def logout(token_details: dict = Depends(AccessTokenBearer())):
     Returns:
         Logout message
     """
-    jti = token_details["jti"]
-    await add_jti_to_blocklist(jti)
+    if "sid" in token_details:
+        await end_session(token_details["user"]["user_uid"], token_details["sid"])
+    else:
+        await add_jti_to_blocklist(token_details["jti"], token_details["exp"])
 
     return JSONResponse(
         content={"message": "Logged out Successfully",},
         status_code=status.HTTP_200_OK
             )
 
+@user_routes.get("/logout_all")
+async def logout_all(token_details: dict = Depends(AccessTokenBearer())):
+    """
+    Logout a user from every device
+    Args:
+        token_details: Token details for logout
+    Returns:
+        Logout message
+    """
+    await end_all_sessions(token_details["user"]["user_uid"])
+
+    return JSONResponse(
+        content={"message": "Logged out of all devices",},
+        status_code=status.HTTP_200_OK
+            )
+
 @user_routes.get("/refresh_token")
-async def get_new_access_token(token_details: dict = Depends(RefreshTokenBearer())):
+async def get_new_access_token(
+    token_details: dict = Depends(RefreshTokenBearer()),
+    session: AsyncSession = Depends(get_session)
+    ):
     """
-    Refresh the access token
+    Refresh the access token. The refresh token is rotated, the one sent
+    can not be used again.
     Args:
         token_details: payload of refresh token
     Returns:
-        Access token with additional data
+        Access token and the new refresh token
     """
     expiry_timestamp = token_details['exp']
     if datetime.fromtimestamp(expiry_timestamp) > datetime.now():
-        new_access_token = create_access_token(token_details['user'])
-        return JSONResponse(content={"access_token": new_access_token})
+        # claims are read again so that a verified account or a new role
+        # shows up in the new access token
+        user = await user_service.get_user_by_email(token_details['user']['email'], session)
+        if user is None:
+            raise InvalidToken()
+        user_uid = str(user.uid)
+        claims = user_claims(user, await get_token_version(user_uid, cached=False))
+
+        session_id = token_details.get("sid")
+        if session_id is None:
+            # issued before sessions existed, it gets one and is used up
+            session_id = str(uuid.uuid4())
+            refresh_token, refresh_jti, expires_at = create_refresh_token(claims, session_id)
+            await add_jti_to_blocklist(token_details["jti"], token_details["exp"])
+            await create_session(user_uid, session_id, refresh_jti, expires_at)
+        else:
+            refresh_token, refresh_jti, expires_at = create_refresh_token(claims, session_id)
+            outcome = await rotate_session(user_uid, session_id, token_details["jti"], refresh_jti, expires_at)
+            if outcome == "reused":
+                logging.warning("refresh token reused, session %s of user %s ended", session_id, user_uid)
+            if outcome != "rotated":
+                raise InvalidToken()
+
+        new_access_token = create_access_token(claims, session_id=session_id)
+        return JSONResponse(content={"access_token": new_access_token, "refresh_token": refresh_token})
     
     raise InvalidToken()
 
-@user_routes.post("/password-reset-request")
+@user_routes.post(
+        "/password-reset-request",
+        dependencies=[Depends(RateLimiter("password_reset", account_field="email"))]
+    )
 async def password_reset_request(
     emails: PasswordResetRequestModel, 
-    background_task: BackgroundTasks,
+    request: Request,
+    session: AsyncSession = Depends(get_session)
     ):
     """Password reset request"""
     email = emails.email
     token = create_url_safe_token({"email": email})
     link = f"http://{Config.DOMAIN}/api/v1/auth/password-reset-confirm/{token}"
-    html_message = f"""
-    <h>Reset Password</h>
-    <p>Please click the <a href="{link}">link</a> to reset your password.</p>
-    """
+    subject, html_message = email_templates.render(
+        "password_reset", locale_from_header(request.headers.get("accept-language")), link=link
+    )
 
-    background_task.add_task(
-        send_email, [email], "Password Reset Request", html_message
-        )
+    queue_email(session, [email], subject, html_message)
+    await session.commit()
     
     return JSONResponse(
         content={"message": "Please check your email regarding password reset"},
@@ -232,8 +301,8 @@ async def password_reset_confirmation(
     if user_email:
         user = await user_service.get_user_by_email(user_email, session)
         if user is not None:
-            hash_password = get_hashed_password(new_password)
-            user_service.update_user(user, {"password_hash": hash_password}, session)
+            hash_password = await get_hashed_password(new_password)
+            await user_service.update_user(user, {"password_hash": hash_password}, session)
 
             return JSONResponse(
                 content={"message": "Password reset successful"},
@@ -245,28 +314,58 @@ async def password_reset_confirmation(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
         ) 
 
-@user_routes.post("/send_mail")
-async def send_mail(emails: EmailModel, background_task: BackgroundTasks):
+@user_routes.post("/send_mail", dependencies=[Depends(RateLimiter("send_mail"))])
+async def send_mail(
+    emails: EmailModel,
+    request: Request,
+    session: AsyncSession = Depends(get_session)
+    ):
     """Send an email to a user"""
 
-    emails = emails.addresses
-    html = "<h>Welcome to the app.</h>"
-    subject = "Welcome to our App"
-
-
-    background_task.add_task(send_email, emails, subject, html)
+    await queue_bulk_email(
+        session,
+        emails.addresses,
+        "welcome",
+        locale_from_header(request.headers.get("accept-language"))
+    )
+    await session.commit()
 
     return {"message": "Email sent successfully"}
 
-@user_routes.delete("/delete_me", status_code=status.HTTP_204_NO_CONTENT)
+@user_routes.delete("/delete_me", status_code=status.HTTP_202_ACCEPTED)
 async def delete_user(
-    user = Depends(get_current_user),_: bool = Depends(role_checker), session:AsyncSession = Depends(get_session)
+    token_details: dict = Depends(AccessTokenBearer()),
+    _: bool = Depends(role_checker),
+    session:AsyncSession = Depends(get_session)
     ):
-    """Deletes a user"""
-    email = user.email
-    print("delete info")
-    print(user)
-    if email is None:
+    """
+    Delete the account of the current user. The account is closed at once,
+    its books and reviews are removed in the background.
+    """
+    user_uid = token_details["user"]["user_uid"]
+    await user_service.delete_user(user_uid, session)
+    try:
+        # the worker module builds the Celery app, only needed once an account is deleted
+        from src.worker import delete_accounts, submit
+
+        await submit(delete_accounts)
+    except Exception:
+        # the scheduled run picks the account up
+        logging.exception("queueing the deletion of account %s failed", user_uid)
+    return {"message": "Account deletion started", "user_uid": user_uid}
+
+@user_routes.get("/deletions/{user_uid}", dependencies=[Depends(RoleChecker(["admin"]))])
+async def account_deletion_progress(user_uid: str):
+    """
+    Progress of an account deletion: status (pending, running, done), the
+    current step and the rows handled per step
+    """
+    progress = await get_deletion_progress(user_uid)
+    if not progress:
         raise UserNotFound()
-    await user_service.delete_user(email, session)
-    return {}
\ No newline at end of file
+    return progress
+
+@jwks_router.get("/.well-known/jwks.json", include_in_schema=False)
+async def jwks():
+    """Public keys verifying our access tokens, for other services"""
+    return RawJSONResponse(keyring.jwks, headers={"Cache-Control": "public, max-age=300"})
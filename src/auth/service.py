@@ -1,10 +1,18 @@
+from datetime import datetime
+
 from pydantic import Field
+from sqlalchemy import update
 from sqlmodel.ext.asyncio.session import AsyncSession
 from sqlmodel import select
 from src.db.models import User
+from src.db.redis import end_all_sessions, record_deletion_progress
 from .schemas import UserCreateModel
 from .utils import get_hashed_password
 
+# changing these logs the user out of every device
+SESSION_ENDING_FIELDS = ("role", "password_hash")
+
+
 class UserService:
     async def get_user_by_email(self, email, session: AsyncSession):
         """
@@ -14,11 +22,21 @@ class UserService:
             session(AsyncSession): sqlmodel async session
         Returns:
             User object if found, otherwise None"""
-        statement = select(User).where(User.email == email)
+        statement = select(User).where(User.email == email, User.deleted_at.is_(None))
         result = await session.exec(statement)
         user = result.first()
         return user 
     
+    async def get_usernames(self, user_uids: list, session: AsyncSession):
+        """
+        Usernames of several users in one query, deleted accounts left out
+        Returns:
+            Dict of user uid to username
+        """
+        statement = select(User.uid, User.username).where(User.uid.in_(user_uids), User.deleted_at.is_(None))
+        result = await session.exec(statement)
+        return {row.uid: row.username for row in result.all()}
+
     async def user_exists(self, email, session: AsyncSession):
         """
         Implement this method to check if a user with the given email already exists in the database
@@ -40,7 +58,7 @@ class UserService:
             User object if created successfully, otherwise None"""
         user_data_dict = user_data.model_dump()
         new_user = User(**user_data_dict)
-        new_user.password_hash = get_hashed_password(user_data_dict['password'])
+        new_user.password_hash = await get_hashed_password(user_data_dict['password'])
         new_user.role = "user"
 
         session.add(new_user)
@@ -61,21 +79,45 @@ class UserService:
 
         await session.commit()
 
+        if any(field in user_update_data for field in SESSION_ENDING_FIELDS):
+            await end_all_sessions(str(user.uid))
+
         return user
     
-    async def delete_user(self, email, session: AsyncSession):
+    async def upgrade_password_hash(self, user, password_hash: str, session: AsyncSession):
         """
-        Implement this method to update user details in the database
+        Store a rehash of the same password, made under a stronger hashing
+        policy. Unlike a password change it keeps the sessions of the user.
         Args:
             session(AsyncSession): sqlmodel async session
-            user_data_dict(dict): User data to be updated
+            password_hash(str): new hash of the current password
         Returns:
             Updated User object"""
-        
-        user_to_delete = await self.get_user_by_email(email, session)
-        if user_to_delete is not None:
-            await session.delete(user_to_delete)
-            await session.commit()
-            return {}
-        else:
-            return None
+        user.password_hash = password_hash
+        await session.commit()
+
+        return user
+
+    async def delete_user(self, user_uid, session: AsyncSession):
+        """
+        Mark a user deleted, its data is removed in the background by
+        src/account_deletion.py. Marking an already marked user does nothing.
+        Args:
+            user_uid(str): uid of the user
+            session(AsyncSession): sqlmodel async session
+        Returns:
+            True if the user was marked by this call, otherwise False"""
+        result = await session.execute(
+            update(User)
+            .where(User.uid == user_uid, User.deleted_at.is_(None))
+            .values(deleted_at=datetime.now())
+        )
+        await session.commit()
+        await end_all_sessions(str(user_uid))
+        if result.rowcount == 0:
+            return False
+
+        await record_deletion_progress(
+            str(user_uid), {"status": "pending", "requested_at": datetime.now().isoformat()}
+        )
+        return True
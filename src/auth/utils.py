@@ -1,15 +1,14 @@
-from passlib.context import CryptContext
 from fastapi import HTTPException
 import jwt
 import uuid
+from typing import Optional, Tuple
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from src.config import Config
+from src.auth.keys import keyring
+from src.auth.passwords import password_policy
 from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadSignature
 
-pass_context = CryptContext(
-    schemes=["bcrypt"]
-)
 
 serializer = URLSafeTimedSerializer(
     secret_key=Config.JWT_SECRET,
@@ -19,51 +18,65 @@ serializer = URLSafeTimedSerializer(
 access_token_time = 3600  # 1 hour
 
 
-def get_hashed_password(password: str) -> str:
+async def get_hashed_password(password: str) -> str:
     """
-    Generate a hashed password using bcrypt.
+    Hash a password with the current hashing policy, see src/auth/passwords.py
     """
-    hash = pass_context.hash(password)
-    return hash
+    return await password_policy.hash(password)
 
-def verify_password(password: str, hash: str) -> bool:
+async def verify_password(password: str, hash: str) -> Tuple[bool, Optional[str]]:
     """
-    Verify a password using bcrypt.
-    Returns True if the password matches the hashed password, False otherwise.
+    Verify a password against its hash.
+    Returns (True if the password matches, a new hash to store when the
+    stored one is weaker than the current policy or None).
     """
-    return pass_context.verify(password, hash)
+    return await password_policy.verify_and_update(password, hash)
 
 
-def create_access_token(user_data, expiry: timedelta = None, refresh: bool = False) -> str:
+def create_access_token(user_data, expiry: timedelta = None, refresh: bool = False,
+                        session_id: str = None, jti: str = None) -> str:
     """
     Create a JWT token for the user
+    Args:
+        session_id: login session the token belongs to, see `create_session`
+        jti: token id, a random one when not given
     """
     payload = {
         "user": user_data,
-        "exp": datetime.now() + (expiry if expiry is not None else timedelta(seconds=access_token_time)),
-        "jti": str(uuid.uuid4()),
+        "exp": datetime.now(timezone.utc) + (expiry if expiry is not None else timedelta(seconds=access_token_time)),
+        "jti": jti or str(uuid.uuid4()),
         "refresh": refresh
     }
+    if session_id is not None:
+        payload["sid"] = session_id
 
-    token = jwt.encode(
-        payload=payload,
-        key=Config.JWT_SECRET,
-        algorithm=Config.JWT_ALGORITHM
-    )
+    token = keyring.sign(payload)
 
     return token
 
 
+def user_claims(user, token_version: int) -> dict:
+    """
+    Claims identifying the user and what it is allowed to do, so that
+    authorization does not need to load the user.
+    `pv` is the token version of the user when the token was issued, tokens
+    with an older version are rejected (see `bump_token_version`).
+    """
+    return {
+        "email": user.email,
+        "user_uid": str(user.uid),
+        "role": user.role,
+        "verified": user.is_verified,
+        "pv": token_version,
+    }
+
+
 def decode_token(token: str) -> dict:
     """
     Decode a JWT token and return its payload
     """
     try:
-        token_data = jwt.decode(
-            jwt=token,
-            key=Config.JWT_SECRET,
-            algorithms=[Config.JWT_ALGORITHM]
-            )
+        token_data = keyring.verify(token)
         return token_data
     except jwt.PyJWTError as jwte:
         logging.exception(jwte)
@@ -0,0 +1,298 @@
+import asyncio
+import re
+import unicodedata
+import zlib
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src.config import Config
+from src.db.models import Book
+
+_EMPTY = 1 << 32
+_SHINGLE_SIZE = 3
+_NON_WORD = re.compile(r"[^\w\s]")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize(title: str, author: str, publisher: str) -> str:
+    """
+    Normalize the identifying fields of a book so that trivial differences
+    (case, accents, punctuation, extra spaces) do not change the shingles.
+    """
+    text = " ".join((title or "", author or "", publisher or ""))
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = _NON_WORD.sub(" ", text.lower())
+    return _SPACES.sub(" ", text).strip()
+
+
+def shingles(text: str) -> set:
+    """
+    Character shingles of the normalized text hashed to 32 bit integers
+    """
+    if len(text) <= _SHINGLE_SIZE:
+        return {zlib.crc32(text.encode())}
+    return {
+        zlib.crc32(text[i:i + _SHINGLE_SIZE].encode())
+        for i in range(len(text) - _SHINGLE_SIZE + 1)
+    }
+
+
+class MinHashLSH:
+    """
+    In memory near-duplicate index using MinHash signatures and LSH banding.
+
+    Signatures use one permutation hashing: every shingle hash falls in one of
+    `bands * rows` bins and each bin keeps its minimum, so building a signature
+    costs one pass over the shingles instead of one pass per permutation.
+    Empty bins borrow the value of the next non empty bin (rotation
+    densification) so short strings still give full signatures.
+
+    Two documents become candidates when every row of at least one band is
+    equal, which happens with high probability once their Jaccard similarity
+    goes above roughly (1 / bands) ** (1 / rows). Candidates are then confirmed with the
+    similarity estimated from the full signatures.
+    """
+    def __init__(self, bands: int = 8, rows: int = 4, threshold: float = 0.8):
+        self.bands = bands
+        self.rows = rows
+        self.threshold = threshold
+        self.size = bands * rows
+        self._buckets: List[Dict[Tuple[int, ...], set]] = [defaultdict(set) for _ in range(bands)]
+        self._signatures: Dict[str, Tuple[int, ...]] = {}
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._signatures
+
+    def signature(self, text: str) -> Tuple[int, ...]:
+        """
+        MinHash signature of the normalized text
+        """
+        size = self.size
+        bins = [_EMPTY] * size
+        for h in shingles(text):
+            index = h % size
+            value = h // size
+            if value < bins[index]:
+                bins[index] = value
+
+        for index in range(size):
+            if bins[index] == _EMPTY:
+                for offset in range(1, size):
+                    value = bins[(index + offset) % size]
+                    if value != _EMPTY:
+                        bins[index] = value + offset * _EMPTY
+                        break
+        return tuple(bins)
+
+    def _bands(self, signature: Tuple[int, ...]) -> Iterable[Tuple[int, Tuple[int, ...]]]:
+        rows = self.rows
+        for band in range(self.bands):
+            yield band, signature[band * rows:(band + 1) * rows]
+
+    def similarity(self, sig_a: Tuple[int, ...], sig_b: Tuple[int, ...]) -> float:
+        """
+        Estimated Jaccard similarity of two signatures
+        """
+        return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / len(sig_a)
+
+    def insert(self, key: str, signature: Tuple[int, ...]) -> None:
+        if key in self._signatures:
+            self.remove(key)
+        self._signatures[key] = signature
+        for band, value in self._bands(signature):
+            self._buckets[band][value].add(key)
+
+    def remove(self, key: str) -> None:
+        signature = self._signatures.pop(key, None)
+        if signature is None:
+            return
+        for band, value in self._bands(signature):
+            bucket = self._buckets[band].get(value)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band][value]
+
+    def query(self, signature: Tuple[int, ...]) -> List[Tuple[str, float]]:
+        """
+        Keys whose estimated similarity with the signature is above the
+        threshold, most similar first.
+        """
+        candidates = set()
+        for band, value in self._bands(signature):
+            bucket = self._buckets[band].get(value)
+            if bucket:
+                candidates.update(bucket)
+
+        matches = []
+        for key in candidates:
+            score = self.similarity(signature, self._signatures[key])
+            if score >= self.threshold:
+                matches.append((key, score))
+        matches.sort(key=lambda match: match[1], reverse=True)
+        return matches
+
+
+class BookDedupIndex:
+    """
+    Near-duplicate index of the books of this worker.
+
+    The index is built from the database on first use and then kept up to date
+    by `BookService`. Books created through another worker are only picked up
+    when the index is rebuilt, so the batch job in `find_duplicate_clusters`
+    remains the source of truth for merging.
+
+    Near duplicates are only similar: the volumes of a series differ by a
+    number. Exact duplicates, the same normalized title, author and
+    publisher, are told apart with the normalized text kept per book.
+    """
+    def __init__(self):
+        self.lsh = MinHashLSH(
+            bands=Config.BOOK_DEDUP_BANDS,
+            rows=Config.BOOK_DEDUP_ROWS,
+            threshold=Config.BOOK_DEDUP_THRESHOLD
+        )
+        self._texts: Dict[str, str] = {}
+        self._loaded = False
+        self._lock = asyncio.Lock()
+
+    def book_signature(self, book) -> Tuple[int, ...]:
+        return self.lsh.signature(normalize(book.title, book.author, book.publisher))
+
+    async def ensure_loaded(self, session: AsyncSession) -> None:
+        """
+        Load the signatures of all the existing books once per worker
+        """
+        if self._loaded:
+            return
+        async with self._lock:
+            if self._loaded:
+                return
+            statement = select(Book.uid, Book.title, Book.author, Book.publisher).where(Book.deleted_at.is_(None))
+            result = await session.exec(statement)
+            for row in result.all():
+                self.add(row)
+            self._loaded = True
+
+    def find_duplicates(self, book_data) -> List[Tuple[str, float]]:
+        """
+        Find the books that are near duplicates of the given book data
+
+        Args:
+            book_data: anything with title, author and publisher attributes
+        Returns:
+            List of (book uid, similarity) tuples, most similar first
+        """
+        return self.lsh.query(self.book_signature(book_data))
+
+    def find_exact_duplicates(self, book_data) -> List[str]:
+        """
+        Find the books with the same normalized title, author and publisher
+
+        Returns:
+            List of book uids
+        """
+        text = normalize(book_data.title, book_data.author, book_data.publisher)
+        return [key for key, _ in self.lsh.query(self.lsh.signature(text)) if self._texts.get(key) == text]
+
+    def add(self, book) -> None:
+        text = normalize(book.title, book.author, book.publisher)
+        self._texts[str(book.uid)] = text
+        self.lsh.insert(str(book.uid), self.lsh.signature(text))
+
+    def discard(self, book_uid) -> None:
+        self._texts.pop(str(book_uid), None)
+        self.lsh.remove(str(book_uid))
+
+
+book_dedup_index = BookDedupIndex()
+
+
+async def find_duplicate_clusters(session: AsyncSession, batch_size: int = 1000) -> List[List[str]]:
+    """
+    Cluster all the existing books into groups of near duplicates.
+
+    Books are streamed from the database in batches and put into a fresh index.
+    Each book is linked with the matches already in the index, and the linked
+    components form the clusters that can be merged.
+
+    Args:
+        session(AsyncSession): sqlmodel async session
+        batch_size(int): number of rows fetched at a time
+    Returns:
+        List of clusters, each a list of book uids ordered by creation
+    """
+    lsh = MinHashLSH(
+        bands=Config.BOOK_DEDUP_BANDS,
+        rows=Config.BOOK_DEDUP_ROWS,
+        threshold=Config.BOOK_DEDUP_THRESHOLD
+    )
+    parent: Dict[str, str] = {}
+    order: Dict[str, int] = {}
+
+    def find(key: str) -> str:
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    def union(a: str, b: str) -> None:
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            if order[root_a] > order[root_b]:
+                root_a, root_b = root_b, root_a
+            parent[root_b] = root_a
+
+    statement = (
+        select(Book.uid, Book.title, Book.author, Book.publisher)
+        .where(Book.deleted_at.is_(None))
+        .order_by(Book.created_at)
+        .execution_options(yield_per=batch_size)
+    )
+    result = await session.stream(statement)
+    async for row in result:
+        key = str(row.uid)
+        signature = lsh.signature(normalize(row.title, row.author, row.publisher))
+        parent[key] = key
+        order[key] = len(order)
+        for match, _ in lsh.query(signature):
+            union(key, match)
+        lsh.insert(key, signature)
+
+    clusters: Dict[str, List[str]] = defaultdict(list)
+    for key in order:
+        clusters[find(key)].append(key)
+
+    return [members for members in clusters.values() if len(members) > 1]
+
+
+async def main(output: Optional[str] = None) -> None:
+    """
+    Run the clustering job and print or write the clusters as json
+    """
+    import json
+    from src.db.main import engine
+
+    async with AsyncSession(engine) as session:
+        clusters = await find_duplicate_clusters(session)
+
+    content = json.dumps(clusters, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(content)
+    else:
+        print(content)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    import sys
+
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else None))
@@ -1,17 +1,24 @@
-from fastapi import APIRouter, status, Depends
-from typing import List
+from fastapi import APIRouter, status, Depends, Header
+from typing import List, Optional
+from sqlmodel import desc
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from src.books.service import BookService
-from src.db.main import get_session
+from src.config import Config
+from src.db.main import engine, get_session
 from src.books.schema import BookUpdateModel, BookCreateModel, BookDetailModel
 from src.auth.dependencies import AccessTokenBearer
 from src.auth.dependencies import RoleChecker
+from src.db.models import Book
 from src.errors import BookNotFound
+from src.responses import EventStreamResponse, NegotiatedRoute, rows_response, sqlmodel_response
+from src.reviews.service import ReviewService
+from src.reviews.stream import parse_event_id, review_broadcaster, review_stream
 
 
-books_route = APIRouter()
+books_route = APIRouter(route_class=NegotiatedRoute)
 book_service = BookService()
+review_service = ReviewService()
 access_token_bearer = AccessTokenBearer()
 role_checker = Depends(RoleChecker(["admin", "user"]))
 
@@ -20,8 +27,8 @@ role_checker = Depends(RoleChecker(["admin", "user"]))
 async def get_books(session: AsyncSession = Depends(get_session), token_details = Depends(access_token_bearer)):
     """
     Retrive all the books"""
-    books = await book_service.get_all_books(session)
-    return books
+    books = await book_service.get_book_rows(session)
+    return rows_response(books)
 
 @books_route.get(
     "/user/{user_uid}", response_model=List[BookDetailModel], dependencies=[role_checker]
@@ -31,20 +38,25 @@ async def get_user_book_submissions(
     session: AsyncSession = Depends(get_session),
     _: dict = Depends(access_token_bearer),
 ):
-    books = await book_service.get_user_books(session, user_uid)
-    return books
+    books = await book_service.get_book_rows(
+        session, Book.user_uid == user_uid, order_by=desc(Book.created_at)
+    )
+    return rows_response(books)
 
 @books_route.post('/', status_code=status.HTTP_201_CREATED, dependencies=[role_checker])
 async def create_book(
     book_data: BookCreateModel, 
+    force: bool = False,
     session: AsyncSession = Depends(get_session), 
     token_details = Depends(access_token_bearer)
     ) -> dict:
     """
-    Create a new book"""
+    Create a new book. When similar books exist (another volume of a series,
+    a typo) their uids are returned with a 409, send again with force=true to
+    create it anyway. The same book is always refused."""
     user_uid = token_details.get("user")["user_uid"]
-    new_book = await book_service.create_book(session, book_data, user_uid)
-    return new_book.model_dump()
+    new_book = await book_service.create_book(session, book_data, user_uid, force)
+    return sqlmodel_response(new_book, status_code=status.HTTP_201_CREATED)
 
 
 @books_route.get('/{book_id}', status_code=status.HTTP_200_OK, dependencies=[role_checker])
@@ -57,11 +69,43 @@ async def get_book_by_id(
     Retrieve a book by ID"""
     book = await book_service.get_book_by_id(session, book_id)
     if book:
-        return book.model_dump()
+        return sqlmodel_response(book)
     else:
         raise BookNotFound()
 
 
+@books_route.get('/{book_id}/reviews/stream', dependencies=[role_checker])
+async def stream_book_reviews(
+    book_id: str,
+    last_event_id: Optional[str] = Header(None),
+    token_details = Depends(access_token_bearer)
+    ):
+    """
+    New reviews of a book as Server-Sent Events. Reconnecting with the
+    Last-Event-ID header replays the reviews missed meanwhile"""
+    since = parse_event_id(last_event_id) if last_event_id else None
+    queue = await review_broadcaster.subscribe(book_id)
+    try:
+        # a session of its own, released before the stream starts
+        async with AsyncSession(engine) as session:
+            if not await book_service.book_exists(session, book_id):
+                raise BookNotFound()
+            missed = []
+            if since is not None:
+                missed = await review_service.get_book_review_rows_since(
+                    book_id, since, Config.SSE_RESUME_LIMIT + 1, session
+                )
+    except BaseException:
+        review_broadcaster.unsubscribe(book_id, queue)
+        raise
+
+    reset = len(missed) > Config.SSE_RESUME_LIMIT
+    return EventStreamResponse(
+        review_stream(queue, [] if reset else missed, reset),
+        on_close=lambda: review_broadcaster.unsubscribe(book_id, queue),
+    )
+
+
 @books_route.patch('/{book_id}', dependencies=[role_checker])
 async def update_book(
     book_id: str, 
@@ -73,7 +117,7 @@ async def update_book(
     Update a book by ID"""
     updated_book = await book_service.update_book(session, book_id, book_update_data)
     if updated_book is not None:
-        return updated_book.model_dump()
+        return sqlmodel_response(updated_book)
     else:
         raise BookNotFound()
 
@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter
 import uuid
 from typing import List
 from src.reviews.schemas import ReviewModel
@@ -31,4 +31,8 @@ class BookUpdateModel(BaseModel):
     author: str
     publisher: str
     page_count: int
-    language: str
\ No newline at end of file
+    language: str
+
+
+book_adapter = TypeAdapter(Book)
+book_detail_list_adapter = TypeAdapter(List[BookDetailModel])
@@ -1,9 +1,23 @@
 from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import tuple_, update
 from sqlmodel import select, desc
 from datetime import datetime
 from fastapi import status
 from src.books.schema import BookCreateModel
-from src.db.models import Book
+from src.books.dedup import book_dedup_index
+from src.config import Config
+from src.db.models import Book, Review
+from src.errors import BookAlreadyExists, SimilarBookExists
+
+BOOK_COLUMNS = (
+    Book.uid, Book.title, Book.author, Book.publisher,
+    Book.published_date, Book.page_count, Book.language
+)
+REVIEW_COLUMNS = (
+    Review.uid, Review.rating, Review.review_text,
+    Review.user_uid, Review.book_uid, Review.created_at
+)
+
 
 class BookService:
     """
@@ -17,22 +31,87 @@ class BookService:
         Returns:
             List of all books
         """
-        statement = select(Book).order_by(Book.created_at)
+        statement = select(Book).where(Book.deleted_at.is_(None)).order_by(Book.created_at)
         result = await session.exec(statement)
 
         return result.all()
     
+    async def get_book_rows(self, session: AsyncSession, *where, order_by=None):
+        """
+        Get books with their reviews as plain dicts, shaped like BookDetailModel.
+
+        Only the needed columns are selected and the reviews of all the books
+        come from one extra query, so no ORM object is hydrated and no
+        relationship is loaded. Deleted books and reviews are left out.
+
+        Args:
+            session(AsyncSession): sqlmodel async session
+            where: filters on the books
+            order_by: order of the books, oldest first by default
+        Returns:
+            List of book dicts, each with a `reviews` list
+        """
+        where = (Book.deleted_at.is_(None), *where)
+        statement = select(*BOOK_COLUMNS).where(*where).order_by(
+            order_by if order_by is not None else Book.created_at
+        )
+        result = await session.exec(statement)
+        books = [row._asdict() for row in result.all()]
+        if not books:
+            return books
+
+        reviews = {}
+        for book in books:
+            book["reviews"] = reviews[book["uid"]] = []
+
+        statement = (
+            select(*REVIEW_COLUMNS)
+            .where(Review.book_uid.in_(select(Book.uid).where(*where)), Review.deleted_at.is_(None))
+            .order_by(Review.created_at)
+        )
+        result = await session.exec(statement)
+        for row in result.all():
+            book_reviews = reviews.get(row.book_uid)
+            if book_reviews is not None:
+                book_reviews.append(row._asdict())
+        return books
+
+    async def get_book_page_rows(self, session: AsyncSession, *where, limit: int, after=None):
+        """
+        A page of books as plain dicts without their reviews, oldest first
+
+        Args:
+            session(AsyncSession): sqlmodel async session
+            where: filters on the books
+            limit(int): size of the page
+            after: (created_at, uid) of the last book of the previous page
+        Returns:
+            List of book dicts, with created_at for the next cursor
+        """
+        where = (Book.deleted_at.is_(None), *where)
+        if after is not None:
+            where = (*where, tuple_(Book.created_at, Book.uid) > tuple(after))
+        statement = (
+            select(*BOOK_COLUMNS, Book.user_uid, Book.created_at)
+            .where(*where)
+            .order_by(Book.created_at, Book.uid)
+            .limit(limit)
+        )
+        result = await session.exec(statement)
+        return [row._asdict() for row in result.all()]
+
     async def get_user_books(self, session: AsyncSession, user_uid: str):
         statement = (
             select(Book) 
-            .where(Book.user_uid == user_uid) 
+            .where(Book.user_uid == user_uid, Book.deleted_at.is_(None)) 
             .order_by(desc(Book.created_at))
         )
         result = await session.exec(statement)
 
         return result.all()
 
-    async def create_book(self, session: AsyncSession, book_data: BookCreateModel, user_uid: str):
+    async def create_book(self, session: AsyncSession, book_data: BookCreateModel, user_uid: str,
+                          force: bool = False):
         """
         Create a new book
         
@@ -40,17 +119,43 @@ class BookService:
             session(AsyncSession): sqlmodel async session
             book_data: Book data to create
             user_uid(str): Id of the user who created the book
+            force(bool): create it even though similar books exist
         Returns:
             Create a new book and return it
+        Raises:
+            BookAlreadyExists: if the same book already exists
+            SimilarBookExists: if near duplicates of the book exist and `force` is not set
         """
+        if Config.BOOK_DEDUP_ENABLED:
+            await book_dedup_index.ensure_loaded(session)
+            if book_dedup_index.find_exact_duplicates(book_data):
+                raise BookAlreadyExists()
+            if not force:
+                similar = book_dedup_index.find_duplicates(book_data)
+                if similar:
+                    raise SimilarBookExists([uid for uid, _ in similar])
+
         book_data_dict = book_data.model_dump()
         new_book = Book(**book_data_dict)
         new_book.user_uid = user_uid
         # new_book.published_date = datetime.strptime(book_data_dict['published_date'],"%Y-%m-%d")
         session.add(new_book)
         await session.commit()
+        book_dedup_index.add(new_book)
         return new_book
         
+    async def book_exists(self, session: AsyncSession, book_uid: str) -> bool:
+        """
+        Whether a book exists, without loading its reviews and tags
+
+        Args:
+            session(AsyncSession): sqlmodel async session
+            book_uid(str): Id of the book
+        """
+        statement = select(Book.uid).where(Book.uid == book_uid, Book.deleted_at.is_(None))
+        result = await session.exec(statement)
+        return result.first() is not None
+
     async def get_book_by_id(self, session: AsyncSession, book_uid: str):
         """
         Retrieve a book by ID
@@ -61,7 +166,7 @@ class BookService:
         Returns:
             Book: a Book object 
         """
-        statement = select(Book).where(Book.uid == book_uid)
+        statement = select(Book).where(Book.uid == book_uid, Book.deleted_at.is_(None))
         result = await session.exec(statement)
         book = result.first()
         return book if book is not None else None
@@ -84,21 +189,32 @@ class BookService:
                 setattr(book_to_update, k, v)
             
             await session.commit()
+            book_dedup_index.add(book_to_update)
             return book_to_update
         else:
             return None
         
     async def delete_book(self, session: AsyncSession, book_uid: str):
         """
-        Delete a book by ID
+        Soft delete a book by ID, with its reviews
         Args:
             session(AsyncSession): sqlmodel async session
             book_uid(str): Id of the book
         """
-        book_to_delete = await self.get_book_by_id(session, book_uid)
-        if book_to_delete is not None:
-            await session.delete(book_to_delete)
+        now = datetime.now()
+        result = await session.execute(
+            update(Book)
+            .where(Book.uid == book_uid, Book.deleted_at.is_(None))
+            .values(deleted_at=now)
+        )
+        if result.rowcount:
+            await session.execute(
+                update(Review)
+                .where(Review.book_uid == book_uid, Review.deleted_at.is_(None))
+                .values(deleted_at=now)
+            )
             await session.commit()
+            book_dedup_index.discard(book_uid)
             return {}
         else:
             return None
@@ -0,0 +1,218 @@
+"""
+Response compression.
+
+Responses of at least COMPRESSION_MIN_SIZE bytes are compressed with the best
+encoding the client accepts among zstd, br and gzip. brotli and zstandard are
+optional, without them only gzip is offered.
+
+Bodies of COMPRESSION_THREAD_SIZE bytes or more are compressed in a worker
+thread so a large list does not stall the event loop. Compressed bodies are
+kept in an LRU keyed by the digest of the uncompressed body and the encoding,
+so a hot response that does not change between requests (the first page of
+`GET /books/` for instance) is compressed once and then only hashed. The LRU
+holds at most COMPRESSION_CACHE_BYTES of compressed bytes, and a body is only
+kept the second time it is seen: one-off responses do not evict the hot ones.
+
+Streaming responses (server-sent events, anything sent in several chunks)
+are passed through untouched.
+"""
+import asyncio
+import gzip
+import hashlib
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from src.config import Config
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def _gzip(body: bytes) -> bytes:
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+
+def _brotli(body: bytes) -> bytes:
+    return brotli.compress(body, quality=4)
+
+
+def _zstd(body: bytes) -> bytes:
+    return zstandard.ZstdCompressor(level=3).compress(body)
+
+
+# in order of preference when the client accepts several with the same q-value
+COMPRESSORS: Dict[str, Callable[[bytes], bytes]] = {}
+if zstandard is not None:
+    COMPRESSORS["zstd"] = _zstd
+if brotli is not None:
+    COMPRESSORS["br"] = _brotli
+COMPRESSORS["gzip"] = _gzip
+
+COMPRESSIBLE_TYPES = (
+    "application/json",
+    "application/msgpack",
+    "application/xml",
+    "application/javascript",
+    "image/svg+xml",
+)
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    Pick the encoding to use from an Accept-Encoding header
+    Returns:
+        one of COMPRESSORS keys, None when the client accepts none of them
+    """
+    if not accept_encoding:
+        return None
+    qualities: Dict[str, float] = {}
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.strip().lower()] = quality
+
+    wildcard = qualities.get("*", 0.0)
+    best, best_quality = None, 0.0
+    for name in COMPRESSORS:
+        quality = qualities.get(name, wildcard)
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+
+def is_compressible(content_type: str) -> bool:
+    content_type = content_type.split(";")[0].strip().lower()
+    if content_type == "text/event-stream":
+        return False
+    return content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+
+
+class CompressedBodyCache:
+    """
+    LRU of compressed bodies keyed by (digest of the body, encoding), bounded
+    by the total size of the compressed bodies. A key is only stored on its
+    second put, the first one is remembered in a bounded LRU of seen keys.
+    """
+    def __init__(self, max_bytes: int, max_body: int, max_seen: int):
+        self.max_bytes = max_bytes
+        self.max_body = max_body
+        self.max_seen = max_seen
+        self.bytes = 0
+        self._entries: "OrderedDict[Tuple[bytes, str], bytes]" = OrderedDict()
+        self._seen: "OrderedDict[Tuple[bytes, str], None]" = OrderedDict()
+
+    def get(self, key: Tuple[bytes, str]) -> Optional[bytes]:
+        compressed = self._entries.get(key)
+        if compressed is not None:
+            self._entries.move_to_end(key)
+        return compressed
+
+    def put(self, key: Tuple[bytes, str], compressed: bytes) -> None:
+        if len(compressed) > min(self.max_body, self.max_bytes) or key in self._entries:
+            return
+        if key not in self._seen:
+            self._seen[key] = None
+            if len(self._seen) > self.max_seen:
+                self._seen.popitem(last=False)
+            return
+        del self._seen[key]
+        self._entries[key] = compressed
+        self.bytes += len(compressed)
+        while self.bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= len(evicted)
+
+
+compressed_bodies = CompressedBodyCache(
+    Config.COMPRESSION_CACHE_BYTES, Config.COMPRESSION_CACHE_MAX_BODY, Config.COMPRESSION_CACHE_SEEN
+)
+
+
+async def compress(body: bytes, encoding: str) -> bytes:
+    """
+    Compress a body, reusing the compressed bytes of an identical body
+    """
+    key = (hashlib.blake2b(body, digest_size=16).digest(), encoding)
+    compressed = compressed_bodies.get(key)
+    if compressed is not None:
+        return compressed
+
+    compressor = COMPRESSORS[encoding]
+    if len(body) >= Config.COMPRESSION_THREAD_SIZE:
+        compressed = await asyncio.to_thread(compressor, body)
+    else:
+        compressed = compressor(body)
+    compressed_bodies.put(key, compressed)
+    return compressed
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing complete responses above the size threshold
+    """
+    def __init__(self, app: ASGIApp, minimum_size: int = Config.COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Optional[Message] = None
+        passthrough = False
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start, passthrough
+            if passthrough or message["type"] not in ("http.response.start", "http.response.body"):
+                await send(message)
+                return
+
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                if "content-encoding" in headers or not is_compressible(headers.get("content-type", "")):
+                    passthrough = True
+                    await send(message)
+                else:
+                    start = message
+                return
+
+            if message.get("more_body", False):
+                # streaming response, sent as it comes
+                passthrough = True
+                await send(start)
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            headers = MutableHeaders(raw=start["headers"])
+            if len(body) >= self.minimum_size:
+                body = await compress(body, encoding)
+                headers["Content-Encoding"] = encoding
+                headers["Content-Length"] = str(len(body))
+                headers.add_vary_header("Accept-Encoding")
+            await send(start)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_compressed)
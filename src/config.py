@@ -1,3 +1,5 @@
+from typing import Dict, List, Optional
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class Settings(BaseSettings):
@@ -5,10 +7,44 @@ class Settings(BaseSettings):
 
     JWT_SECRET:str
     JWT_ALGORITHM:str
+    # kid -> PEM private key (Ed25519 or P-256) or path of a PEM file;
+    # when set, tokens are signed with JWT_ACTIVE_KID (default: the last key)
+    JWT_SIGNING_KEYS: Dict[str, str] = {}
+    # kid -> PEM public key of retired keys, still accepted for verification
+    JWT_VERIFY_KEYS: Dict[str, str] = {}
+    JWT_ACTIVE_KID: Optional[str] = None
+    # accept tokens signed with JWT_SECRET once signing keys are set
+    JWT_ACCEPT_SECRET: bool = True
 
     REDIS_HOST: str 
     REDIS_PORT: int = 6379
     REDIS_PASSWORD: str 
+    REDIS_SSL: bool = True
+    # "standalone", "sentinel" or "cluster"
+    REDIS_MODE: str = "standalone"
+    # "host:port" of the sentinels, for REDIS_MODE=sentinel
+    REDIS_SENTINELS: List[str] = []
+    REDIS_SENTINEL_MASTER: str = "mymaster"
+    REDIS_MAX_CONNECTIONS: int = 64
+    REDIS_POOL_TIMEOUT: float = 1
+    REDIS_HEALTH_CHECK_INTERVAL: float = 30
+    # send the commands issued in the same event loop iteration as one pipeline
+    REDIS_AUTO_BATCH: bool = True
+    REDIS_BATCH_MAX: int = 128
+    TOKEN_VERSION_CACHE_SECONDS: float = 5
+    SESSION_REUSE_GRACE_SECONDS: float = 10
+
+    # "bcrypt" or "argon2" (argon2id), hashes of the other scheme are upgraded at login
+    PASSWORD_SCHEME: str = "bcrypt"
+    # cost calibrated at startup so that a hash takes about this long, 0 disables it
+    PASSWORD_HASH_TARGET_MS: float = 250
+    # floors for the calibration
+    BCRYPT_ROUNDS: int = 12
+    ARGON2_TIME_COST: int = 2
+    ARGON2_MEMORY_KIB: int = 64 * 1024
+    ARGON2_PARALLELISM: int = 2
+    # threads hashing passwords, 0 for one per cpu
+    PASSWORD_HASH_WORKERS: int = 0
 
     MAIL_USERNAME: str
     MAIL_PASSWORD: str
@@ -20,8 +56,153 @@ class Settings(BaseSettings):
     MAIL_SSL_TLS: bool = False
     USE_CREDENTIALS: bool = True
     VALIDATE_CERTS: bool = True
+    MAIL_TIMEOUT: float = 30
+    MAIL_POOL_SIZE: int = 4
+    MAIL_BATCH_SIZE: int = 100
+    MAIL_POLL_INTERVAL: float = 2
+    MAIL_LEASE_SECONDS: int = 300
+    MAIL_MAX_ATTEMPTS: int = 8
+    MAIL_RETRY_BASE_DELAY: float = 30
+    MAIL_RETRY_MAX_DELAY: float = 3600
+    MAIL_RATE_LIMIT: float = 10
+    MAIL_RATE_BURST: int = 20
+    MAIL_DEFAULT_LOCALE: str = "en"
     DOMAIN: str
 
+    ACCESS_LOG_SAMPLE_RATE: float = 0.1
+    ACCESS_LOG_SLOW_MS: float = 500
+    ACCESS_LOG_QUEUE_SIZE: int = 10000
+
+    SERVER_TIMING_ENABLED: bool = True
+    SQL_N_PLUS_ONE_THRESHOLD: int = 5
+    SQL_QUERY_BUDGETS: Dict[str, int] = {}
+    SQL_STRICT_MODE: bool = False
+
+    PROFILING_SAMPLE_RATE: float = 0.0
+    PROFILING_INTERVAL: float = 0.005
+    PROFILING_WINDOW_SECONDS: int = 900
+    PROFILING_TOKEN: Optional[str] = None
+
+    TRACING_ENABLED: bool = False
+    TRACING_SAMPLE_RATE: float = 1.0
+    TRACING_EXPORTER: str = "otlp"
+    TRACING_OTLP_ENDPOINT: str = "http://localhost:4318/v1/traces"
+    TRACING_FILE: str = "spans.jsonl"
+
+    BOOK_DEDUP_ENABLED: bool = True
+    BOOK_DEDUP_THRESHOLD: float = 0.8
+    BOOK_DEDUP_BANDS: int = 8
+    BOOK_DEDUP_ROWS: int = 4
+
+    COMPRESSION_MIN_SIZE: int = 1024
+    COMPRESSION_THREAD_SIZE: int = 256 * 1024
+    COMPRESSION_CACHE_BYTES: int = 32 * 1024 * 1024
+    COMPRESSION_CACHE_MAX_BODY: int = 1024 * 1024
+    COMPRESSION_CACHE_SEEN: int = 4096
+
+    RATE_LIMIT_ENABLED: bool = True
+    # "<requests>/<second|minute|hour|day>" per client ip, the `_account`
+    # entries apply per email address whatever the ip
+    RATE_LIMITS: Dict[str, str] = {
+        "login": "20/minute",
+        "login_account": "5/minute",
+        "signup": "10/hour",
+        "signup_account": "3/hour",
+        "password_reset": "10/hour",
+        "password_reset_account": "3/hour",
+        "send_mail": "30/minute",
+    }
+    RATE_LIMIT_PREFETCH: int = 10
+    RATE_LIMIT_LEASE_SECONDS: float = 1.0
+    RATE_LIMIT_LOCAL_KEYS: int = 10000
+    # addresses or networks of the reverse proxies in front of the API. A
+    # request from one of them is limited by the X-Forwarded-For address its
+    # proxy saw, otherwise every client behind the proxy shares its bucket.
+    # Running uvicorn with --proxy-headers --forwarded-allow-ips does the same.
+    TRUSTED_PROXIES: List[str] = ["127.0.0.1", "::1"]
+
+    ADMISSION_ENABLED: bool = True
+    ADMISSION_MAX_CONCURRENCY: int = 64
+    ADMISSION_QUEUE_SIZE: int = 256
+    ADMISSION_QUEUE_TARGET_MS: float = 50
+    ADMISSION_QUEUE_INTERVAL_MS: float = 500
+    ADMISSION_MAX_WAIT_MS: float = 2000
+    # keyed by "<METHOD> <route template>"
+    ADMISSION_ROUTE_LIMITS: Dict[str, int] = {
+        "GET /api/v1/books/": 16,
+        "GET /api/v1/review/": 16,
+    }
+    # 0 goes first, routes not listed get ADMISSION_DEFAULT_PRIORITY
+    ADMISSION_PRIORITIES: Dict[str, int] = {
+        "GET /metrics": 0,
+        "GET /.well-known/jwks.json": 0,
+        "GET /health": 0,
+        "GET /api/v1/books/{book_id}": 0,
+        "GET /api/v1/review/{review_uid}": 0,
+        "GET /api/v1/books/": 2,
+        "GET /api/v1/review/": 2,
+    }
+    ADMISSION_DEFAULT_PRIORITY: int = 1
+    # long lived routes bypass admission control, they have their own limits
+    ADMISSION_EXEMPT_ROUTES: List[str] = ["GET /api/v1/books/{book_id}/reviews/stream"]
+
+    REQUEST_TIMEOUT: float = 10
+    # keyed by "<METHOD> <route template>", in seconds, 0 for no deadline
+    REQUEST_TIMEOUTS: Dict[str, float] = {
+        "GET /api/v1/books/{book_id}": 3,
+        "GET /api/v1/review/{review_uid}": 3,
+        "GET /api/v1/books/": 5,
+        "GET /api/v1/review/": 5,
+        "GET /api/v1/books/{book_id}/reviews/stream": 0,
+    }
+    # applies to statements run outside of a request deadline, 0 disables it
+    DB_STATEMENT_TIMEOUT_MS: int = 30000
+    REDIS_SOCKET_TIMEOUT: float = 1
+    REDIS_CONNECT_TIMEOUT: float = 1
+    MAIL_BATCH_TIMEOUT: float = 120
+
+    ACCOUNT_DELETION_BATCH_SIZE: int = 1000
+    ACCOUNT_DELETION_POLL_INTERVAL: float = 5
+    ACCOUNT_DELETION_LEASE_SECONDS: int = 600
+    # what happens to the books a deleted user added: "anonymize" or "delete"
+    ACCOUNT_DELETION_BOOKS: str = "anonymize"
+
+    REVIEW_PARTITION_MONTHS_AHEAD: int = 3
+    # reviews are moved out of the database once their month is this old
+    REVIEW_ARCHIVE_AFTER_MONTHS: int = 24
+    REVIEW_ARCHIVE_DIR: str = "archive/reviews"
+    REVIEW_ARCHIVE_INTERVAL: float = 24 * 3600
+
+    # default to the Redis of REDIS_HOST, db 1 for the broker and db 2 for results
+    CELERY_BROKER_URL: Optional[str] = None
+    CELERY_RESULT_BACKEND: Optional[str] = None
+    # run tasks in the calling process with an in memory broker, for local runs and tests
+    CELERY_TASK_ALWAYS_EAGER: bool = False
+    CELERY_RESULT_EXPIRES: int = 24 * 3600
+    CELERY_TASK_MAX_RETRIES: int = 5
+    CELERY_RETRY_BACKOFF_MAX: int = 600
+    # tasks not acknowledged by then are delivered again, keep it above the longest task
+    CELERY_VISIBILITY_TIMEOUT: int = 2 * 3600
+    BOOK_EXPORT_DIR: str = "exports"
+    BOOK_IMPORT_MAX_ROWS: int = 10000
+
+    # per API worker
+    SSE_MAX_CONNECTIONS: int = 1000
+    SSE_HEARTBEAT_SECONDS: float = 15
+    # reconnection delay advised to clients
+    SSE_RETRY_MS: int = 3000
+    # events a client can fall behind before it is disconnected
+    SSE_CLIENT_QUEUE_SIZE: int = 100
+    # reviews replayed on reconnection, a client further behind is told to reload
+    SSE_RESUME_LIMIT: int = 100
+
+    # nesting of fields, introspection excluded
+    GRAPHQL_MAX_DEPTH: int = 6
+    # fields a query may resolve, list fields counted `first` times
+    GRAPHQL_MAX_COST: int = 5000
+    GRAPHQL_MAX_PAGE_SIZE: int = 100
+    GRAPHQL_DOCUMENT_CACHE_SIZE: int = 256
+
     model_config = SettingsConfigDict(
         env_file=".env",
         extra="ignore"
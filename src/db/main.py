@@ -1,18 +1,135 @@
+import re
+import time
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
 from sqlmodel import create_engine, text
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import AsyncEngine
 from sqlmodel import SQLModel
 from sqlmodel.ext.asyncio.session import AsyncSession
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 from src.config import Config
+from src.deadlines import remaining
+from src.tracing import start_span
 
 engine = AsyncEngine(create_engine(
     url=Config.DATABASE_URL,
-    echo=False
+    echo=False,
+    connect_args={"server_settings": {"statement_timeout": str(Config.DB_STATEMENT_TIMEOUT_MS)}}
 ))
 
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\$\d+|%\(\w+\)s|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r"\bIN\s*\(\s*\?(?:::\w+)?(?:\s*,\s*\?(?:::\w+)?)*\s*\)", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=2048)
+def fingerprint(statement: str) -> str:
+    """
+    Normalize a SQL statement so that statements differing only by their
+    parameters or the length of an IN list share the same fingerprint.
+    """
+    statement = _LITERALS.sub("?", statement)
+    statement = _IN_LISTS.sub("IN (?...)", statement)
+    return _WHITESPACE.sub(" ", statement).strip()
+
+
+class QueryStats:
+    """Queries executed and time spent in the database during one request"""
+    __slots__ = ("count", "duration", "fingerprints")
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints: Dict[str, int] = {}
+
+    def repeated(self, threshold: int) -> List[Tuple[str, int]]:
+        """
+        Fingerprints executed at least `threshold` times, the usual sign of a
+        lazy relationship loaded once per row (N+1).
+        """
+        return [(fp, count) for fp, count in self.fingerprints.items() if count >= threshold]
+
+
+def query_problems(stats: QueryStats, route: str) -> List[Tuple[str, str]]:
+    """
+    Check the queries of a request against the N+1 threshold and the query
+    budget of its route.
+    Returns:
+        List of (kind, detail) tuples, empty when everything is fine
+    """
+    problems = []
+    for fp, count in stats.repeated(Config.SQL_N_PLUS_ONE_THRESHOLD):
+        problems.append(("n_plus_one", f"{count}x {fp}"))
+    budget = Config.SQL_QUERY_BUDGETS.get(route)
+    if budget is not None and stats.count > budget:
+        problems.append(("budget_exceeded", f"{stats.count} queries, budget is {budget}"))
+    return problems
+
+
+query_stats: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+    conn.info.setdefault("query_span", []).append(
+        start_span("SQL", {"db.system": "postgresql", "db.statement": fingerprint(statement)})
+    )
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info["query_start"].pop()
+    span = conn.info["query_span"].pop()
+    if span is not None:
+        span.end()
+    stats = query_stats.get()
+    if stats is not None and not conn.info.get("untracked"):
+        stats.count += 1
+        stats.duration += duration
+        fp = fingerprint(statement)
+        stats.fingerprints[fp] = stats.fingerprints.get(fp, 0) + 1
+
+
+@event.listens_for(engine.sync_engine, "handle_error")
+def _handle_error(exception_context):
+    if exception_context.connection is None:
+        return
+    info = exception_context.connection.info
+    if info.get("query_start"):
+        info["query_start"].pop()
+    if info.get("query_span"):
+        span = info["query_span"].pop()
+        if span is not None:
+            span.record_exception(exception_context.original_exception)
+            span.end()
+
+
+@event.listens_for(Session, "after_begin")
+def _set_statement_timeout(session, transaction, connection):
+    """
+    Cap the statements of the transaction to what is left of the request
+    deadline, so a slow query is cancelled by Postgres instead of holding its
+    connection after the client has been answered.
+    """
+    left = remaining()
+    if left is not None:
+        # not a query of the request: it would count against its budget and,
+        # once per transaction, look like an N+1
+        connection.info["untracked"] = True
+        try:
+            connection.exec_driver_sql(f"SET LOCAL statement_timeout = {max(1, int(left * 1000))}")
+        finally:
+            connection.info["untracked"] = False
+
+
 async def get_session():
     async_session = sessionmaker(
         bind=engine, class_=AsyncSession, expire_on_commit=False
     )
     async with async_session() as session:
-        yield session
\ No newline at end of file
+        yield session
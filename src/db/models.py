@@ -1,4 +1,5 @@
 from sqlmodel import SQLModel, Field, Column, Relationship
+from sqlalchemy import DDL, Index, event, text
 import sqlalchemy.dialects.postgresql as pg
 import uuid
 from datetime import datetime
@@ -7,6 +8,13 @@ from typing import Optional, List
 
 class User(SQLModel, table=True):
     __tablename__ = 'user_accounts'
+    __table_args__ = (
+        Index(
+            "ix_user_accounts_deleted_at",
+            "deleted_at",
+            postgresql_where=text("deleted_at IS NOT NULL"),
+        ),
+    )
 
     uid: uuid.UUID = Field(
         sa_column=Column(
@@ -19,14 +27,23 @@ class User(SQLModel, table=True):
     is_verified: bool = Field(default=False)
     password_hash: str
     created_at: datetime = Field(sa_column=Column(pg.TIMESTAMP, default=datetime.now))
+    # set when the account deletion is requested, the row is removed by
+    # the account deletion worker once its data is gone
+    deleted_at: Optional[datetime] = Field(default=None, sa_column=Column(pg.TIMESTAMP, nullable=True))
 
     books: List["Book"] = Relationship(
         back_populates="user", 
-        sa_relationship_kwargs={"lazy": "selectin"}
+        sa_relationship_kwargs={
+            "lazy": "selectin",
+            "primaryjoin": "and_(User.uid == Book.user_uid, Book.deleted_at == None)",
+        }
     )
     reviews: List["Review"] = Relationship(
         back_populates="user", 
-        sa_relationship_kwargs={"lazy": "selectin"}
+        sa_relationship_kwargs={
+            "lazy": "selectin",
+            "primaryjoin": "and_(User.uid == Review.user_uid, Review.deleted_at == None)",
+        }
     )
     
     def __repr__(self) -> str:
@@ -63,6 +80,14 @@ class Tag(SQLModel, table=True):
 
 class Book(SQLModel, table=True):
     __tablename__ = 'books'
+    __table_args__ = (
+        # deleted books stay in the table but not in the indexes reads use
+        Index(
+            "ix_books_created_at_live",
+            "created_at",
+            postgresql_where=text("deleted_at IS NULL"),
+        ),
+    )
 
     uid: uuid.UUID = Field(
         sa_column=Column(
@@ -79,16 +104,20 @@ class Book(SQLModel, table=True):
     published_date: str
     page_count: int
     language:str
-    user_uid: Optional[uuid.UUID] = Field(default=None, foreign_key="user_accounts.uid")
+    user_uid: Optional[uuid.UUID] = Field(default=None, foreign_key="user_accounts.uid", index=True)
     created_at: datetime = Field(sa_column=Column(pg.TIMESTAMP, default=datetime.now))
     updated_at:datetime = Field(sa_column=Column(pg.TIMESTAMP, default=datetime.now))
+    deleted_at: Optional[datetime] = Field(default=None, sa_column=Column(pg.TIMESTAMP, nullable=True))
     user: Optional["User"] = Relationship(
         back_populates="books"
         )
 
     reviews: List["Review"] = Relationship(
         back_populates="book", 
-        sa_relationship_kwargs={"lazy": "selectin"}
+        sa_relationship_kwargs={
+            "lazy": "selectin",
+            "primaryjoin": "and_(Book.uid == Review.book_uid, Review.deleted_at == None)",
+        }
     )
     tags: List[Tag] = Relationship(
         link_model=BookTags,
@@ -101,7 +130,26 @@ class Book(SQLModel, table=True):
     
 
 class Review(SQLModel, table=True):
+    """
+    Reviews are partitioned by month of `created_at` (reviews_pYYYY_MM, see
+    src/review_archive.py), the primary key includes it as partitioning
+    requires.
+    """
     __tablename__ ='reviews'
+    __table_args__ = (
+        Index(
+            "ix_reviews_book_uid_live",
+            "book_uid",
+            "created_at",
+            postgresql_where=text("deleted_at IS NULL"),
+        ),
+        Index(
+            "ix_reviews_created_at_live",
+            "created_at",
+            postgresql_where=text("deleted_at IS NULL"),
+        ),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
 
     uid: uuid.UUID = Field(
         sa_column=Column(
@@ -113,10 +161,13 @@ class Review(SQLModel, table=True):
     )
     rating: int = Field(lt=5)
     review_text: str = Field(sa_column=Column(pg.VARCHAR , nullable=False))
-    user_uid : Optional[uuid.UUID] = Field(default=None, foreign_key="user_accounts.uid")
+    user_uid : Optional[uuid.UUID] = Field(default=None, foreign_key="user_accounts.uid", index=True)
     book_uid : Optional[uuid.UUID] = Field(default=None, foreign_key="books.uid")
-    created_at: datetime = Field(sa_column=Column(pg.TIMESTAMP, default=datetime.now))
+    created_at: datetime = Field(
+        sa_column=Column(pg.TIMESTAMP, primary_key=True, nullable=False, default=datetime.now)
+    )
     update_at: datetime = Field(sa_column=Column(pg.TIMESTAMP, default=datetime.now))
+    deleted_at: Optional[datetime] = Field(default=None, sa_column=Column(pg.TIMESTAMP, nullable=True))
 
     user: Optional["User"] = Relationship(back_populates="reviews")
     book: Optional["Book"] = Relationship(back_populates="reviews")
@@ -124,3 +175,43 @@ class Review(SQLModel, table=True):
     def __repr__(self) -> str:
         return f"Review for book {self.book_uid} and user {self.user_uid}"
     
+
+class EmailOutbox(SQLModel, table=True):
+    __tablename__ = 'email_outbox'
+    __table_args__ = (
+        Index(
+            "ix_email_outbox_pending",
+            "next_attempt_at",
+            postgresql_where=text("status = 'pending'"),
+        ),
+    )
+
+    uid: uuid.UUID = Field(
+        sa_column=Column(
+            pg.UUID,
+            primary_key=True,
+            default=uuid.uuid4,
+            nullable=False
+        )
+    )
+    recipient: str = Field(sa_column=Column(pg.VARCHAR, nullable=False))
+    subject: str = Field(sa_column=Column(pg.VARCHAR, nullable=False))
+    body: str = Field(sa_column=Column(pg.TEXT, nullable=False))
+    status: str = Field(sa_column=Column(pg.VARCHAR, nullable=False, server_default="pending"))
+    attempts: int = Field(sa_column=Column(pg.INTEGER, nullable=False, server_default="0"))
+    last_error: Optional[str] = Field(default=None, sa_column=Column(pg.TEXT, nullable=True))
+    next_attempt_at: datetime = Field(sa_column=Column(pg.TIMESTAMP, nullable=False, default=datetime.now))
+    created_at: datetime = Field(sa_column=Column(pg.TIMESTAMP, default=datetime.now))
+    sent_at: Optional[datetime] = Field(default=None, sa_column=Column(pg.TIMESTAMP, nullable=True))
+
+    def __repr__(self) -> str:
+        return f"<EmailOutbox {self.recipient} {self.status}>"
+
+
+# a partitioned table without partitions rejects every insert, tables made
+# by create_all (tests, benchmarks) get a default partition taking any date
+event.listen(
+    Review.__table__,
+    "after_create",
+    DDL("CREATE TABLE IF NOT EXISTS reviews_default PARTITION OF reviews DEFAULT"),
+)
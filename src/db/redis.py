@@ -1,21 +1,544 @@
-from redis.asyncio import StrictRedis
+import asyncio
+import math
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from redis.asyncio import BlockingConnectionPool, StrictRedis
+from redis.asyncio.cluster import RedisCluster
+from redis.asyncio.connection import SSLConnection
+from redis.asyncio.sentinel import Sentinel
+from redis.exceptions import TimeoutError as RedisTimeoutError
 from src.config import Config
+from src.deadlines import timeout_for
+from src.errors import RequestTimeout
+from src.metrics import REDIS_BATCH_SIZE, observe_redis
+from src.tracing import traced
+
+
+def _host_port(address: str) -> Tuple[str, int]:
+    host, _, port = address.rpartition(":")
+    return host, int(port)
+
+
+def create_client():
+    """
+    Redis client for REDIS_MODE: "standalone" (REDIS_HOST:REDIS_PORT),
+    "sentinel" (the master REDIS_SENTINEL_MASTER found through
+    REDIS_SENTINELS) or "cluster" (REDIS_HOST:REDIS_PORT is any node).
+    Connections are health checked with a PING when they were idle for
+    REDIS_HEALTH_CHECK_INTERVAL seconds. A standalone client waits up to
+    REDIS_POOL_TIMEOUT for a free connection instead of failing when all
+    REDIS_MAX_CONNECTIONS are in use.
+    """
+    options = dict(
+        password=Config.REDIS_PASSWORD or None,
+        socket_timeout=Config.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=Config.REDIS_CONNECT_TIMEOUT,
+        health_check_interval=Config.REDIS_HEALTH_CHECK_INTERVAL,
+    )
+    if Config.REDIS_MODE == "cluster":
+        return RedisCluster(
+            host=Config.REDIS_HOST, port=Config.REDIS_PORT, ssl=Config.REDIS_SSL,
+            max_connections=Config.REDIS_MAX_CONNECTIONS, **options
+        )
+    if Config.REDIS_MODE == "sentinel":
+        sentinel = Sentinel(
+            [_host_port(address) for address in Config.REDIS_SENTINELS],
+            sentinel_kwargs={"password": options["password"], "socket_timeout": Config.REDIS_SOCKET_TIMEOUT},
+            ssl=Config.REDIS_SSL, **options
+        )
+        return sentinel.master_for(Config.REDIS_SENTINEL_MASTER, max_connections=Config.REDIS_MAX_CONNECTIONS)
+    if Config.REDIS_MODE != "standalone":
+        raise ValueError(f"REDIS_MODE must be standalone, sentinel or cluster, got {Config.REDIS_MODE}")
+    pool_options = dict(
+        host=Config.REDIS_HOST, port=Config.REDIS_PORT,
+        max_connections=Config.REDIS_MAX_CONNECTIONS, timeout=Config.REDIS_POOL_TIMEOUT, **options
+    )
+    if Config.REDIS_SSL:
+        pool_options["connection_class"] = SSLConnection
+    return StrictRedis(connection_pool=BlockingConnectionPool(**pool_options))
+
+
+async def bounded(awaitable):
+    """
+    Await a Redis call for REDIS_SOCKET_TIMEOUT at most, shortened to what is
+    left of the deadline of the request
+    Raises:
+        RequestTimeout: when the deadline has already passed
+        redis.exceptions.TimeoutError: when the call takes longer
+    """
+    try:
+        timeout = timeout_for(Config.REDIS_SOCKET_TIMEOUT)
+    except RequestTimeout:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise RedisTimeoutError(f"Redis call timed out after {timeout:.3f}s") from None
+
+
+# commands whose concurrent calls with the same arguments share one reply
+READ_COMMANDS = frozenset(("GET", "EXISTS", "HEXISTS", "HGET"))
+
+
+class RedisBatcher:
+    """
+    Send the commands issued during one iteration of the event loop as one
+    pipeline. Concurrent requests checking their tokens then cost one round
+    trip instead of one each, and identical reads (the token version of a
+    user, the same session) are sent once, unless a write to their key is
+    queued in the same batch: the reads after it must see its effect.
 
-JTI_EXPIRY = 3600
+    The pipeline is not a transaction, every command gets its own reply or
+    error. Commands are sent directly when REDIS_AUTO_BATCH is off.
+    """
+    def __init__(self, client, max_batch: int = Config.REDIS_BATCH_MAX, enabled: bool = Config.REDIS_AUTO_BATCH):
+        self.client = client
+        self.max_batch = max_batch
+        self.enabled = enabled
+        self._pending: Dict[tuple, List[asyncio.Future]] = {}
+        # keys written by the pending commands
+        self._written: set = set()
+        self._scheduled = False
+        self.commands = 0
+        self.round_trips = 0
 
-token_blocklist = StrictRedis(
-    host=Config.REDIS_HOST,
-    port=Config.REDIS_PORT,
-    password=Config.REDIS_PASSWORD,
-    ssl=True
-)
+    async def execute(self, command: str, *args):
+        if not self.enabled:
+            self.commands += 1
+            self.round_trips += 1
+            return await bounded(self.client.execute_command(command, *args))
 
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # its error is not retrieved when all its callers timed out
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        if command in READ_COMMANDS and args[0] not in self._written:
+            key = (command, args)
+        else:
+            key = (command, args, id(future))
+            if command not in READ_COMMANDS:
+                self._written.add(args[0])
+        self._pending.setdefault(key, []).append(future)
+        if not self._scheduled:
+            self._scheduled = True
+            loop.call_soon(self._flush)
+        # shielded: the reply may be shared with callers that have more time left
+        return await bounded(asyncio.shield(future))
 
-async def add_jti_to_blocklist(jti: str) -> None:
-    await token_blocklist.set(name=jti, value="", ex=JTI_EXPIRY)
+    def _flush(self) -> None:
+        self._scheduled = False
+        batch, self._pending = list(self._pending.items()), {}
+        self._written = set()
+        asyncio.ensure_future(self._send_chunks(batch))
+
+    async def _send_chunks(self, batch: List[Tuple[tuple, List[asyncio.Future]]]) -> None:
+        # one chunk after the other: a read must not overtake a write queued before it
+        for start in range(0, len(batch), self.max_batch):
+            await self._send(batch[start:start + self.max_batch])
+
+    async def _send(self, batch: List[Tuple[tuple, List[asyncio.Future]]]) -> None:
+        self.commands += sum(len(futures) for _, futures in batch)
+        self.round_trips += 1
+        REDIS_BATCH_SIZE.observe(len(batch))
+        try:
+            if len(batch) == 1:
+                key = batch[0][0]
+                results = [await self.client.execute_command(key[0], *key[1])]
+            else:
+                async with self.client.pipeline(transaction=False) as pipe:
+                    for key, _ in batch:
+                        pipe.execute_command(key[0], *key[1])
+                    results = await pipe.execute(raise_on_error=False)
+        except BaseException as exc:
+            for _, futures in batch:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(exc)
+            if not isinstance(exc, Exception):
+                raise
+            return
+
+        for (_, futures), result in zip(batch, results):
+            for future in futures:
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+token_blocklist = create_client()
+batcher = RedisBatcher(token_blocklist)
+
+
+async def redis_healthy(timeout: float = 1) -> bool:
+    """
+    True when Redis answers a PING within `timeout` seconds
+    """
+    try:
+        with traced("redis PING", {"db.system": "redis"}), observe_redis("ping"):
+            return bool(await asyncio.wait_for(token_blocklist.ping(), timeout))
+    except Exception:
+        return False
+
+
+async def add_jti_to_blocklist(jti: str, expires_at: float) -> None:
+    """
+    Block a token until it expires, `expires_at` being its `exp` claim.
+    Only tokens that are not bound to a session need this, a session is
+    ended by removing it from the session store.
+    """
+    ttl = math.ceil(expires_at - time.time())
+    if ttl <= 0:
+        return
+    with traced("redis SET", {"db.system": "redis"}), observe_redis("set"):
+        await batcher.execute("SET", jti, "", "EX", ttl)
 
 
 async def token_in_blocklist(jti: str) -> bool:
-    jti = await token_blocklist.get(jti)
+    with traced("redis GET", {"db.system": "redis"}), observe_redis("get"):
+        jti = await batcher.execute("GET", jti)
 
     return jti is not None
+
+
+# user uid -> (token version, monotonic time the cached value expires)
+_token_versions: Dict[str, Tuple[int, float]] = {}
+TOKEN_VERSION_CACHE_SIZE = 10000
+
+
+def _cache_token_version(user_uid: str, version: int) -> None:
+    if len(_token_versions) >= TOKEN_VERSION_CACHE_SIZE:
+        _token_versions.clear()
+    _token_versions[user_uid] = (version, time.monotonic() + Config.TOKEN_VERSION_CACHE_SECONDS)
+
+
+# the user uid is a hash tag, so that in a cluster the token version and the
+# sessions of a user are in the same slot and one script can update both
+def _token_version_key(user_uid: str) -> str:
+    return f"token_version:{{{user_uid}}}"
+
+
+async def get_token_version(user_uid: str, cached: bool = True) -> int:
+    """
+    Current token version of a user, 0 until it is first bumped. Values are
+    cached in process for TOKEN_VERSION_CACHE_SECONDS, which bounds how long
+    another worker keeps accepting claims that were just revoked.
+
+    Args:
+        cached(bool): False when issuing a token: a version cached before
+            another worker bumped it would mint a token rejected for its
+            whole lifetime by the workers that know the new version
+    """
+    if cached:
+        entry = _token_versions.get(user_uid)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+
+    with traced("redis GET", {"db.system": "redis"}), observe_redis("get"):
+        version = await batcher.execute("GET", _token_version_key(user_uid))
+    version = int(version) if version is not None else 0
+    _cache_token_version(user_uid, version)
+    return version
+
+
+async def bump_token_version(user_uid: str) -> int:
+    """
+    Invalidate the claims of every token issued to a user so far
+    Returns:
+        the new token version
+    """
+    with traced("redis INCR", {"db.system": "redis"}), observe_redis("incr"):
+        version = await bounded(token_blocklist.incr(_token_version_key(user_uid)))
+    _cache_token_version(user_uid, version)
+    return version
+
+
+# Login sessions of a user, in one hash per user: session id ->
+# "<refresh jti>|<refresh exp>|<previous refresh jti>|<rotated at>".
+# A refresh token is accepted once, refreshing replaces its jti with the one
+# of the new refresh token. Access tokens carry the session id and are valid
+# as long as their session exists, so logging out never adds to the blocklist.
+# The hash expires with its last session; expired sessions are pruned when
+# a new one is created.
+SESSION_CREATE_SCRIPT = """
+local now = tonumber(redis.call("TIME")[1])
+local expire_at = tonumber(ARGV[3])
+local sessions = redis.call("HGETALL", KEYS[1])
+for i = 1, #sessions, 2 do
+    local exp = tonumber(string.match(sessions[i + 1], "^[^|]*|([^|]*)"))
+    if exp == nil or exp <= now then
+        redis.call("HDEL", KEYS[1], sessions[i])
+    elseif exp > expire_at then
+        expire_at = exp
+    end
+end
+redis.call("HSET", KEYS[1], ARGV[1], ARGV[2] .. "|" .. ARGV[3] .. "||0")
+redis.call("EXPIREAT", KEYS[1], expire_at)
+"""
+
+# Swap the refresh jti of a session. Presenting a refresh token that was
+# already rotated out means it leaked: the session is removed, which logs
+# out both the thief and the owner. The previous token is tolerated for
+# ARGV[5] seconds so that two tabs refreshing at once are not taken for a
+# replay; the late one is refused without ending the session.
+SESSION_ROTATE_SCRIPT = """
+local now = tonumber(redis.call("TIME")[1])
+local session = redis.call("HGET", KEYS[1], ARGV[1])
+if not session then
+    return "unknown"
+end
+local jti, exp, previous, rotated = string.match(session, "^([^|]*)|([^|]*)|([^|]*)|([^|]*)$")
+if jti == ARGV[2] then
+    redis.call("HSET", KEYS[1], ARGV[1], ARGV[3] .. "|" .. ARGV[4] .. "|" .. jti .. "|" .. now)
+    if now + redis.call("TTL", KEYS[1]) < tonumber(ARGV[4]) then
+        redis.call("EXPIREAT", KEYS[1], ARGV[4])
+    end
+    return "rotated"
+end
+if previous == ARGV[2] and now - tonumber(rotated) <= tonumber(ARGV[5]) then
+    return "superseded"
+end
+redis.call("HDEL", KEYS[1], ARGV[1])
+return "reused"
+"""
+
+# Drop the sessions of a user and bump its token version atomically. A
+# script rather than MULTI, which the cluster client does not support.
+END_ALL_SESSIONS_SCRIPT = """
+redis.call("DEL", KEYS[1])
+return redis.call("INCR", KEYS[2])
+"""
+
+_create_session = token_blocklist.register_script(SESSION_CREATE_SCRIPT)
+_rotate_session = token_blocklist.register_script(SESSION_ROTATE_SCRIPT)
+_end_all_sessions = token_blocklist.register_script(END_ALL_SESSIONS_SCRIPT)
+
+
+def _sessions_key(user_uid: str) -> str:
+    return f"sessions:{{{user_uid}}}"
+
+
+async def create_session(user_uid: str, session_id: str, refresh_jti: str, expires_at: int) -> None:
+    """
+    Store a new login session
+    Args:
+        refresh_jti: jti of the refresh token issued with the session
+        expires_at: `exp` claim of that refresh token
+    """
+    with traced("redis EVALSHA", {"db.system": "redis"}), observe_redis("evalsha"):
+        await bounded(_create_session(keys=[_sessions_key(user_uid)], args=[session_id, refresh_jti, expires_at]))
+
+
+async def rotate_session(user_uid: str, session_id: str, refresh_jti: str,
+                         new_refresh_jti: str, expires_at: int) -> str:
+    """
+    Replace the refresh token of a session
+    Returns:
+        "rotated", "unknown" when the session ended, "reused" when
+        `refresh_jti` was already rotated out (the session is ended) or
+        "superseded" when it was rotated out a moment ago
+    """
+    with traced("redis EVALSHA", {"db.system": "redis"}), observe_redis("evalsha"):
+        outcome = await bounded(_rotate_session(
+            keys=[_sessions_key(user_uid)],
+            args=[session_id, refresh_jti, new_refresh_jti, expires_at, Config.SESSION_REUSE_GRACE_SECONDS]
+        ))
+    return outcome.decode() if isinstance(outcome, bytes) else outcome
+
+
+async def session_active(user_uid: str, session_id: str) -> bool:
+    with traced("redis HEXISTS", {"db.system": "redis"}), observe_redis("hexists"):
+        return bool(await batcher.execute("HEXISTS", _sessions_key(user_uid), session_id))
+
+
+async def end_session(user_uid: str, session_id: str) -> None:
+    with traced("redis HDEL", {"db.system": "redis"}), observe_redis("hdel"):
+        await batcher.execute("HDEL", _sessions_key(user_uid), session_id)
+
+
+async def end_all_sessions(user_uid: str) -> int:
+    """
+    Log a user out of every device: drop its sessions and bump its token
+    version, which also rejects tokens issued before sessions existed
+    Returns:
+        the new token version
+    """
+    with traced("redis EVALSHA", {"db.system": "redis"}), observe_redis("evalsha"):
+        version = await bounded(_end_all_sessions(keys=[_sessions_key(user_uid), _token_version_key(user_uid)]))
+    _cache_token_version(user_uid, version)
+    return version
+
+
+# Token bucket stored as a hash {tokens, ts}. The bucket is refilled from
+# the time elapsed since ts, using the Redis clock so that every worker sees
+# the same time. A caller is granted one token, plus up to `prefetch` more
+# (never more than a tenth of what is left) that it may spend locally
+# without coming back to Redis.
+# Returns {granted, retry_after seconds as a string}.
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local prefetch = tonumber(ARGV[3])
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(bucket[1])
+local ts = tonumber(bucket[2])
+if tokens == nil or ts == nil then
+    tokens = capacity
+    ts = now
+end
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local granted = 0
+local retry_after = 0
+if tokens >= 1 then
+    granted = 1 + math.min(prefetch, math.floor((tokens - 1) / 10))
+    tokens = tokens - granted
+else
+    retry_after = (1 - tokens) / rate
+end
+
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "ts", tostring(now))
+redis.call("PEXPIRE", KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+return {granted, tostring(retry_after)}
+"""
+
+_token_bucket = token_blocklist.register_script(TOKEN_BUCKET_SCRIPT)
+
+
+async def take_tokens(key: str, capacity: int, rate: float, prefetch: int = 0) -> Tuple[int, float]:
+    """
+    Take a token from the bucket stored at `key`
+    Args:
+        capacity: size of the bucket, the burst allowed
+        rate: tokens added per second
+        prefetch: extra tokens the caller would like to take for later
+    Returns:
+        (tokens granted, seconds until a token is available when none was granted)
+    """
+    with traced("redis EVALSHA", {"db.system": "redis"}), observe_redis("evalsha"):
+        granted, retry_after = await bounded(_token_bucket(keys=[key], args=[capacity, rate, prefetch]))
+    return int(granted), float(retry_after)
+
+
+# Progress of account deletions, kept a week after they finish
+DELETION_PROGRESS_TTL = 7 * 24 * 3600
+
+
+def _deletion_key(user_uid: str) -> str:
+    return f"account_deletion:{{{user_uid}}}"
+
+
+# HSET the first ARGV[2] field/value pairs, HINCRBY the pairs after them and
+# expire the hash after ARGV[1] seconds
+DELETION_PROGRESS_SCRIPT = """
+local fields = tonumber(ARGV[2])
+local i = 3
+while i < #ARGV do
+    if (i - 1) / 2 <= fields then
+        redis.call("HSET", KEYS[1], ARGV[i], ARGV[i + 1])
+    else
+        redis.call("HINCRBY", KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    i = i + 2
+end
+redis.call("EXPIRE", KEYS[1], ARGV[1])
+"""
+
+_record_deletion_progress = token_blocklist.register_script(DELETION_PROGRESS_SCRIPT)
+
+
+async def record_deletion_progress(user_uid: str, fields: Dict[str, str], counts: Dict[str, int] = None) -> None:
+    """
+    Set fields of the progress of an account deletion and add to its row counts
+    """
+    args = [DELETION_PROGRESS_TTL, len(fields)]
+    for name, value in (*fields.items(), *(counts or {}).items()):
+        args += [name, value]
+    with traced("redis EVALSHA", {"db.system": "redis"}), observe_redis("evalsha"):
+        await bounded(_record_deletion_progress(keys=[_deletion_key(user_uid)], args=args))
+
+
+async def get_deletion_progress(user_uid: str) -> Dict[str, str]:
+    with traced("redis HGETALL", {"db.system": "redis"}), observe_redis("hgetall"):
+        progress = await bounded(token_blocklist.hgetall(_deletion_key(user_uid)))
+    return {k.decode(): v.decode() for k, v in progress.items()}
+
+
+async def acquire_lease(name: str, seconds: int) -> Optional[str]:
+    """
+    Take a lease that expires after `seconds` unless released
+    Returns:
+        the lease token, None when someone else holds it
+    """
+    token = uuid.uuid4().hex
+    if await batcher.execute("SET", f"lease:{name}", token, "NX", "EX", seconds):
+        return token
+    return None
+
+
+# delete the lease only while it is still ours
+RELEASE_LEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+_release_lease = token_blocklist.register_script(RELEASE_LEASE_SCRIPT)
+
+
+async def release_lease(name: str, token: str) -> None:
+    with traced("redis EVALSHA", {"db.system": "redis"}), observe_redis("evalsha"):
+        await bounded(_release_lease(keys=[f"lease:{name}"], args=[token]))
+
+
+# new reviews are published on reviews:<book uid>, see src/reviews/stream.py
+REVIEW_CHANNELS = "reviews:*"
+
+
+def review_channel(book_uid: str) -> str:
+    return f"reviews:{book_uid}"
+
+
+async def publish_review_event(book_uid: str, event: bytes) -> None:
+    with traced("redis PUBLISH", {"db.system": "redis"}), observe_redis("publish"):
+        await batcher.execute("PUBLISH", review_channel(book_uid), event)
+
+
+def create_pubsub():
+    """
+    Pub/sub on a connection of its own. In a cluster a PUBLISH reaches every
+    node, so subscribing on the configured node is enough.
+    """
+    if Config.REDIS_MODE == "cluster":
+        return StrictRedis(
+            host=Config.REDIS_HOST, port=Config.REDIS_PORT, ssl=Config.REDIS_SSL,
+            password=Config.REDIS_PASSWORD or None, socket_connect_timeout=Config.REDIS_CONNECT_TIMEOUT,
+        ).pubsub()
+    return token_blocklist.pubsub()
+
+
+def use_client(client) -> None:
+    """
+    Replace the Redis client, with the batcher and scripts bound to it
+    (benchmarks run against fakeredis this way)
+    """
+    global token_blocklist, batcher, _create_session, _rotate_session, _end_all_sessions, _token_bucket, \
+        _record_deletion_progress, _release_lease
+    token_blocklist = client
+    batcher = RedisBatcher(client)
+    _create_session = client.register_script(SESSION_CREATE_SCRIPT)
+    _rotate_session = client.register_script(SESSION_ROTATE_SCRIPT)
+    _end_all_sessions = client.register_script(END_ALL_SESSIONS_SCRIPT)
+    _token_bucket = client.register_script(TOKEN_BUCKET_SCRIPT)
+    _record_deletion_progress = client.register_script(DELETION_PROGRESS_SCRIPT)
+    _release_lease = client.register_script(RELEASE_LEASE_SCRIPT)
@@ -0,0 +1,174 @@
+"""
+Request deadlines.
+
+Every request gets a deadline, REQUEST_TIMEOUTS[route] or REQUEST_TIMEOUT,
+kept in a context variable so that it follows the request into the database
+layer (`SET LOCAL statement_timeout`, see src/db/main.py), Redis calls
+(`bounded` in src/db/redis.py) and anything else that waits on the network. When the deadline passes the handler
+is cancelled and the client gets a 504. When the client disconnects the
+handler is cancelled as well, there is nobody left to answer.
+"""
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from src.config import Config
+from src.errors import RequestTimeout
+from src.responses import RawJSONResponse
+
+ROUTE_KEY = "bookstore.route"
+TIMEOUT_BODY = b'{"message":"Request timed out","error_code":"request_timeout"}'
+
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+def remaining() -> Optional[float]:
+    """
+    Seconds left before the deadline of the current request, None without a deadline
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def timeout_for(default: float) -> float:
+    """
+    Timeout for one network call: `default`, shortened to what is left of the deadline
+    Raises:
+        RequestTimeout: when the deadline has already passed
+    """
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise RequestTimeout()
+    return min(default, left)
+
+
+@contextmanager
+def deadline_scope(seconds: float):
+    """
+    Run a block with a deadline, for work done outside of a request such as
+    the mail dispatcher batches. An earlier deadline already set is kept.
+    """
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def match_route(scope: Scope) -> Optional[str]:
+    """
+    Template of the route a request will be routed to, looked up before
+    routing so that its deadline and admission can be decided without
+    running the app. The result is kept in the scope for the next middleware.
+    """
+    if ROUTE_KEY in scope:
+        return scope[ROUTE_KEY]
+    app = scope.get("app")
+    route_path = None
+    if app is not None:
+        for route in app.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                route_path = route.path
+                break
+    scope[ROUTE_KEY] = route_path
+    return route_path
+
+
+def route_timeout(scope: Scope) -> float:
+    """
+    Deadline of the route in seconds, 0 for routes without a deadline such as streams
+    """
+    route = match_route(scope)
+    if route is None:
+        return Config.REQUEST_TIMEOUT
+    return Config.REQUEST_TIMEOUTS.get(f"{scope['method']} {route}", Config.REQUEST_TIMEOUT)
+
+
+class DeadlineMiddleware:
+    """
+    Run each request as a task cancelled when its deadline passes or when
+    the client disconnects.
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timeout = route_timeout(scope) or None
+        response_started = False
+        response_complete = False
+        disconnected = False
+        messages: asyncio.Queue = asyncio.Queue()
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal response_started, response_complete
+            if message["type"] == "http.response.start":
+                response_started = True
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                # set before sending: the server reports a disconnect as
+                # soon as the last chunk is out
+                response_complete = True
+            await send(message)
+
+        async def receive_wrapper() -> Message:
+            return await messages.get()
+
+        token = _deadline.set(time.monotonic() + timeout if timeout else None)
+        try:
+            app_task = asyncio.ensure_future(self.app(scope, receive_wrapper, send_wrapper))
+        finally:
+            _deadline.reset(token)
+
+        async def pump() -> None:
+            # read ahead of the app so that a disconnect is seen while the
+            # handler is still waiting on the database. Once the body is read
+            # the only message left is the disconnect, which the server also
+            # sends when the response is complete: by then the app may be
+            # running its background tasks and must not be cancelled.
+            nonlocal disconnected
+            while True:
+                message = await receive()
+                messages.put_nowait(message)
+                if message["type"] == "http.disconnect":
+                    if not response_complete:
+                        disconnected = True
+                        app_task.cancel()
+                    return
+
+        pump_task = asyncio.ensure_future(pump())
+        try:
+            done, _ = await asyncio.wait({app_task}, timeout=timeout)
+            if done:
+                if disconnected and app_task.cancelled():
+                    return
+                app_task.result()
+                return
+
+            app_task.cancel()
+            try:
+                await app_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            if not response_started and not disconnected:
+                response = RawJSONResponse(TIMEOUT_BODY, status_code=504)
+                await response(scope, receive, send)
+        except asyncio.CancelledError:
+            app_task.cancel()
+            raise
+        finally:
+            pump_task.cancel()
@@ -1,9 +1,10 @@
-from typing import Any, Callable
+from typing import Any, Callable, List
 from fastapi.requests import Request
 from fastapi.responses import JSONResponse
 from fastapi import FastAPI, status
 from sqlalchemy.exc import SQLAlchemyError
 import asyncio
+import math
 
 class BooklyException(Exception):
     """This is the base class for all bookly errors"""
@@ -41,6 +42,16 @@ class BookNotFound(BooklyException):
     """Book Not found"""
     pass
 
+class BookAlreadyExists(BooklyException):
+    """A book with the same title, author and publisher already exists"""
+    pass
+
+class SimilarBookExists(BooklyException):
+    """Books with nearly the same title, author and publisher exist, the client has to confirm"""
+    def __init__(self, similar_books: List[str]):
+        super().__init__(similar_books)
+        self.similar_books = similar_books
+
 class ReviewNotFound(BooklyException):
     """Book Not found"""
     pass
@@ -57,6 +68,20 @@ class UserNotFound(BooklyException):
     """User Not found"""
     pass
 
+class RateLimitExceeded(BooklyException):
+    """Too many requests from the same ip or for the same account"""
+    def __init__(self, retry_after: float):
+        super().__init__(retry_after)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+class StreamUnavailable(BooklyException):
+    """This worker serves as many event streams as it can, or lost its Redis subscription"""
+    pass
+
+class RequestTimeout(BooklyException):
+    """The request did not complete before its deadline"""
+    pass
+
 class AccountNotVerified(Exception):
     """Account not yet verified"""
     pass
@@ -65,6 +90,11 @@ class PasswordNotMatched(Exception):
     """passwords did not matched"""
     pass
 
+def is_statement_timeout(exc: SQLAlchemyError) -> bool:
+    """Postgres cancelled the statement because of statement_timeout"""
+    orig = getattr(exc, "orig", None)
+    return (getattr(orig, "sqlstate", None) or getattr(orig, "pgcode", None)) == "57014"
+
 def create_exception_handler(
         status_code: int, initial_detail: Any
 ) -> Callable[[Request, Exception], JSONResponse]:
@@ -109,6 +139,17 @@ def register_error_handler(app: FastAPI):
         ),
     )
 
+    app.add_exception_handler(
+        BookAlreadyExists,
+        create_exception_handler(
+            status_code=status.HTTP_409_CONFLICT,
+            initial_detail={
+                "message": "This book already exists",
+                "error_code": "book_already_exists"
+            },
+        ),
+    )
+
     app.add_exception_handler(
         ReviewNotFound,
         create_exception_handler(
@@ -236,6 +277,56 @@ def register_error_handler(app: FastAPI):
         ),
     )
 
+    app.add_exception_handler(
+        RequestTimeout,
+        create_exception_handler(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            initial_detail={
+                "message": "Request timed out",
+                "error_code": "request_timeout"
+            },
+        ),
+    )
+
+    @app.exception_handler(RateLimitExceeded)
+    async def rate_limit_exceeded(request, exc: RateLimitExceeded):
+
+        return JSONResponse(
+            content={
+                "message": "Too many requests",
+                "error_code": "rate_limit_exceeded",
+                "resolution": f"Please try again in {exc.retry_after} seconds.",
+            },
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            headers={"Retry-After": str(exc.retry_after)},
+        )
+
+    @app.exception_handler(SimilarBookExists)
+    async def similar_book_exists(request, exc: SimilarBookExists):
+
+        return JSONResponse(
+            content={
+                "message": "Similar books already exist",
+                "error_code": "similar_book_exists",
+                "similar_books": exc.similar_books,
+                "resolution": "Check the similar books, then create it anyway with force=true.",
+            },
+            status_code=status.HTTP_409_CONFLICT,
+        )
+
+    @app.exception_handler(StreamUnavailable)
+    async def stream_unavailable(request, exc: StreamUnavailable):
+
+        return JSONResponse(
+            content={
+                "message": "Live updates are unavailable",
+                "error_code": "stream_unavailable",
+                "resolution": "Please reconnect in a few seconds.",
+            },
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={"Retry-After": "5"},
+        )
+
     @app.exception_handler(500)
     async def internal_server_error(request, exc):
 
@@ -250,6 +341,14 @@ def register_error_handler(app: FastAPI):
 
     @app.exception_handler(SQLAlchemyError)
     async def database__error(request, exc):
+        if is_statement_timeout(exc):
+            return JSONResponse(
+                content={
+                    "message": "Request timed out",
+                    "error_code": "request_timeout",
+                },
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            )
         print(str(exc))
         return JSONResponse(
             content={
@@ -0,0 +1,124 @@
+"""
+Depth and cost of a GraphQL operation, checked before it runs.
+
+Every field costs 1, times the number of items of the lists it is nested
+in. A list field counts for its `first` argument, or for its default. Every
+list of the schema is bounded by a `first`; one without would be counted as
+GRAPHQL_MAX_PAGE_SIZE items. So
+`books(first: 20) { title reviews(first: 10) { rating } }` costs
+1 + 20 * (1 + 1 + 10 * 1) = 241. Introspection fields are free, client
+tooling queries the schema with deeply nested fragments.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+
+from graphql import (
+    FieldNode,
+    FragmentDefinitionNode,
+    FragmentSpreadNode,
+    GraphQLError,
+    GraphQLField,
+    GraphQLList,
+    GraphQLSchema,
+    InlineFragmentNode,
+    OperationDefinitionNode,
+    SelectionSetNode,
+    get_named_type,
+    get_nullable_type,
+    value_from_ast,
+)
+
+from src.config import Config
+
+
+class _Walker:
+    def __init__(self, schema: GraphQLSchema, fragments: Dict[str, FragmentDefinitionNode], variables: Dict[str, Any]):
+        self.schema = schema
+        self.fragments = fragments
+        self.variables = variables
+
+    def list_size(self, field: GraphQLField, node: FieldNode) -> int:
+        first = field.args.get("first")
+        if first is None:
+            return Config.GRAPHQL_MAX_PAGE_SIZE
+        for argument in node.arguments:
+            if argument.name.value == "first":
+                value = value_from_ast(argument.value, first.type, self.variables)
+                if isinstance(value, int):
+                    return max(value, 0)
+        return first.default_value if isinstance(first.default_value, int) else Config.GRAPHQL_MAX_PAGE_SIZE
+
+    def fields(self, selection_set: SelectionSetNode, parent_type) -> List[Tuple[FieldNode, Any]]:
+        """
+        Fields of a selection set with fragments expanded
+        """
+        found = []
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                found.append((selection, parent_type))
+            elif isinstance(selection, InlineFragmentNode):
+                type_ = parent_type
+                if selection.type_condition is not None:
+                    type_ = self.schema.get_type(selection.type_condition.name.value) or parent_type
+                found.extend(self.fields(selection.selection_set, type_))
+            elif isinstance(selection, FragmentSpreadNode):
+                fragment = self.fragments[selection.name.value]
+                type_ = self.schema.get_type(fragment.type_condition.name.value) or parent_type
+                found.extend(self.fields(fragment.selection_set, type_))
+        return found
+
+    def measure(self, selection_set: Optional[SelectionSetNode], parent_type) -> Tuple[int, int]:
+        """
+        Returns:
+            (depth, cost) of a selection set
+        """
+        if selection_set is None:
+            return 0, 0
+        depth = cost = 0
+        for node, type_ in self.fields(selection_set, parent_type):
+            name = node.name.value
+            if name.startswith("__"):
+                continue
+            field = getattr(type_, "fields", {}).get(name)
+            if field is None:
+                continue
+            multiplier = 1
+            if isinstance(get_nullable_type(field.type), GraphQLList):
+                multiplier = self.list_size(field, node)
+            child_depth, child_cost = self.measure(node.selection_set, get_named_type(field.type))
+            depth = max(depth, child_depth + 1)
+            cost += 1 + multiplier * child_cost
+        return depth, cost
+
+
+def measure_operation(schema: GraphQLSchema, document, operation_name: Optional[str],
+                      variables: Optional[Dict[str, Any]]) -> Tuple[int, int]:
+    """
+    Depth and cost of the operation of a validated document that will run
+    """
+    fragments = {}
+    operations = []
+    for definition in document.definitions:
+        if isinstance(definition, FragmentDefinitionNode):
+            fragments[definition.name.value] = definition
+        elif isinstance(definition, OperationDefinitionNode):
+            operations.append(definition)
+    if operation_name is not None:
+        operations = [op for op in operations if op.name is not None and op.name.value == operation_name]
+    if len(operations) != 1:
+        # the executor reports it
+        return 0, 0
+
+    operation = operations[0]
+    root_type = schema.get_root_type(operation.operation)
+    return _Walker(schema, fragments, variables or {}).measure(operation.selection_set, root_type)
+
+
+def check_limits(schema: GraphQLSchema, document, operation_name: Optional[str],
+                 variables: Optional[Dict[str, Any]]) -> List[GraphQLError]:
+    depth, cost = measure_operation(schema, document, operation_name, variables)
+    errors = []
+    if depth > Config.GRAPHQL_MAX_DEPTH:
+        errors.append(GraphQLError(f"Query depth {depth} exceeds the limit of {Config.GRAPHQL_MAX_DEPTH}"))
+    if cost > Config.GRAPHQL_MAX_COST:
+        errors.append(GraphQLError(f"Query cost {cost} exceeds the limit of {Config.GRAPHQL_MAX_COST}"))
+    return errors
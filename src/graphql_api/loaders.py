@@ -0,0 +1,104 @@
+"""
+Per request batching of the GraphQL relationships.
+
+Resolvers of the same level of a query all run before the executor waits on
+any of them, so the keys a DataLoader receives during one iteration of the
+event loop are the books (or reviews) of that level. They are fetched with
+one `IN (...)` query instead of one query per parent object.
+"""
+import asyncio
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src.auth.service import UserService
+from src.reviews.service import ReviewService
+from src.tags.service import TagService
+
+review_service = ReviewService()
+tag_service = TagService()
+user_service = UserService()
+
+
+class DataLoader:
+    """
+    Collect the keys loaded during one iteration of the event loop and fetch
+    them with one call of `batch`, which returns one value per key. Values are
+    kept for the rest of the request.
+    """
+    def __init__(self, batch: Callable[[List[Any]], Awaitable[List[Any]]]):
+        self.batch = batch
+        self._futures: Dict[Any, asyncio.Future] = {}
+        self._pending: List[Any] = []
+
+    def load(self, key: Any) -> asyncio.Future:
+        future = self._futures.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._futures[key] = loop.create_future()
+            if not self._pending:
+                loop.call_soon(self._flush)
+            self._pending.append(key)
+        return future
+
+    def _flush(self) -> None:
+        keys, self._pending = self._pending, []
+        asyncio.ensure_future(self._dispatch(keys))
+
+    async def _dispatch(self, keys: List[Any]) -> None:
+        try:
+            values = await self.batch(keys)
+        except Exception as exc:
+            for key in keys:
+                self._futures.pop(key).set_exception(exc)
+            return
+        for key, value in zip(keys, values):
+            self._futures[key].set_result(value)
+
+
+class RequestContext:
+    """
+    Session and loaders of one GraphQL request. A session runs one statement
+    at a time and the loaders of different relationships flush together, so
+    their queries take turns on `lock`.
+    """
+    def __init__(self, session: AsyncSession):
+        self.session = session
+        self.lock = asyncio.Lock()
+        self.tags = DataLoader(self._load_tags)
+        self.reviews = DataLoader(self._load_reviews)
+        self.users = DataLoader(self._load_users)
+
+    async def query(self, method: Callable[..., Awaitable], *args, **kwargs) -> Any:
+        async with self.lock:
+            return await method(*args, **kwargs)
+
+    async def _load_per_book(self, method: Callable[..., Awaitable], keys: List[tuple]) -> List[List[dict]]:
+        # keys are (book uid, page size), one query per page size
+        by_size = defaultdict(list)
+        for book_uid, first in keys:
+            by_size[first].append(book_uid)
+        found = {}
+        for first, book_uids in by_size.items():
+            rows = await self.query(method, book_uids, first)
+            for book_uid in book_uids:
+                found[(book_uid, first)] = rows[book_uid]
+        return [found[key] for key in keys]
+
+    async def _load_tags(self, keys: List[tuple]) -> List[List[dict]]:
+        return await self._load_per_book(
+            lambda book_uids, first: tag_service.get_tag_rows_for_books(self.session, book_uids, first), keys
+        )
+
+    async def _load_reviews(self, keys: List[tuple]) -> List[List[dict]]:
+        return await self._load_per_book(
+            lambda book_uids, first: review_service.get_review_rows_for_books(book_uids, first, self.session), keys
+        )
+
+    async def _load_users(self, user_uids: List) -> List[Optional[dict]]:
+        names = await self.query(user_service.get_usernames, user_uids, self.session)
+        return [
+            {"uid": user_uid, "username": names[user_uid]} if user_uid in names else None
+            for user_uid in user_uids
+        ]
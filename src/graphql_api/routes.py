@@ -0,0 +1,69 @@
+from functools import lru_cache
+from inspect import isawaitable
+from typing import Any, Dict, Optional
+
+import orjson
+from fastapi import APIRouter, Depends
+from graphql import ExecutionResult, GraphQLError, execute, parse, validate
+from pydantic import BaseModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src.auth.dependencies import RoleChecker
+from src.config import Config
+from src.db.main import get_session
+from src.responses import RawJSONResponse
+
+from .limits import check_limits
+from .loaders import RequestContext
+from .schema import schema
+
+graphql_router = APIRouter()
+role_checker = Depends(RoleChecker(["admin", "user"]))
+
+
+class GraphQLRequest(BaseModel):
+    query: str
+    variables: Optional[Dict[str, Any]] = None
+    operationName: Optional[str] = None
+
+
+@lru_cache(maxsize=Config.GRAPHQL_DOCUMENT_CACHE_SIZE)
+def parse_and_validate(query: str):
+    """
+    Parse and validate a query once, clients send the same few queries over and over
+    Returns:
+        (document, validation errors)
+    """
+    try:
+        document = parse(query)
+    except GraphQLError as error:
+        return None, (error,)
+    return document, tuple(validate(schema, document))
+
+
+def graphql_response(result: ExecutionResult) -> RawJSONResponse:
+    return RawJSONResponse(orjson.dumps(result.formatted))
+
+
+@graphql_router.post("", dependencies=[role_checker])
+async def graphql_query(request: GraphQLRequest, session: AsyncSession = Depends(get_session)):
+    """
+    Run a GraphQL query, rejected before it runs when it is deeper than
+    GRAPHQL_MAX_DEPTH or costs more than GRAPHQL_MAX_COST
+    """
+    document, errors = parse_and_validate(request.query)
+    if not errors:
+        errors = check_limits(schema, document, request.operationName, request.variables)
+    if errors:
+        return graphql_response(ExecutionResult(errors=list(errors)))
+
+    result = execute(
+        schema,
+        document,
+        context_value=RequestContext(session),
+        variable_values=request.variables,
+        operation_name=request.operationName,
+    )
+    if isawaitable(result):
+        result = await result
+    return graphql_response(result)
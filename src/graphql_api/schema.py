@@ -0,0 +1,185 @@
+"""
+GraphQL schema over the book, review, tag and user services.
+
+    query {
+      books(first: 20) {
+        title cursor
+        tags { name }
+        reviews(first: 5) { rating reviewText reviewer { username } }
+      }
+    }
+
+Books are paged by creation: pass the `cursor` of the last book as `after`
+to get the next page. The tags, reviews and reviewers of all the books of a
+page come from one query each (see loaders.py).
+"""
+import base64
+import uuid
+from datetime import datetime
+
+from graphql import (
+    GraphQLArgument,
+    GraphQLError,
+    GraphQLField,
+    GraphQLInt,
+    GraphQLList,
+    GraphQLNonNull,
+    GraphQLObjectType,
+    GraphQLScalarType,
+    GraphQLSchema,
+    GraphQLString,
+)
+
+from src.books.service import BookService
+from src.config import Config
+from src.db.models import Book
+from src.tags.service import TagService
+
+book_service = BookService()
+tag_service = TagService()
+
+
+def _parse_uuid(value):
+    try:
+        return uuid.UUID(str(value))
+    except ValueError:
+        raise GraphQLError(f"Invalid UUID: {value}")
+
+
+UUIDType = GraphQLScalarType(
+    "UUID",
+    serialize=str,
+    parse_value=_parse_uuid,
+    parse_literal=lambda node, _variables=None: _parse_uuid(getattr(node, "value", "")),
+)
+DateTimeType = GraphQLScalarType(
+    "DateTime",
+    description="ISO 8601 date and time",
+    serialize=lambda value: value.isoformat(),
+)
+
+
+def column(name: str):
+    """Resolver of a field named differently from its column"""
+    return lambda row, info: row[name]
+
+
+def page_size(first: int) -> int:
+    if not 0 <= first <= Config.GRAPHQL_MAX_PAGE_SIZE:
+        raise GraphQLError(f"first must be between 0 and {Config.GRAPHQL_MAX_PAGE_SIZE}")
+    return first
+
+
+def encode_cursor(book: dict) -> str:
+    return base64.urlsafe_b64encode(f"{book['created_at'].isoformat()}|{book['uid']}".encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        created_at, _, uid = base64.urlsafe_b64decode(cursor.encode()).decode().partition("|")
+        return datetime.fromisoformat(created_at), uuid.UUID(uid)
+    except ValueError:
+        raise GraphQLError("Invalid cursor")
+
+
+def resolve_user(key: str):
+    def resolve(row, info):
+        if row[key] is None:
+            return None
+        return info.context.users.load(row[key])
+    return resolve
+
+
+UserType = GraphQLObjectType("User", lambda: {
+    "uid": GraphQLField(GraphQLNonNull(UUIDType)),
+    "username": GraphQLField(GraphQLNonNull(GraphQLString)),
+})
+
+TagType = GraphQLObjectType("Tag", lambda: {
+    "uid": GraphQLField(GraphQLNonNull(UUIDType)),
+    "name": GraphQLField(GraphQLNonNull(GraphQLString)),
+})
+
+ReviewType = GraphQLObjectType("Review", lambda: {
+    "uid": GraphQLField(GraphQLNonNull(UUIDType)),
+    "rating": GraphQLField(GraphQLNonNull(GraphQLInt)),
+    "reviewText": GraphQLField(GraphQLNonNull(GraphQLString), resolve=column("review_text")),
+    "createdAt": GraphQLField(DateTimeType, resolve=column("created_at")),
+    "reviewer": GraphQLField(UserType, resolve=resolve_user("user_uid")),
+})
+
+BookType = GraphQLObjectType("Book", lambda: {
+    "uid": GraphQLField(GraphQLNonNull(UUIDType)),
+    "title": GraphQLField(GraphQLNonNull(GraphQLString)),
+    "author": GraphQLField(GraphQLNonNull(GraphQLString)),
+    "publisher": GraphQLField(GraphQLNonNull(GraphQLString)),
+    "publishedDate": GraphQLField(GraphQLString, resolve=column("published_date")),
+    "pageCount": GraphQLField(GraphQLInt, resolve=column("page_count")),
+    "language": GraphQLField(GraphQLString),
+    "createdAt": GraphQLField(DateTimeType, resolve=column("created_at")),
+    "cursor": GraphQLField(
+        GraphQLNonNull(GraphQLString),
+        description="Pass it as `after` to get the books that follow",
+        resolve=lambda book, info: encode_cursor(book),
+    ),
+    "submittedBy": GraphQLField(UserType, resolve=resolve_user("user_uid")),
+    "tags": GraphQLField(
+        GraphQLNonNull(GraphQLList(GraphQLNonNull(TagType))),
+        description="By name",
+        args={"first": GraphQLArgument(GraphQLNonNull(GraphQLInt), default_value=10)},
+        resolve=lambda book, info, first: info.context.tags.load((book["uid"], page_size(first))),
+    ),
+    "reviews": GraphQLField(
+        GraphQLNonNull(GraphQLList(GraphQLNonNull(ReviewType))),
+        description="Newest reviews first",
+        args={"first": GraphQLArgument(GraphQLNonNull(GraphQLInt), default_value=10)},
+        resolve=lambda book, info, first: info.context.reviews.load((book["uid"], page_size(first))),
+    ),
+})
+
+
+async def resolve_books(_, info, first: int, after=None):
+    context = info.context
+    return await context.query(
+        book_service.get_book_page_rows,
+        context.session,
+        limit=page_size(first),
+        after=decode_cursor(after) if after is not None else None,
+    )
+
+
+async def resolve_book(_, info, uid: uuid.UUID):
+    context = info.context
+    rows = await context.query(book_service.get_book_page_rows, context.session, Book.uid == uid, limit=1)
+    return rows[0] if rows else None
+
+
+async def resolve_tags(_, info, first: int):
+    context = info.context
+    return await context.query(tag_service.get_all_tag_rows, context.session, limit=page_size(first))
+
+
+QueryType = GraphQLObjectType("Query", lambda: {
+    "books": GraphQLField(
+        GraphQLNonNull(GraphQLList(GraphQLNonNull(BookType))),
+        description="Books, oldest first",
+        args={
+            "first": GraphQLArgument(GraphQLNonNull(GraphQLInt), default_value=20),
+            "after": GraphQLArgument(GraphQLString),
+        },
+        resolve=resolve_books,
+    ),
+    "book": GraphQLField(
+        BookType,
+        args={"uid": GraphQLArgument(GraphQLNonNull(UUIDType))},
+        resolve=resolve_book,
+    ),
+    "tags": GraphQLField(
+        GraphQLNonNull(GraphQLList(GraphQLNonNull(TagType))),
+        description="Tags, newest first",
+        args={"first": GraphQLArgument(GraphQLNonNull(GraphQLInt), default_value=20)},
+        resolve=resolve_tags,
+    ),
+})
+
+schema = GraphQLSchema(query=QueryType)
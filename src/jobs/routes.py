@@ -0,0 +1,66 @@
+import asyncio
+import uuid
+from typing import Annotated, List
+
+from celery import states
+from fastapi import APIRouter, Body, Depends, status
+
+from src.auth.dependencies import AccessTokenBearer, RoleChecker
+from src.books.schema import BookCreateModel
+from src.config import Config
+from src.worker import book_duplicates, celery_app, export_books, import_books, submit
+
+jobs_router = APIRouter()
+admin_role_checker = Depends(RoleChecker(["admin"]))
+
+
+@jobs_router.post("/book_export", status_code=status.HTTP_202_ACCEPTED, dependencies=[admin_role_checker])
+async def start_book_export():
+    """
+    Export all the books as gzipped json lines, the job result is the file path
+    """
+    return {"job_id": await submit(export_books)}
+
+
+@jobs_router.post("/book_import", status_code=status.HTTP_202_ACCEPTED, dependencies=[admin_role_checker])
+async def start_book_import(
+    books: Annotated[List[BookCreateModel], Body(max_length=Config.BOOK_IMPORT_MAX_ROWS)],
+    token_details: dict = Depends(AccessTokenBearer()),
+):
+    """
+    Import up to BOOK_IMPORT_MAX_ROWS books, attributed to the current user
+    """
+    job_id = await submit(
+        import_books,
+        str(uuid.uuid4()),
+        [book.model_dump() for book in books],
+        token_details["user"]["user_uid"],
+    )
+    return {"job_id": job_id}
+
+
+@jobs_router.post("/book_duplicates", status_code=status.HTTP_202_ACCEPTED, dependencies=[admin_role_checker])
+async def start_book_duplicates():
+    """
+    Rebuild the clusters of near duplicate books, they are the job result
+    """
+    return {"job_id": await submit(book_duplicates)}
+
+
+@jobs_router.get("/{job_id}", dependencies=[admin_role_checker])
+async def job_status(job_id: str):
+    """
+    State of a job: PENDING (queued, or unknown), STARTED, RETRY, SUCCESS with
+    its result or FAILURE with its error
+    """
+    meta = await asyncio.to_thread(celery_app.backend.get_task_meta, job_id)
+    job = {
+        "job_id": job_id,
+        "state": meta["status"],
+        "date_done": str(meta["date_done"]) if meta.get("date_done") else None,
+    }
+    if meta["status"] == states.SUCCESS:
+        job["result"] = meta["result"]
+    elif meta["status"] in (states.FAILURE, states.RETRY):
+        job["error"] = repr(meta["result"])
+    return job
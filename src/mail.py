@@ -1,31 +1,45 @@
-from fastapi_mail import FastMail, MessageSchema, ConnectionConfig, MessageType
-from src.config import Config
+from email.message import EmailMessage
+from email.utils import formataddr
 from pathlib import Path
 from typing import List
 
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src.config import Config
+from src.db.models import EmailOutbox
+
 BaseDir = Path(__file__).resolve().parent
 
-# config for mail 
-mail_config = ConnectionConfig(
-    MAIL_USERNAME = Config.MAIL_USERNAME,
-    MAIL_FROM = Config.MAIL_FROM,
-    MAIL_PASSWORD = Config.MAIL_PASSWORD,
-    MAIL_SERVER = Config.MAIL_SERVER,
-    MAIL_PORT = Config.MAIL_PORT,
-    MAIL_FROM_NAME = Config.MAIL_FROM_NAME,
-    MAIL_SSL_TLS = False,
-    MAIL_STARTTLS = True,
-    USE_CREDENTIALS = True,
-    VALIDATE_CERTS = True
-)
-
-mail = FastMail(mail_config)
-
-def create_message(recipients: List[str], subject: str, body: str):
-    message = MessageSchema(
-        recipients=recipients,
-        subject=subject,
-        body=body,
-        subtype=MessageType.html
-    )
-    return message
\ No newline at end of file
+
+def queue_email(session: AsyncSession, recipients: List[str], subject: str, body: str) -> List[EmailOutbox]:
+    """
+    Add one outbox row per recipient to the session.
+
+    Nothing is committed here, the rows are written in the same transaction as
+    the change that triggered the email and sent later by the mail dispatcher.
+    Args:
+        session(AsyncSession): sqlmodel async session
+        recipients(List[str]): email addresses
+        subject(str): subject of the email
+        body(str): html body of the email
+    Returns:
+        The outbox rows added to the session
+    """
+    messages = [
+        EmailOutbox(recipient=recipient, subject=subject, body=body)
+        for recipient in recipients
+    ]
+    session.add_all(messages)
+    return messages
+
+
+def create_message(recipient: str, subject: str, body: str) -> EmailMessage:
+    """
+    Build the html email for one recipient
+    """
+    message = EmailMessage()
+    message["From"] = formataddr((Config.MAIL_FROM_NAME, Config.MAIL_FROM))
+    message["To"] = recipient
+    message["Subject"] = subject
+    message.set_content(body, subtype="html")
+    return message
@@ -0,0 +1,246 @@
+"""
+Mail dispatcher worker.
+
+Sends the emails queued in the `email_outbox` table over a small pool of
+persistent SMTP connections. Run it as a separate process next to the API:
+
+    python -m src.mail_dispatcher
+
+For local testing point MAIL_SERVER/MAIL_PORT to an aiosmtpd server with
+MAIL_STARTTLS=False and USE_CREDENTIALS=False:
+
+    python -m aiosmtpd -n -l localhost:8025
+"""
+import asyncio
+import logging
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import aiosmtplib
+from sqlalchemy import update
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src.config import Config
+from src.db.main import engine
+from src.db.models import EmailOutbox
+from src.deadlines import deadline_scope, timeout_for
+from src.mail import create_message
+from src.tracing import setup_tracing, shutdown_tracing, traced
+
+logger = logging.getLogger(__name__)
+
+
+class SMTPConnectionPool:
+    """
+    Pool of persistent SMTP connections, reconnected lazily when the server
+    closes them.
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self._idle: asyncio.Queue = asyncio.Queue()
+        for _ in range(size):
+            self._idle.put_nowait(None)
+
+    def _new_client(self) -> aiosmtplib.SMTP:
+        return aiosmtplib.SMTP(
+            hostname=Config.MAIL_SERVER,
+            port=Config.MAIL_PORT,
+            username=Config.MAIL_USERNAME if Config.USE_CREDENTIALS else None,
+            password=Config.MAIL_PASSWORD if Config.USE_CREDENTIALS else None,
+            use_tls=Config.MAIL_SSL_TLS,
+            start_tls=Config.MAIL_STARTTLS,
+            validate_certs=Config.VALIDATE_CERTS,
+            timeout=Config.MAIL_TIMEOUT,
+        )
+
+    async def acquire(self) -> aiosmtplib.SMTP:
+        client = await self._idle.get()
+        try:
+            if client is None:
+                client = self._new_client()
+            if not client.is_connected:
+                await client.connect()
+        except Exception:
+            self._idle.put_nowait(None)
+            raise
+        return client
+
+    def release(self, client: aiosmtplib.SMTP, broken: bool = False) -> None:
+        if broken:
+            client.close()
+        self._idle.put_nowait(client)
+
+    async def close(self) -> None:
+        while not self._idle.empty():
+            client = self._idle.get_nowait()
+            if client is not None and client.is_connected:
+                try:
+                    await client.quit()
+                except aiosmtplib.SMTPException:
+                    client.close()
+
+
+class ProviderRateLimiter:
+    """
+    Token bucket per mail provider, the provider being the recipient domain
+    """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+
+    async def acquire(self, provider: str) -> None:
+        while True:
+            now = time.monotonic()
+            tokens, updated = self._buckets.get(provider, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                self._buckets[provider] = (tokens - 1, now)
+                return
+            self._buckets[provider] = (tokens, now)
+            await asyncio.sleep((1 - tokens) / self.rate)
+
+
+def retry_delay(attempts: int) -> float:
+    """
+    Exponential backoff with full jitter
+    """
+    delay = min(Config.MAIL_RETRY_MAX_DELAY, Config.MAIL_RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    return random.uniform(delay / 2, delay)
+
+
+def is_permanent_failure(exc: Exception) -> bool:
+    if isinstance(exc, aiosmtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(exc, aiosmtplib.SMTPResponseException) and 500 <= exc.code < 600
+
+
+class OutboxDispatcher:
+    """
+    Claims batches of pending outbox rows and sends them.
+
+    A claimed row keeps the `pending` status but its `next_attempt_at` moves
+    forward by `MAIL_LEASE_SECONDS`, so the row is picked up again if this
+    process dies before recording the result.
+    """
+    def __init__(self):
+        self.pool = SMTPConnectionPool(Config.MAIL_POOL_SIZE)
+        self.rate_limiter = ProviderRateLimiter(Config.MAIL_RATE_LIMIT, Config.MAIL_RATE_BURST)
+
+    async def claim_batch(self, session: AsyncSession) -> List[EmailOutbox]:
+        now = datetime.now()
+        statement = (
+            select(EmailOutbox)
+            .where(EmailOutbox.status == "pending", EmailOutbox.next_attempt_at <= now)
+            .order_by(EmailOutbox.next_attempt_at)
+            .limit(Config.MAIL_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+        )
+        result = await session.exec(statement)
+        messages = result.all()
+        lease = now + timedelta(seconds=Config.MAIL_LEASE_SECONDS)
+        for message in messages:
+            message.attempts += 1
+            message.next_attempt_at = lease
+        await session.commit()
+        return messages
+
+    async def _send_all(self, queue: asyncio.Queue, results: Dict) -> None:
+        client = None
+        try:
+            while not queue.empty():
+                message = queue.get_nowait()
+                await self.rate_limiter.acquire(message.recipient.rpartition("@")[2].lower())
+                try:
+                    with traced("smtp send", {"messaging.system": "smtp", "message.uid": str(message.uid)}):
+                        if client is None:
+                            client = await self.pool.acquire()
+                        await client.send_message(
+                            create_message(message.recipient, message.subject, message.body),
+                            timeout=timeout_for(Config.MAIL_TIMEOUT)
+                        )
+                    results[message.uid] = None
+                except Exception as exc:
+                    results[message.uid] = exc
+                    if isinstance(exc, aiosmtplib.SMTPServerDisconnected) and client is not None:
+                        self.pool.release(client, broken=True)
+                        client = None
+        finally:
+            if client is not None:
+                self.pool.release(client)
+
+    async def run_once(self) -> int:
+        """
+        Send one batch
+        Returns:
+            number of rows processed
+        """
+        with traced("mail dispatch batch"), deadline_scope(Config.MAIL_BATCH_TIMEOUT):
+            return await self._run_once()
+
+    async def _run_once(self) -> int:
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            messages = await self.claim_batch(session)
+            if not messages:
+                return 0
+
+            queue: asyncio.Queue = asyncio.Queue()
+            for message in messages:
+                queue.put_nowait(message)
+            results: Dict = {}
+            await asyncio.gather(
+                *(self._send_all(queue, results) for _ in range(min(self.pool.size, len(messages))))
+            )
+
+            sent = [uid for uid, exc in results.items() if exc is None]
+            now = datetime.now()
+            if sent:
+                await session.execute(
+                    update(EmailOutbox)
+                    .where(EmailOutbox.uid.in_(sent))
+                    .values(status="sent", sent_at=now, last_error=None)
+                )
+            for message in messages:
+                exc = results.get(message.uid, Exception("not attempted"))
+                if exc is None:
+                    continue
+                logger.warning("Sending email %s failed: %s", message.uid, exc)
+                message.last_error = str(exc)
+                if is_permanent_failure(exc) or message.attempts >= Config.MAIL_MAX_ATTEMPTS:
+                    message.status = "failed"
+                else:
+                    message.next_attempt_at = now + timedelta(seconds=retry_delay(message.attempts))
+            await session.commit()
+            return len(messages)
+
+    async def run_forever(self, stop: Optional[asyncio.Event] = None) -> None:
+        stop = stop or asyncio.Event()
+        try:
+            while not stop.is_set():
+                try:
+                    processed = await self.run_once()
+                except Exception:
+                    logger.exception("Mail dispatcher batch failed")
+                    processed = 0
+                if processed < Config.MAIL_BATCH_SIZE:
+                    try:
+                        await asyncio.wait_for(stop.wait(), timeout=Config.MAIL_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            await self.pool.close()
+
+
+async def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    setup_tracing("bookstore-mail-dispatcher")
+    await OutboxDispatcher().run_forever()
+    await engine.dispose()
+    shutdown_tracing()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,145 @@
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from jinja2 import Environment, FileSystemLoader, Template, select_autoescape
+from sqlalchemy import insert
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src.config import Config
+from src.db.models import EmailOutbox
+
+TEMPLATE_DIR = Path(__file__).resolve().parent / "templates" / "email"
+
+
+def locale_from_header(accept_language: Optional[str]) -> Optional[str]:
+    """
+    Most preferred language of an Accept-Language header, e.g. "es-MX,es;q=0.9" -> "es-mx"
+    """
+    if not accept_language:
+        return None
+    best, best_quality = None, -1.0
+    for part in accept_language.split(","):
+        tag, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                continue
+        if tag and tag != "*" and quality > best_quality:
+            best, best_quality = tag.lower(), quality
+    return best
+
+
+class EmailTemplates:
+    """
+    Email templates compiled once at startup.
+
+    Templates live in `templates/email/<locale>/<name>.html` and declare their
+    subject with `{% set subject = "..." %}`. Only the compiled templates are
+    kept: contexts carry one-time verification and reset links, which must
+    not outlive the request in memory. A bulk email with one context for
+    every recipient is rendered once.
+    """
+    def __init__(self, directory: Path = TEMPLATE_DIR, default_locale: str = "en"):
+        self.env = Environment(
+            loader=FileSystemLoader(str(directory)),
+            autoescape=select_autoescape(["html"]),
+            auto_reload=False,
+        )
+        self.directory = directory
+        self.default_locale = default_locale
+        self._templates: Dict[Tuple[str, str], Template] = {}
+
+    def precompile(self) -> None:
+        """
+        Compile every template of every locale
+        """
+        for path in sorted(self.directory.glob("*/*.html")):
+            locale, name = path.parent.name, path.stem
+            self._templates[(locale, name)] = self.env.get_template(f"{locale}/{path.name}")
+
+    @property
+    def locales(self) -> List[str]:
+        return sorted({locale for locale, _ in self._templates})
+
+    def get(self, name: str, locale: Optional[str] = None) -> Tuple[str, Template]:
+        """
+        Find the template for the locale, falling back to the base language and
+        then to the default locale.
+        Returns:
+            (locale, template) of the template found
+        """
+        if not self._templates:
+            self.precompile()
+        candidates = []
+        if locale:
+            candidates.append(locale.lower())
+            candidates.append(locale.lower().split("-")[0])
+        candidates.append(self.default_locale)
+        for candidate in candidates:
+            template = self._templates.get((candidate, name))
+            if template is not None:
+                return candidate, template
+        raise LookupError(f"Email template {name} not found")
+
+    def render(self, name: str, locale: Optional[str] = None, **context) -> Tuple[str, str]:
+        """
+        Render a template
+        Returns:
+            (subject, html body)
+        """
+        locale, template = self.get(name, locale)
+        module = template.make_module(context)
+        return str(getattr(module, "subject", "")), str(module)
+
+    def render_bulk(
+            self,
+            name: str,
+            recipients: Iterable[str],
+            locale: Optional[str] = None,
+            **context
+    ) -> Iterator[Tuple[str, str, str]]:
+        """
+        The email for each recipient, the context being the same for all of
+        them it is rendered once
+        Returns:
+            iterator of (recipient, subject, html body)
+        """
+        subject, body = self.render(name, locale, **context)
+        for recipient in recipients:
+            yield recipient, subject, body
+
+
+email_templates = EmailTemplates(default_locale=Config.MAIL_DEFAULT_LOCALE)
+
+
+async def queue_bulk_email(
+        session: AsyncSession,
+        recipients: Iterable[str],
+        name: str,
+        locale: Optional[str] = None,
+        chunk_size: int = 500,
+        **context
+) -> int:
+    """
+    Render a template for many recipients and insert the outbox rows in chunks.
+
+    Rows are inserted with core statements, so no ORM objects pile up in the
+    session and memory stays bounded by `chunk_size` whatever the number of
+    recipients. Nothing is committed here.
+    Returns:
+        number of emails queued
+    """
+    queued = 0
+    chunk = []
+    for recipient, subject, body in email_templates.render_bulk(name, recipients, locale, **context):
+        chunk.append({"recipient": recipient, "subject": subject, "body": body})
+        if len(chunk) >= chunk_size:
+            await session.execute(insert(EmailOutbox), chunk)
+            queued += len(chunk)
+            chunk = []
+    if chunk:
+        await session.execute(insert(EmailOutbox), chunk)
+        queued += len(chunk)
+    return queued
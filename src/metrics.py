@@ -0,0 +1,215 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from fastapi import APIRouter, Request, Response
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+
+from src.db.main import QueryStats, engine
+
+REDIS_DURATION = Histogram(
+    "redis_command_duration_seconds",
+    "Redis command latency",
+    ["command"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+
+REDIS_BATCH_SIZE = Histogram(
+    "redis_batch_size",
+    "Commands sent in one round trip by the Redis auto-batcher",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+
+
+class PoolCollector:
+    """Collect the SQLAlchemy connection pool state at scrape time"""
+    def collect(self):
+        pool = engine.sync_engine.pool
+        for name, documentation, value in (
+            ("db_pool_size", "Configured size of the connection pool", pool.size()),
+            ("db_pool_checked_out", "Connections currently checked out", pool.checkedout()),
+            ("db_pool_checked_in", "Idle connections in the pool", pool.checkedin()),
+            ("db_pool_overflow", "Connections opened above the pool size", pool.overflow()),
+        ):
+            yield GaugeMetricFamily(name, documentation, value=value)
+
+
+REGISTRY.register(PoolCollector())
+
+
+def route_template(request: Request) -> str:
+    """
+    Path template of the matched route, so /books/{book_id} is one series and
+    not one series per book.
+    """
+    route = request.scope.get("route")
+    return getattr(route, "path", "unmatched")
+
+
+class LoopHistogram:
+    """
+    Histogram without locking, to be used from the event loop thread only.
+    prometheus_client takes a lock on every observation which costs more than
+    everything else we record for a request.
+    """
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def buckets(self):
+        cumulative, total = [], 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            cumulative.append((str(bound) if bound != float("inf") else "+Inf", total))
+        return cumulative
+
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+class RouteMetrics:
+    __slots__ = ("duration", "db_queries", "db_duration", "statuses", "query_problems", "shed")
+
+    def __init__(self):
+        self.duration = LoopHistogram(DURATION_BUCKETS)
+        self.db_queries = LoopHistogram(QUERY_COUNT_BUCKETS)
+        self.db_duration = LoopHistogram(DURATION_BUCKETS)
+        self.statuses = {}
+        self.query_problems = {}
+        self.shed = {}
+
+
+_route_metrics = {}
+_in_flight = 0
+
+
+def request_started() -> None:
+    global _in_flight
+    _in_flight += 1
+
+
+def request_finished() -> None:
+    global _in_flight
+    _in_flight -= 1
+
+
+def _get_route_metrics(method: str, route: str) -> RouteMetrics:
+    metrics = _route_metrics.get((method, route))
+    if metrics is None:
+        metrics = _route_metrics[(method, route)] = RouteMetrics()
+    return metrics
+
+
+def record_request(method: str, route: str, status_code: int, duration: float, stats: QueryStats) -> None:
+    """
+    Record the duration, status code and database usage of one request
+    """
+    metrics = _get_route_metrics(method, route)
+    metrics.duration.observe(duration)
+    metrics.db_queries.observe(stats.count)
+    metrics.db_duration.observe(stats.duration)
+    metrics.statuses[status_code] = metrics.statuses.get(status_code, 0) + 1
+
+
+def record_query_problem(method: str, route: str, kind: str) -> None:
+    """
+    Count a request flagged by `query_problems` (n_plus_one or budget_exceeded)
+    """
+    problems = _get_route_metrics(method, route).query_problems
+    problems[kind] = problems.get(kind, 0) + 1
+
+
+def record_shed(method: str, route: str, reason: str) -> None:
+    """
+    Count a request rejected by admission control (queue_full, queue_timeout or queue_delay)
+    """
+    shed = _get_route_metrics(method, route).shed
+    shed[reason] = shed.get(reason, 0) + 1
+
+
+class RouteCollector:
+    """Export the per route metrics recorded by `record_request`"""
+    def collect(self):
+        duration = HistogramMetricFamily(
+            "http_request_duration_seconds",
+            "Request duration per route template",
+            labels=["method", "route"],
+        )
+        responses = CounterMetricFamily(
+            "http_responses",
+            "Responses per route template and status code",
+            labels=["method", "route", "status"],
+        )
+        db_queries = HistogramMetricFamily(
+            "db_queries_per_request",
+            "Number of SQL statements executed per request",
+            labels=["method", "route"],
+        )
+        db_duration = HistogramMetricFamily(
+            "db_duration_seconds_per_request",
+            "Time spent executing SQL statements per request",
+            labels=["method", "route"],
+        )
+        query_problems = CounterMetricFamily(
+            "db_query_problems",
+            "Requests flagged for N+1 queries or an exceeded query budget",
+            labels=["method", "route", "kind"],
+        )
+        shed = CounterMetricFamily(
+            "http_requests_shed",
+            "Requests rejected with a 503 by admission control",
+            labels=["method", "route", "reason"],
+        )
+        for (method, route), metrics in list(_route_metrics.items()):
+            duration.add_metric([method, route], metrics.duration.buckets(), metrics.duration.sum)
+            db_queries.add_metric([method, route], metrics.db_queries.buckets(), metrics.db_queries.sum)
+            db_duration.add_metric([method, route], metrics.db_duration.buckets(), metrics.db_duration.sum)
+            for status_code, count in list(metrics.statuses.items()):
+                responses.add_metric([method, route, str(status_code)], count)
+            for kind, count in list(metrics.query_problems.items()):
+                query_problems.add_metric([method, route, kind], count)
+            for reason, count in list(metrics.shed.items()):
+                shed.add_metric([method, route, reason], count)
+        yield GaugeMetricFamily(
+            "http_requests_in_flight", "Requests currently being processed", value=_in_flight
+        )
+        yield duration
+        yield responses
+        yield db_queries
+        yield db_duration
+        yield query_problems
+        yield shed
+
+
+REGISTRY.register(RouteCollector())
+
+
+@contextmanager
+def observe_redis(command: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        REDIS_DURATION.labels(command).observe(time.perf_counter() - start)
+
+
+metrics_router = APIRouter()
+
+
+@metrics_router.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(content=generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
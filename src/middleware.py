@@ -1,26 +1,91 @@
 from fastapi import FastAPI, Request, status
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 import time
 import logging
 
+from src.access_log import log_access
+from src.admission import AdmissionControlMiddleware
+from src.compression import CompressionMiddleware
+from src.config import Config
+from src.deadlines import DeadlineMiddleware
+from src.db.main import QueryStats, query_problems, query_stats
+from src.metrics import (
+    record_query_problem,
+    record_request,
+    request_finished,
+    request_started,
+    route_template,
+)
+from src.profiling import profiler
+from src.tracing import request_span
+
 logger = logging.getLogger("uvicorn.access")
 logger.disabled = True
 
+sql_logger = logging.getLogger("bookstore.sql")
+
 def register_middleware(app: FastAPI):
     """Register middleware for FastAPI app"""
+    # added first so it runs inside custom_logging and sees the complete
+    # response body, not the chunks re-streamed by the http middleware
+    app.add_middleware(CompressionMiddleware, minimum_size=Config.COMPRESSION_MIN_SIZE)
+
     @app.middleware("http")
     async def custom_logging(request: Request, next_call):
-        """Custom logging"""
-        start_time = time.time()
+        """Custom logging and request metrics"""
+        stats = QueryStats()
+        query_stats.set(stats)
+        request_started()
+        profile = profiler.start(request)
+        start_time = time.perf_counter()
 
-        response = await next_call(request) 
-        processing_time = time.time() - start_time
+        with request_span(request) as span:
+            try:
+                response = await next_call(request) 
+            finally:
+                request_finished()
+                if profile is not None:
+                    profiler.stop(profile, route_template(request))
+            processing_time = time.perf_counter() - start_time
+            route = route_template(request)
+            if span is not None:
+                span.update_name(f"{request.method} {route}")
+                span.set_attribute("http.route", route)
+                span.set_attribute("http.response.status_code", response.status_code)
+                span.set_attribute("db.query_count", stats.count)
 
-        message = f"{request.client.host}:{request.client.port} - {request.method} - {request.url.path} - {response.status_code} completed after {processing_time}s"
+        problems = query_problems(stats, route)
+        if problems:
+            for kind, detail in problems:
+                record_query_problem(request.method, route, kind)
+                sql_logger.warning("%s %s %s: %s", request.method, route, kind, detail)
+            if Config.SQL_STRICT_MODE:
+                response = JSONResponse(
+                    content={
+                        "message": "Query checks failed",
+                        "error_code": "query_problems",
+                        "problems": [{"kind": kind, "detail": detail} for kind, detail in problems],
+                    },
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                )
 
-        print(message)
+        if Config.SERVER_TIMING_ENABLED:
+            response.headers["Server-Timing"] = (
+                f'db;dur={stats.duration * 1000:.2f};desc="{stats.count} queries", '
+                f"app;dur={processing_time * 1000:.2f}"
+            )
+
+        record_request(request.method, route, response.status_code, processing_time, stats)
+        log_access(request, response, processing_time)
         return response
+
+    # outside custom_logging so that shed requests cost as little as possible,
+    # inside CORS so that browsers can read the 503
+    app.add_middleware(AdmissionControlMiddleware)
+    # the deadline includes the time spent waiting for admission
+    app.add_middleware(DeadlineMiddleware)
     
     # Add CORS middleware
     app.add_middleware(
@@ -0,0 +1,192 @@
+"""
+Sampling profiler for live requests.
+
+A profiled request sets a context variable; a SIGPROF timer interrupts the
+main thread every PROFILING_INTERVAL seconds of CPU time and the signal
+handler records the interrupted stack if the running task belongs to a
+profiled request. The timer only runs while at least one profiled request is
+in flight, so unprofiled requests pay a single random() call.
+
+Stacks are aggregated per route template in the collapsed format understood
+by flamegraph.pl and speedscope ("frame;frame;frame count").
+"""
+import os
+import random
+import signal
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import PlainTextResponse
+
+from src.auth.dependencies import RoleChecker
+from src.config import Config
+
+PROFILE_HEADER = "x-profile"
+
+
+class RequestProfile:
+    __slots__ = ("samples",)
+
+    def __init__(self):
+        self.samples: Dict[tuple, int] = {}
+
+
+_current_profile: ContextVar[Optional[RequestProfile]] = ContextVar("current_profile", default=None)
+
+
+def _frame_label(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def _on_sigprof(signum, frame) -> None:
+    profile = _current_profile.get()
+    if profile is None:
+        return
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        if code.co_name == "_run" and code.co_filename.endswith(os.path.join("asyncio", "events.py")):
+            break
+        stack.append(code)
+        frame = frame.f_back
+    key = tuple(reversed(stack))
+    profile.samples[key] = profile.samples.get(key, 0) + 1
+
+
+class SamplingProfiler:
+    """
+    Decides which requests to profile, runs the timer while they are in flight
+    and keeps a rolling aggregate of their stacks per route template.
+    """
+    def __init__(self, interval: float, sample_rate: float, window: int):
+        self.interval = interval
+        self.sample_rate = sample_rate
+        self.window = window
+        self.installed = False
+        self._active = 0
+        self._labels: Dict[object, str] = {}
+        self._window_start = time.monotonic()
+        self._current: Dict[str, Counter] = {}
+        self._previous: Dict[str, Counter] = {}
+
+    def install(self) -> None:
+        """
+        Install the signal handler, it has to be called from the main thread
+        """
+        if not hasattr(signal, "SIGPROF") or threading.current_thread() is not threading.main_thread():
+            return
+        signal.signal(signal.SIGPROF, _on_sigprof)
+        self.installed = True
+
+    def uninstall(self) -> None:
+        if self.installed:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+            self.installed = False
+
+    def should_profile(self, request: Request) -> bool:
+        if not self.installed:
+            return False
+        token = Config.PROFILING_TOKEN
+        if token and request.headers.get(PROFILE_HEADER) == token:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start(self, request: Request) -> Optional[RequestProfile]:
+        """
+        Start profiling the request if it is sampled
+        Returns:
+            the profile to pass to `stop`, None when the request is not profiled
+        """
+        if not self.should_profile(request):
+            return None
+        profile = RequestProfile()
+        _current_profile.set(profile)
+        self._active += 1
+        if self._active == 1:
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        return profile
+
+    def stop(self, profile: RequestProfile, route: str) -> None:
+        self._active -= 1
+        if self._active == 0:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+        _current_profile.set(None)
+
+        self._rotate()
+        stacks = self._current.setdefault(route, Counter())
+        for key, count in profile.samples.items():
+            stacks[";".join(self._label(code) for code in key)] += count
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = _frame_label(code)
+        return label
+
+    def _rotate(self) -> None:
+        now = time.monotonic()
+        if now - self._window_start >= self.window:
+            self._previous = self._current if now - self._window_start < 2 * self.window else {}
+            self._current = {}
+            self._window_start = now
+
+    def aggregate(self, route: Optional[str] = None) -> Counter:
+        """
+        Stacks sampled during the last one to two windows, for one route or all
+        """
+        self._rotate()
+        total = Counter()
+        for window in (self._previous, self._current):
+            for name, stacks in window.items():
+                if route is None or name == route:
+                    total.update(stacks)
+        return total
+
+    def routes(self) -> Dict[str, int]:
+        self._rotate()
+        counts: Dict[str, int] = {}
+        for window in (self._previous, self._current):
+            for name, stacks in window.items():
+                counts[name] = counts.get(name, 0) + sum(stacks.values())
+        return counts
+
+
+profiler = SamplingProfiler(
+    interval=Config.PROFILING_INTERVAL,
+    sample_rate=Config.PROFILING_SAMPLE_RATE,
+    window=Config.PROFILING_WINDOW_SECONDS
+)
+
+profiling_router = APIRouter()
+admin_role_checker = Depends(RoleChecker(["admin"]))
+
+
+@profiling_router.get("/", dependencies=[admin_role_checker])
+async def get_profiled_routes():
+    """
+    Number of samples collected per route template
+    """
+    return {
+        "interval": profiler.interval,
+        "sample_rate": profiler.sample_rate,
+        "window_seconds": profiler.window,
+        "routes": profiler.routes(),
+    }
+
+
+@profiling_router.get("/flamegraph", dependencies=[admin_role_checker])
+async def download_flamegraph(route: Optional[str] = None):
+    """
+    Collapsed stacks of a route (or of all routes), ready for flamegraph.pl or speedscope
+    """
+    stacks = profiler.aggregate(route)
+    content = "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+    return PlainTextResponse(
+        content,
+        headers={"Content-Disposition": 'attachment; filename="profile.folded"'}
+    )
@@ -0,0 +1,195 @@
+"""
+Rate limiting.
+
+Limits are token buckets kept in Redis (see `take_tokens`), keyed by route
+and client ip, and for the routes taking an email address also by route and
+account, so that a credential stuffing run spread over many ips still hits
+the per account limit.
+
+Each worker keeps some state in process to avoid a Redis round trip:
+- a caller denied by Redis is denied locally until its Retry-After has
+  passed, tokens can only be taken in the meantime so the answer cannot change
+- a caller far below a generous limit is granted a few extra tokens by Redis
+  that the worker spends over the next RATE_LIMIT_LEASE_SECONDS
+
+When Redis cannot be reached the buckets are kept per worker instead.
+
+Behind a reverse proxy the client ip is taken from X-Forwarded-For, for
+requests coming from TRUSTED_PROXIES only: anyone else could send the
+header to get a fresh bucket.
+"""
+import ipaddress
+import logging
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import NamedTuple, Optional
+
+from fastapi import Request
+from redis.exceptions import RedisError
+
+from src.config import Config
+from src.db.redis import take_tokens
+from src.errors import RateLimitExceeded
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+class Limit(NamedTuple):
+    capacity: int
+    rate: float
+
+
+@lru_cache(maxsize=None)
+def parse_limit(limit: str) -> Limit:
+    """
+    Parse a limit such as "5/minute"
+    Returns:
+        Limit with the bucket capacity and the tokens added per second
+    """
+    count, _, period = limit.partition("/")
+    count = int(count)
+    return Limit(capacity=count, rate=count / PERIODS[period.strip().rstrip("s")])
+
+
+class LocalBucket:
+    """
+    What a worker knows about one bucket: the tokens leased from Redis, and
+    the bucket kept in process while Redis cannot be reached
+    """
+    __slots__ = ("leased", "lease_expires", "blocked_until", "fallback_tokens", "fallback_updated")
+
+    def __init__(self):
+        self.leased = 0
+        self.lease_expires = 0.0
+        self.blocked_until = 0.0
+        self.fallback_tokens = 0.0
+        self.fallback_updated = 0.0
+
+
+class TokenBuckets:
+    def __init__(self, prefetch: int, lease_seconds: float, max_keys: int):
+        self.prefetch = prefetch
+        self.lease_seconds = lease_seconds
+        self.max_keys = max_keys
+        self._local: "OrderedDict[str, LocalBucket]" = OrderedDict()
+
+    def _bucket(self, key: str) -> LocalBucket:
+        bucket = self._local.get(key)
+        if bucket is None:
+            bucket = self._local[key] = LocalBucket()
+            if len(self._local) > self.max_keys:
+                self._local.popitem(last=False)
+        else:
+            self._local.move_to_end(key)
+        return bucket
+
+    async def hit(self, key: str, limit: Limit) -> None:
+        """
+        Take a token for `key`
+        Raises:
+            RateLimitExceeded: when the bucket is empty
+        """
+        now = time.monotonic()
+        bucket = self._bucket(key)
+        if bucket.blocked_until > now:
+            raise RateLimitExceeded(bucket.blocked_until - now)
+        if bucket.leased >= 1 and bucket.lease_expires > now:
+            bucket.leased -= 1
+            return
+
+        try:
+            granted, retry_after = await take_tokens(key, limit.capacity, limit.rate, self.prefetch)
+        except RedisError as exc:
+            logger.warning("rate limiting %s in process, redis failed: %s", key, exc)
+            bucket.leased = 0
+            granted, retry_after = self._take_local(bucket, limit, now)
+        else:
+            bucket.leased = max(granted - 1, 0)
+            bucket.lease_expires = now + self.lease_seconds
+            # a later outage starts from a full bucket, Redis counted meanwhile
+            bucket.fallback_updated = 0.0
+
+        if not granted:
+            bucket.blocked_until = now + retry_after
+            raise RateLimitExceeded(retry_after)
+
+    def _take_local(self, bucket: LocalBucket, limit: Limit, now: float):
+        if bucket.fallback_updated:
+            elapsed = now - bucket.fallback_updated
+            bucket.fallback_tokens = min(limit.capacity, bucket.fallback_tokens + elapsed * limit.rate)
+        else:
+            bucket.fallback_tokens = limit.capacity
+        bucket.fallback_updated = now
+        if bucket.fallback_tokens >= 1:
+            bucket.fallback_tokens -= 1
+            return 1, 0.0
+        return 0, (1 - bucket.fallback_tokens) / limit.rate
+
+
+token_buckets = TokenBuckets(
+    prefetch=Config.RATE_LIMIT_PREFETCH,
+    lease_seconds=Config.RATE_LIMIT_LEASE_SECONDS,
+    max_keys=Config.RATE_LIMIT_LOCAL_KEYS,
+)
+
+
+@lru_cache(maxsize=1)
+def _trusted_networks(proxies: tuple) -> tuple:
+    return tuple(ipaddress.ip_network(proxy, strict=False) for proxy in proxies)
+
+
+def _is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in _trusted_networks(tuple(Config.TRUSTED_PROXIES)))
+
+
+def client_ip(request: Request) -> str:
+    """
+    Address of the client: the peer, or when the peer is a trusted proxy the
+    last address of X-Forwarded-For that is not one of our proxies (the ones
+    before it are whatever the client sent)
+    """
+    if not request.client:
+        return "unknown"
+    address = request.client.host
+    if not _is_trusted_proxy(address):
+        return address
+    forwarded = request.headers.get("x-forwarded-for", "")
+    for hop in reversed([hop.strip() for hop in forwarded.split(",") if hop.strip()]):
+        address = hop
+        if not _is_trusted_proxy(hop):
+            break
+    return address
+
+
+class RateLimiter:
+    """
+    Dependency limiting a route per client ip, and per account when
+    `account_field` names the email field of the request body.
+    """
+    def __init__(self, name: str, account_field: Optional[str] = None):
+        self.name = name
+        self.account_field = account_field
+
+    async def __call__(self, request: Request) -> None:
+        if not Config.RATE_LIMIT_ENABLED:
+            return
+        limit = Config.RATE_LIMITS.get(self.name)
+        if limit:
+            await token_buckets.hit(f"ratelimit:{self.name}:ip:{client_ip(request)}", parse_limit(limit))
+
+        account_limit = Config.RATE_LIMITS.get(f"{self.name}_account")
+        if self.account_field and account_limit:
+            # the body has already been read and validated by FastAPI
+            body = await request.json()
+            account = body.get(self.account_field) if isinstance(body, dict) else None
+            if isinstance(account, str):
+                await token_buckets.hit(
+                    f"ratelimit:{self.name}:account:{account.strip().lower()}", parse_limit(account_limit)
+                )
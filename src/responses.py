@@ -0,0 +1,185 @@
+"""
+Response serialization.
+
+Responses are json by default. Clients sending `Accept: application/msgpack`
+get MessagePack instead, with UUIDs as ext type 1 (the 16 raw bytes) and
+datetimes as the msgpack timestamp ext type. The models store naive local
+times (`datetime.now()`), so naive datetimes are taken in the zone of the
+server to pack the right instant. Routers using `NegotiatedRoute` also
+accept msgpack request bodies.
+"""
+import uuid
+from contextvars import ContextVar
+from datetime import date, datetime
+from typing import Any, AsyncIterator, Callable
+
+import msgpack
+import orjson
+from fastapi import Request, Response, status
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.routing import APIRoute
+from pydantic import TypeAdapter
+
+MSGPACK = "application/msgpack"
+MSGPACK_TYPES = (MSGPACK, "application/x-msgpack")
+UUID_EXT_TYPE = 1
+
+_wants_msgpack: ContextVar[bool] = ContextVar("wants_msgpack", default=False)
+
+
+def _msgpack_default(obj: Any) -> Any:
+    if isinstance(obj, uuid.UUID):
+        return msgpack.ExtType(UUID_EXT_TYPE, obj.bytes)
+    if isinstance(obj, datetime):
+        if obj.tzinfo is None:
+            obj = obj.astimezone()
+        return msgpack.Timestamp.from_datetime(obj)
+    if isinstance(obj, date):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not msgpack serializable")
+
+
+def _msgpack_ext_hook(code: int, data: bytes) -> Any:
+    if code == UUID_EXT_TYPE:
+        return uuid.UUID(bytes=data)
+    return msgpack.ExtType(code, data)
+
+
+def packb(content: Any) -> bytes:
+    return msgpack.packb(content, default=_msgpack_default, datetime=False)
+
+
+def unpackb(data: bytes) -> Any:
+    return msgpack.unpackb(data, ext_hook=_msgpack_ext_hook, timestamp=3)
+
+
+def prefers_msgpack(accept: str) -> bool:
+    """
+    True when the Accept header ranks msgpack at least as high as json
+    """
+    if not accept or "msgpack" not in accept:
+        return False
+    msgpack_quality, json_quality = 0.0, 0.0
+    for media_range in accept.split(","):
+        media_type, _, params = media_range.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        media_type = media_type.strip().lower()
+        if media_type in MSGPACK_TYPES:
+            msgpack_quality = max(msgpack_quality, quality)
+        elif media_type in ("application/json", "application/*", "*/*"):
+            json_quality = max(json_quality, quality)
+    return msgpack_quality > 0 and msgpack_quality >= json_quality
+
+
+class RawJSONResponse(Response):
+    """Response for content that is already serialized json bytes"""
+    media_type = "application/json"
+
+
+class EventStreamResponse(StreamingResponse):
+    """
+    Server-Sent Events, kept out of proxy buffers. `on_close` runs however
+    the stream ends, even when the client leaves before the first event.
+    """
+    media_type = "text/event-stream"
+
+    def __init__(self, content: AsyncIterator[bytes], on_close: Callable[[], None]):
+        super().__init__(content, headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.on_close()
+
+
+class NegotiatedResponse(ORJSONResponse):
+    """
+    Default response class: orjson, or msgpack when the client asked for it
+    """
+    def __init__(self, content: Any = None, status_code: int = 200, headers=None, media_type=None, background=None):
+        if media_type is None and _wants_msgpack.get():
+            media_type = MSGPACK
+        super().__init__(content, status_code, headers, media_type, background)
+
+    def render(self, content: Any) -> bytes:
+        if self.media_type == MSGPACK:
+            return packb(content)
+        return super().render(content)
+
+
+def _msgpack_response(content: Any, status_code: int) -> Response:
+    return Response(content=packb(content), status_code=status_code, media_type=MSGPACK)
+
+
+def rows_response(rows: Any, status_code: int = status.HTTP_200_OK) -> Response:
+    """
+    Serialize plain rows (dicts, lists, UUIDs, datetimes) straight to bytes,
+    skipping ORM hydration and pydantic validation.
+    """
+    if _wants_msgpack.get():
+        return _msgpack_response(rows, status_code)
+    return RawJSONResponse(content=orjson.dumps(rows), status_code=status_code)
+
+
+def model_response(adapter: TypeAdapter, obj: Any, status_code: int = status.HTTP_200_OK) -> Response:
+    """
+    Validate ORM objects once against a precompiled adapter and dump them
+    to json bytes in pydantic-core, instead of letting FastAPI validate,
+    convert to python objects and encode again.
+    """
+    validated = adapter.validate_python(obj, from_attributes=True)
+    if _wants_msgpack.get():
+        return _msgpack_response(adapter.dump_python(validated), status_code)
+    return RawJSONResponse(content=adapter.dump_json(validated), status_code=status_code)
+
+
+def sqlmodel_response(obj: Any, status_code: int = status.HTTP_200_OK) -> Response:
+    """
+    Dump a table model with its own compiled serializer
+    """
+    if _wants_msgpack.get():
+        return _msgpack_response(obj.model_dump(), status_code)
+    return RawJSONResponse(content=obj.model_dump_json(), status_code=status_code)
+
+
+class MsgPackRequest(Request):
+    """Request whose body is msgpack, decoded where FastAPI expects json"""
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            self._json = unpackb(await self.body())
+        return self._json
+
+
+class NegotiatedRoute(APIRoute):
+    """
+    Route picking the response format from the Accept header and decoding
+    msgpack request bodies.
+    """
+    def get_route_handler(self) -> Callable:
+        original_route_handler = super().get_route_handler()
+
+        async def negotiated_route_handler(request: Request) -> Response:
+            token = _wants_msgpack.set(prefers_msgpack(request.headers.get("accept", "")))
+            try:
+                content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+                if content_type in MSGPACK_TYPES:
+                    scope = dict(request.scope)
+                    scope["headers"] = [
+                        (name, b"application/json" if name == b"content-type" else value)
+                        for name, value in request.scope["headers"]
+                    ]
+                    request = MsgPackRequest(scope, request.receive)
+                return await original_route_handler(request)
+            finally:
+                _wants_msgpack.reset(token)
+
+        return negotiated_route_handler
@@ -0,0 +1,243 @@
+"""
+Review partition maintenance.
+
+`reviews` is range partitioned by month of `created_at`, one table per
+month named reviews_pYYYY_MM, plus reviews_default for anything no partition
+covers. This job keeps REVIEW_PARTITION_MONTHS_AHEAD months of partitions
+ready, and archives the partitions older than REVIEW_ARCHIVE_AFTER_MONTHS:
+the partition is detached, copied as compressed CSV to REVIEW_ARCHIVE_DIR
+and dropped. Its indexes go with it, so the indexes reads use only cover
+the months kept online however long the history gets.
+
+    python -m src.review_archive          # once, from cron
+    python -m src.review_archive --forever
+
+Archiving is restartable: a partition detached by a run that failed before
+dropping it is picked up again by the next run, and its file is written
+under a temporary name and only renamed once complete.
+"""
+import argparse
+import asyncio
+import gzip
+import logging
+import os
+import re
+from datetime import date, datetime, time
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from src.config import Config
+from src.db.main import engine
+from src.tracing import setup_tracing, shutdown_tracing, traced
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+PARTITION_NAME = re.compile(r"^reviews_p(\d{4})_(\d{2})$")
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def add_months(day: date, months: int) -> date:
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"reviews_p{month.year:04d}_{month.month:02d}"
+
+
+def partition_month(name: str) -> Optional[date]:
+    match = PARTITION_NAME.match(name)
+    return date(int(match[1]), int(match[2]), 1) if match else None
+
+
+async def create_partition(conn: AsyncConnection, month: date) -> None:
+    """
+    Create the partition of a month. Postgres refuses it while reviews_default
+    holds rows of that month (the job was paused longer than
+    REVIEW_PARTITION_MONTHS_AHEAD, or a review is dated in the future): the
+    default partition is then detached, the partition created, the rows
+    moved to it and the default partition attached again.
+    """
+    name = partition_name(month)
+    # created_at is a timestamp, asyncpg wants datetimes for it
+    bounds = {"start": datetime.combine(month, time()), "end": datetime.combine(add_months(month, 1), time())}
+    create = text(
+        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF reviews "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    )
+    in_month = "created_at >= :start AND created_at < :end"
+    stranded = await conn.execute(text(f"SELECT EXISTS (SELECT 1 FROM reviews_default WHERE {in_month})"), bounds)
+    if not stranded.scalar():
+        await conn.execute(create)
+        return
+
+    logger.warning("Moving the reviews of %s out of reviews_default", month.strftime("%Y-%m"))
+    # detaching locks the whole table, give up rather than queue reads behind it
+    await conn.execute(text("SET LOCAL lock_timeout = '5s'"))
+    await conn.execute(text("ALTER TABLE reviews DETACH PARTITION reviews_default"))
+    await conn.execute(create)
+    await conn.execute(text(f"INSERT INTO {name} SELECT * FROM reviews_default WHERE {in_month}"), bounds)
+    await conn.execute(text(f"DELETE FROM reviews_default WHERE {in_month}"), bounds)
+    await conn.execute(text("ALTER TABLE reviews ATTACH PARTITION reviews_default DEFAULT"))
+
+
+async def ensure_partitions(conn: AsyncConnection, first: date, last: date) -> List[str]:
+    """
+    Create the monthly partitions from the month of `first` to the month of
+    `last` included that do not exist yet. A month that fails is logged and
+    skipped, the next run tries it again.
+    Returns:
+        the partitions created
+    """
+    existing = set(await attached_partitions(conn))
+    created = []
+    month = month_start(first)
+    while month <= last:
+        name = partition_name(month)
+        if name not in existing:
+            try:
+                async with conn.begin_nested():
+                    await create_partition(conn, month)
+                created.append(name)
+            except SQLAlchemyError:
+                logger.exception("Creating the review partition %s failed", name)
+        month = add_months(month, 1)
+    return created
+
+
+async def default_months(conn: AsyncConnection) -> List[date]:
+    """
+    Months of the reviews that fell in reviews_default for lack of a partition
+    """
+    result = await conn.execute(text(
+        "SELECT DISTINCT date_trunc('month', created_at)::date FROM reviews_default ORDER BY 1"
+    ))
+    return list(result.scalars())
+
+
+async def attached_partitions(conn: AsyncConnection) -> List[str]:
+    result = await conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'reviews'::regclass"
+    ))
+    return [name for name in result.scalars()]
+
+
+async def detached_partitions(conn: AsyncConnection) -> List[str]:
+    """
+    Monthly review tables no longer attached, left by an archive run that did not finish
+    """
+    result = await conn.execute(text(
+        "SELECT c.relname FROM pg_class c "
+        "WHERE c.relkind = 'r' AND c.relname ~ '^reviews_p[0-9]{4}_[0-9]{2}$' AND NOT c.relispartition"
+    ))
+    return [name for name in result.scalars()]
+
+
+def archive_path(name: str) -> str:
+    extension = "csv.zst" if zstandard is not None else "csv.gz"
+    return os.path.join(Config.REVIEW_ARCHIVE_DIR, f"{name}.{extension}")
+
+
+def open_archive(path: str):
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=10).stream_writer(open(path, "wb"), closefd=True)
+    return gzip.open(path, "wb")
+
+
+async def copy_out(name: str, path: str) -> None:
+    """
+    Write the rows of a detached partition to `path` as compressed CSV
+    """
+    partial = f"{path}.partial"
+    async with engine.begin() as conn:
+        # a month of reviews takes longer than the default statement timeout
+        await conn.execute(text("SET LOCAL statement_timeout = 0"))
+        raw = await conn.get_raw_connection()
+        with open_archive(partial) as out:
+            async def write(chunk: bytes) -> None:
+                out.write(chunk)
+            await raw.driver_connection.copy_from_table(name, output=write, format="csv", header=True)
+    os.replace(partial, path)
+
+
+async def archive_partition(name: str) -> str:
+    """
+    Detach a partition, save it to REVIEW_ARCHIVE_DIR and drop it
+    Returns:
+        the archive path
+    """
+    path = archive_path(name)
+    with traced("archive review partition", {"partition": name}):
+        async with engine.begin() as conn:
+            if name in await attached_partitions(conn):
+                # detaching locks the whole table, give up rather than queue reads behind it
+                await conn.execute(text("SET LOCAL lock_timeout = '5s'"))
+                await conn.execute(text(f"ALTER TABLE reviews DETACH PARTITION {name}"))
+        await copy_out(name, path)
+        async with engine.begin() as conn:
+            await conn.execute(text(f"DROP TABLE IF EXISTS {name}"))
+    return path
+
+
+async def run_once(today: Optional[date] = None) -> dict:
+    """
+    Create the coming partitions and archive the old ones
+    Returns:
+        the partitions created and archived
+    """
+    today = today or datetime.now().date()
+    cutoff = add_months(month_start(today), -Config.REVIEW_ARCHIVE_AFTER_MONTHS)
+    async with engine.begin() as conn:
+        created = await ensure_partitions(
+            conn, today, add_months(month_start(today), Config.REVIEW_PARTITION_MONTHS_AHEAD)
+        )
+        # months missed while the job was not running, they get archived like the others
+        for month in await default_months(conn):
+            created += await ensure_partitions(conn, month, month)
+        candidates = await attached_partitions(conn) + await detached_partitions(conn)
+
+    os.makedirs(Config.REVIEW_ARCHIVE_DIR, exist_ok=True)
+    archived = []
+    for name in sorted(set(candidates)):
+        month = partition_month(name)
+        if month is not None and month < cutoff:
+            logger.info("Archiving %s to %s", name, await archive_partition(name))
+            archived.append(name)
+    return {"created": created, "archived": archived}
+
+
+async def main(forever: bool = False) -> None:
+    logging.basicConfig(level=logging.INFO)
+    setup_tracing("bookstore-review-archive")
+    try:
+        while True:
+            try:
+                logger.info("Review partitions: %s", await run_once())
+            except Exception:
+                if not forever:
+                    raise
+                logger.exception("Review partition maintenance failed")
+            if not forever:
+                break
+            await asyncio.sleep(Config.REVIEW_ARCHIVE_INTERVAL)
+    finally:
+        await engine.dispose()
+        shutdown_tracing()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--forever", action="store_true", help="run every REVIEW_ARCHIVE_INTERVAL seconds")
+    asyncio.run(main(parser.parse_args().forever))
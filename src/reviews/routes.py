@@ -5,10 +5,11 @@ from src.db.main import get_session
 from src.db.models import User
 from src.auth.dependencies import RoleChecker, get_current_user
 from src.errors import ReviewNotFound
+from src.responses import NegotiatedRoute, model_response, rows_response
 from .service import ReviewService
-from .schemas import ReviewCreateModel, ReviewModel
+from .schemas import ReviewCreateModel, ReviewModel, review_adapter
 
-review_routes = APIRouter()
+review_routes = APIRouter(route_class=NegotiatedRoute)
 review_service = ReviewService()
 admin_role_checker = Depends(RoleChecker(["admin"]))
 user_role_checker = Depends(RoleChecker(["user", "admin"]))
@@ -18,19 +19,19 @@ async def get_all_reviews(session: AsyncSession = Depends(get_session)):
     """
     Get all reviews
     """
-    books = await review_service.get_all_review(session)
+    reviews = await review_service.get_all_review_rows(session)
     
-    return books
+    return rows_response(reviews)
 @review_routes.get("/{review_uid}", dependencies=[user_role_checker])
 async def get_reviews(review_uid: str, session: AsyncSession = Depends(get_session)):
     """
     Get single reviews by id
     """
-    books = await review_service.get_review(review_uid, session)
-    if not books:
-        ReviewNotFound()
+    review = await review_service.get_review(review_uid, session)
+    if not review:
+        raise ReviewNotFound()
     
-    return books
+    return model_response(review_adapter, review)
 
 @review_routes.post("/book/{book_uid}", dependencies=[user_role_checker])
 async def create_review(
@@ -48,7 +49,7 @@ async def create_review(
         session
         )
     
-    return new_review
+    return model_response(review_adapter, new_review)
 
 @review_routes.delete(
         "/{review_uid}", 
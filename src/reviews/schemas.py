@@ -1,8 +1,8 @@
 import uuid
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter
 
 
 class ReviewModel(BaseModel):
@@ -16,4 +16,8 @@ class ReviewModel(BaseModel):
 
 class ReviewCreateModel(BaseModel):
     rating: int = Field(lt=5)
-    review_text: str
\ No newline at end of file
+    review_text: str
+
+
+review_adapter = TypeAdapter(ReviewModel)
+review_list_adapter = TypeAdapter(List[ReviewModel])
@@ -1,7 +1,9 @@
 import logging
+from datetime import datetime
 
 from fastapi import status
 from fastapi.exceptions import HTTPException
+from sqlalchemy import func
 from sqlmodel import desc, select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
@@ -10,6 +12,7 @@ from src.books.service import BookService
 from src.db.models import Review
 
 from .schemas import ReviewCreateModel
+from .stream import publish_review
 
 book_service = BookService()
 user_service = UserService()
@@ -41,6 +44,12 @@ class ReviewService:
             session.add(new_review)
             await session.commit()
 
+            try:
+                await publish_review(new_review)
+            except Exception:
+                # the review is saved, stream clients get it when they reconnect
+                logging.warning("publishing review %s failed", new_review.uid, exc_info=True)
+
             return new_review
         
         except Exception as e:
@@ -52,33 +61,89 @@ class ReviewService:
         
     async def get_review(self, review_uid: str, session: AsyncSession):
 
-        statement = select(Review).where(Review.uid==review_uid)
+        statement = select(Review).where(Review.uid==review_uid, Review.deleted_at.is_(None))
         
         result = await session.exec(statement)
         
         return result.first()
     
-    async def get_all_review(self, review_uid: str, session: AsyncSession):
+    async def get_all_review(self, session: AsyncSession):
 
-        statement = select(Review).order_by(desc(Review.created_at))
+        statement = select(Review).where(Review.deleted_at.is_(None)).order_by(desc(Review.created_at))
         
         result = await session.exec(statement)
         
         return result.all()
+
+    async def get_all_review_rows(self, session: AsyncSession):
+        """
+        All the reviews as plain dicts shaped like ReviewModel, newest first
+        """
+        statement = select(
+            Review.uid, Review.rating, Review.review_text,
+            Review.user_uid, Review.book_uid, Review.created_at
+        ).where(Review.deleted_at.is_(None)).order_by(desc(Review.created_at))
+
+        result = await session.exec(statement)
+
+        return [row._asdict() for row in result.all()]
+
+    async def get_book_review_rows_since(self, book_uid: str, since: datetime, limit: int, session: AsyncSession):
+        """
+        Reviews of a book created after `since`, oldest first, as dicts shaped like ReviewModel
+        """
+        statement = select(
+            Review.uid, Review.rating, Review.review_text,
+            Review.user_uid, Review.book_uid, Review.created_at
+        ).where(
+            Review.book_uid == book_uid, Review.deleted_at.is_(None), Review.created_at > since
+        ).order_by(Review.created_at).limit(limit)
+
+        result = await session.exec(statement)
+
+        return [row._asdict() for row in result.all()]
     
+    async def get_review_rows_for_books(self, book_uids: list, per_book: int, session: AsyncSession):
+        """
+        The newest `per_book` reviews of each book, in one query
+
+        Returns:
+            Dict of book uid to its reviews as dicts shaped like ReviewModel, newest first
+        """
+        rank = func.row_number().over(
+            partition_by=Review.book_uid, order_by=desc(Review.created_at)
+        ).label("rank")
+        ranked = select(
+            Review.uid, Review.rating, Review.review_text,
+            Review.user_uid, Review.book_uid, Review.created_at, rank
+        ).where(Review.book_uid.in_(book_uids), Review.deleted_at.is_(None)).subquery()
+        statement = (
+            select(*(column for column in ranked.c if column.name != "rank"))
+            .where(ranked.c.rank <= per_book)
+            .order_by(ranked.c.book_uid, ranked.c.rank)
+        )
+
+        result = await session.exec(statement)
+
+        reviews = {book_uid: [] for book_uid in book_uids}
+        for row in result.all():
+            reviews[row.book_uid].append(row._asdict())
+        return reviews
+
     async def delete_review_from_book(self, review_uid: str, user_email:str, session: AsyncSession):
         
         review = await self.get_review(review_uid, session)
 
         user = await user_service.get_user_by_email(user_email, session)
 
-        if not review or (review.user != user):
+        if not review or user is None or review.user_uid != user.uid:
             raise HTTPException(
                 detail="Review can not be deleted",
                 status_code=status.HTTP_403_FORBIDDEN
             )
-        
-        session.delete(review)
+
+        # soft delete, the row leaves the database with its partition (src/review_archive.py)
+        review.deleted_at = datetime.now()
 
         await session.commit()
 
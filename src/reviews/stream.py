@@ -0,0 +1,209 @@
+"""
+New reviews pushed to clients as Server-Sent Events.
+
+`ReviewService.add_review_to_book` publishes every new review, already
+formatted as an event, on the Redis channel of its book. Each API worker
+keeps a single pattern subscription to all the review channels and copies
+the events of a book to the queue of every client following it, so a review
+is serialized once however many clients receive it.
+
+Event ids are the creation time and uid of the review. A client reconnecting
+with Last-Event-ID gets the reviews created since from the database, up to
+SSE_RESUME_LIMIT; further behind it gets a `reset` event telling it to
+reload the book. Clients are disconnected, and so resume this way, when
+they fall SSE_CLIENT_QUEUE_SIZE events behind or when the worker loses its
+subscription.
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+from prometheus_client import REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+
+from src.config import Config
+from src.db import redis
+from src.errors import StreamUnavailable
+
+from .schemas import review_adapter
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT = b": heartbeat\n\n"
+RESET_EVENT = b"event: reset\ndata: {}\n\n"
+
+
+def review_event_id(created_at: datetime, uid) -> str:
+    return f"{created_at.isoformat()}/{uid}"
+
+
+def parse_event_id(event_id: str) -> Optional[datetime]:
+    """
+    Creation time of the review an event id points to, None if it is not one of ours
+    """
+    try:
+        return datetime.fromisoformat(event_id.partition("/")[0])
+    except ValueError:
+        return None
+
+
+def review_event(review) -> bytes:
+    """
+    A review, ORM object or dict shaped like ReviewModel, as an SSE event
+    """
+    validated = review_adapter.validate_python(review, from_attributes=True)
+    event_id = review_event_id(validated.created_at, validated.uid)
+    return f"id: {event_id}\nevent: review\ndata: ".encode() + review_adapter.dump_json(validated) + b"\n\n"
+
+
+def event_id_of(event: bytes) -> bytes:
+    return event[4:event.index(b"\n")]
+
+
+async def publish_review(review) -> None:
+    await redis.publish_review_event(str(review.book_uid), review_event(review))
+
+
+class ReviewBroadcaster:
+    """
+    The review subscription of this worker and the queues of its clients
+    """
+    def __init__(self, max_connections: int = Config.SSE_MAX_CONNECTIONS,
+                 queue_size: int = Config.SSE_CLIENT_QUEUE_SIZE):
+        self.max_connections = max_connections
+        self.queue_size = queue_size
+        self.connections = 0
+        self._clients: Dict[str, Set[asyncio.Queue]] = {}
+        self._listener: Optional[asyncio.Task] = None
+        self._ready = asyncio.Event()
+
+    async def subscribe(self, book_uid: str, timeout: float = 2) -> asyncio.Queue:
+        """
+        Register a client of the events of a book
+        Returns:
+            the queue the events are put in, None once the client must reconnect
+        Raises:
+            StreamUnavailable: too many clients, or no subscription within `timeout` seconds
+        """
+        if self.connections >= self.max_connections:
+            raise StreamUnavailable()
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        self._clients.setdefault(book_uid, set()).add(queue)
+        self.connections += 1
+        try:
+            # events published before the subscription is confirmed would be lost
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.unsubscribe(book_uid, queue)
+            raise StreamUnavailable()
+        except BaseException:
+            self.unsubscribe(book_uid, queue)
+            raise
+        return queue
+
+    def unsubscribe(self, book_uid: str, queue: asyncio.Queue) -> None:
+        self.connections -= 1
+        clients = self._clients.get(book_uid)
+        if clients is not None:
+            clients.discard(queue)
+            if not clients:
+                del self._clients[book_uid]
+
+    def _disconnect(self, book_uid: str, queue: asyncio.Queue) -> None:
+        self._clients[book_uid].discard(queue)
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    def _dispatch(self, channel: bytes, event: bytes) -> None:
+        book_uid = channel.decode().partition(":")[2]
+        for queue in list(self._clients.get(book_uid, ())):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self._disconnect(book_uid, queue)
+
+    async def _listen(self) -> None:
+        while True:
+            pubsub = redis.create_pubsub()
+            try:
+                await pubsub.psubscribe(redis.REVIEW_CHANNELS)
+                while True:
+                    message = await pubsub.get_message(timeout=1.0)
+                    if message is None:
+                        continue
+                    if message["type"] == "psubscribe":
+                        self._ready.set()
+                    elif message["type"] == "pmessage":
+                        self._dispatch(message["channel"], message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning("Review subscription lost, reconnecting", exc_info=True)
+            finally:
+                self._ready.clear()
+                # whatever was published meanwhile is missed, the clients resume from the database
+                for book_uid, clients in list(self._clients.items()):
+                    for queue in list(clients):
+                        self._disconnect(book_uid, queue)
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+            await asyncio.sleep(1)
+
+    async def close(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+
+
+review_broadcaster = ReviewBroadcaster()
+
+
+async def review_stream(queue: asyncio.Queue, missed: List[dict], reset: bool) -> AsyncIterator[bytes]:
+    """
+    Body of an event stream: the missed reviews, then the live ones with a
+    heartbeat comment every SSE_HEARTBEAT_SECONDS so that proxies keep the
+    connection open
+    """
+    yield f"retry: {Config.SSE_RETRY_MS}\n\n".encode()
+    if reset:
+        yield RESET_EVENT
+    replayed = set()
+    for row in missed:
+        event = review_event(row)
+        replayed.add(event_id_of(event))
+        yield event
+
+    while True:
+        try:
+            event = await asyncio.wait_for(queue.get(), Config.SSE_HEARTBEAT_SECONDS)
+        except asyncio.TimeoutError:
+            yield HEARTBEAT
+            continue
+        if event is None:
+            return
+        # published while the missed reviews were read
+        if replayed and event_id_of(event) in replayed:
+            continue
+        yield event
+
+
+class StreamCollector:
+    """Export the number of event streams at scrape time"""
+    def collect(self):
+        yield GaugeMetricFamily(
+            "sse_connections", "Event streams open on this worker", value=review_broadcaster.connections
+        )
+
+
+REGISTRY.register(StreamCollector())
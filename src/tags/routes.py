@@ -4,22 +4,23 @@ from fastapi import APIRouter, Depends, status
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from src.auth.dependencies import RoleChecker
-from src.books.schema import Book 
+from src.books.schema import Book, book_adapter
 from src.db.main import get_session
+from src.responses import NegotiatedRoute, model_response, rows_response
 
-from .schemas import TagAddModel, TagCreateModel, TagModel
+from .schemas import TagAddModel, TagCreateModel, TagModel, tag_adapter
 from .service import TagService
 
-tags_router = APIRouter()
+tags_router = APIRouter(route_class=NegotiatedRoute)
 tag_service = TagService()
 user_role_checker = Depends(RoleChecker(["user", "admin"]))
 
 
 @tags_router.get("/", response_model=List[TagModel], dependencies=[user_role_checker])
 async def get_all_tags(session: AsyncSession = Depends(get_session)):
-    tags = await tag_service.get_all_tags(session)
+    tags = await tag_service.get_all_tag_rows(session)
 
-    return tags
+    return rows_response(tags)
 
 
 @tags_router.post(
@@ -34,7 +35,7 @@ async def add_tag(
 
     tag_added = await tag_service.add_tag(tag_data=tag_data, session=session)
 
-    return tag_added
+    return model_response(tag_adapter, tag_added, status_code=status.HTTP_201_CREATED)
 
 
 @tags_router.post(
@@ -48,7 +49,7 @@ async def add_tags_to_book(
         book_uid=book_uid, tag_data=tag_data, session=session
     )
 
-    return book_with_tag
+    return model_response(book_adapter, book_with_tag)
 
 
 @tags_router.put(
@@ -61,7 +62,7 @@ async def update_tag(
 ) -> TagModel:
     updated_tag = await tag_service.update_tag(session, tag_uid, tag_update_data)
 
-    return updated_tag
+    return model_response(tag_adapter, updated_tag)
 
 
 @tags_router.delete(
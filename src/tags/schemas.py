@@ -2,7 +2,7 @@ import uuid
 from datetime import datetime
 from typing import List
 
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter
 
 
 class TagModel(BaseModel):
@@ -16,4 +16,8 @@ class TagCreateModel(BaseModel):
 
 
 class TagAddModel(BaseModel):
-    tags: List[TagCreateModel]
\ No newline at end of file
+    tags: List[TagCreateModel]
+
+
+tag_adapter = TypeAdapter(TagModel)
+tag_list_adapter = TypeAdapter(List[TagModel])
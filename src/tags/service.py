@@ -1,10 +1,13 @@
+from typing import Optional
+
 from fastapi import status
 from fastapi.exceptions import HTTPException
+from sqlalchemy import func
 from sqlmodel import desc, select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from src.books.service import BookService
-from src.db.models import Tag
+from src.db.models import BookTags, Tag
 
 from .schemas import TagAddModel, TagCreateModel
 
@@ -25,7 +28,43 @@ class TagService:
         tags =  await session.exec(statement)
 
         return tags
+
+    async def get_all_tag_rows(self, session: AsyncSession, limit: Optional[int] = None):
+        """Get all tags, or the `limit` newest, as plain dicts shaped like TagModel"""
+
+        statement = select(Tag.uid, Tag.name, Tag.created_at).order_by(desc(Tag.created_at)).limit(limit)
+
+        result = await session.exec(statement)
+
+        return [row._asdict() for row in result.all()]
     
+    async def get_tag_rows_for_books(self, session: AsyncSession, book_uids: list, per_book: int):
+        """
+        The first `per_book` tags of each book by name, in one query
+
+        Returns:
+            Dict of book uid to its tags as dicts shaped like TagModel, by name
+        """
+        rank = func.row_number().over(partition_by=BookTags.book_uid, order_by=Tag.name).label("rank")
+        ranked = (
+            select(BookTags.book_uid, Tag.uid, Tag.name, Tag.created_at, rank)
+            .join(Tag, Tag.uid == BookTags.tag_uid)
+            .where(BookTags.book_uid.in_(book_uids))
+            .subquery()
+        )
+        statement = (
+            select(ranked.c.book_uid, ranked.c.uid, ranked.c.name, ranked.c.created_at)
+            .where(ranked.c.rank <= per_book)
+            .order_by(ranked.c.book_uid, ranked.c.rank)
+        )
+
+        result = await session.exec(statement)
+
+        tags = {book_uid: [] for book_uid in book_uids}
+        for row in result.all():
+            tags[row.book_uid].append({"uid": row.uid, "name": row.name, "created_at": row.created_at})
+        return tags
+
     async def add_tags_to_book(self, session: AsyncSession, book_uid:str, tag_data: TagAddModel):
         """Add tags to a book"""
         book = await book_service.get_book_by_id(session, book_uid)
@@ -0,0 +1,107 @@
+"""
+OpenTelemetry tracing.
+
+Spans are exported in batches by the BatchSpanProcessor thread, so recording a
+span never waits on the collector. With TRACING_EXPORTER=otlp spans go to an
+OTLP/HTTP collector at TRACING_OTLP_ENDPOINT, with TRACING_EXPORTER=file they
+are written as json lines to TRACING_FILE, which is enough for tests and local
+debugging without a collector.
+"""
+import threading
+from contextlib import nullcontext
+from typing import Optional, Sequence
+
+from fastapi import Request
+from opentelemetry import trace
+from opentelemetry.propagate import extract
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import ReadableSpan, TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+from opentelemetry.trace import SpanKind
+
+from src.config import Config
+
+tracer = trace.get_tracer("bookstore")
+
+_provider: Optional[TracerProvider] = None
+_disabled = nullcontext()
+
+
+class FileSpanExporter(SpanExporter):
+    """Append finished spans to a file, one json object per line"""
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        lines = "".join(span.to_json(indent=None) + "\n" for span in spans)
+        with self._lock, open(self.path, "a") as f:
+            f.write(lines)
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self) -> None:
+        pass
+
+
+def setup_tracing(service_name: str = "bookstore") -> None:
+    """
+    Install the tracer provider, nothing is recorded unless TRACING_ENABLED is set
+    """
+    global _provider
+    if not Config.TRACING_ENABLED or _provider is not None:
+        return
+
+    if Config.TRACING_EXPORTER == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        exporter = OTLPSpanExporter(endpoint=Config.TRACING_OTLP_ENDPOINT)
+    else:
+        exporter = FileSpanExporter(Config.TRACING_FILE)
+
+    _provider = TracerProvider(
+        resource=Resource.create({"service.name": service_name}),
+        sampler=ParentBased(TraceIdRatioBased(Config.TRACING_SAMPLE_RATE)),
+    )
+    _provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(_provider)
+
+
+def shutdown_tracing() -> None:
+    """Flush the pending spans"""
+    if _provider is not None:
+        _provider.shutdown()
+
+
+def traced(name: str, attributes: Optional[dict] = None):
+    """
+    Context manager recording a span as the current span, or doing nothing
+    when tracing is disabled.
+    """
+    if _provider is None:
+        return _disabled
+    return tracer.start_as_current_span(name, attributes=attributes)
+
+
+def request_span(request: Request):
+    """
+    Server span of a request, continuing the trace of an incoming traceparent header
+    """
+    if _provider is None:
+        return _disabled
+    return tracer.start_as_current_span(
+        request.method,
+        context=extract(request.headers),
+        kind=SpanKind.SERVER,
+        attributes={"http.request.method": request.method, "url.path": request.url.path},
+    )
+
+
+def start_span(name: str, attributes: Optional[dict] = None):
+    """
+    Start a span that is not made current, for callbacks such as SQLAlchemy
+    events where the start and the end happen in different functions.
+    """
+    if _provider is None:
+        return None
+    return tracer.start_span(name, kind=SpanKind.CLIENT, attributes=attributes)
@@ -0,0 +1,368 @@
+"""
+Background job worker.
+
+Work that does not belong in a request runs as Celery tasks: sending the
+email outbox, account deletions, review partition maintenance, the book
+duplicate clustering, book exports and bulk imports. Run the workers and the
+scheduler next to the API:
+
+    celery -A src.worker worker -Q mail,default -c 4
+    celery -A src.worker worker -Q maintenance,bulk -c 2
+    celery -A src.worker beat
+
+Tasks are routed by the prefix of their name to the mail, maintenance and
+bulk queues, the rest goes to default. Separate workers keep a long export
+from delaying the outbox, and a worker reading several queues empties them
+in the order given to -Q. Within a queue the Redis broker serves priority 0
+first and 9 last.
+
+Tasks are acknowledged once finished, so a task running on a worker that
+dies is delivered again: every task here can run twice. Failures to reach
+Postgres, Redis or SMTP are retried with exponential backoff and jitter.
+States and results are kept CELERY_RESULT_EXPIRES seconds and served by
+`GET /api/v1/jobs/{job_id}`.
+
+With CELERY_TASK_ALWAYS_EAGER tasks run in the process submitting them
+against an in memory broker and result backend, so local runs and tests
+need no worker.
+
+Tasks are coroutines run on one event loop per worker process, which keeps
+the database and SMTP connections pooled from one task to the next: use the
+default prefork pool or --pool solo, not threads. MAIL_RATE_LIMIT applies
+per worker process.
+"""
+import asyncio
+import functools
+import gzip
+import logging
+import os
+import uuid
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from urllib.parse import quote
+
+import orjson
+from celery import Celery, Task
+from celery.signals import worker_process_init, worker_process_shutdown
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import InterfaceError, OperationalError
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src import review_archive
+from src.account_deletion import AccountDeleter
+from src.books.dedup import BookDedupIndex, find_duplicate_clusters
+from src.books.schema import BookCreateModel
+from src.config import Config
+from src.db import redis
+from src.db.main import engine
+from src.db.models import Book
+from src.mail_dispatcher import OutboxDispatcher
+from src.tracing import setup_tracing, shutdown_tracing, traced
+
+logger = logging.getLogger(__name__)
+
+TRANSIENT_ERRORS = (
+    OSError, asyncio.TimeoutError, OperationalError, InterfaceError, RedisConnectionError, RedisTimeoutError
+)
+IMPORT_BATCH_SIZE = 1000
+
+
+def redis_url(db: int) -> str:
+    """
+    URL of the Redis of the REDIS_* settings, for the broker or the result backend
+    """
+    if Config.REDIS_MODE == "cluster":
+        raise ValueError("Celery cannot use Redis Cluster, set CELERY_BROKER_URL and CELERY_RESULT_BACKEND")
+    password = f":{quote(Config.REDIS_PASSWORD, safe='')}@" if Config.REDIS_PASSWORD else ""
+    if Config.REDIS_MODE == "sentinel":
+        return ";".join(f"sentinel://{password}{address}/{db}" for address in Config.REDIS_SENTINELS)
+    if Config.REDIS_SSL:
+        return f"rediss://{password}{Config.REDIS_HOST}:{Config.REDIS_PORT}/{db}?ssl_cert_reqs=required"
+    return f"redis://{password}{Config.REDIS_HOST}:{Config.REDIS_PORT}/{db}"
+
+
+def create_app() -> Celery:
+    eager = Config.CELERY_TASK_ALWAYS_EAGER
+    transport_options = {
+        "priority_steps": list(range(10)),
+        "sep": ":",
+        "queue_order_strategy": "priority",
+        "visibility_timeout": Config.CELERY_VISIBILITY_TIMEOUT,
+    }
+    if Config.REDIS_MODE == "sentinel":
+        transport_options["master_name"] = Config.REDIS_SENTINEL_MASTER
+
+    app = Celery("bookstore")
+    app.conf.update(
+        broker_transport_options=transport_options,
+        result_backend_transport_options={k: v for k, v in transport_options.items() if k == "master_name"},
+        broker_connection_retry_on_startup=True,
+        task_always_eager=eager,
+        task_eager_propagates=True,
+        task_store_eager_result=True,
+        task_serializer="json",
+        result_serializer="json",
+        accept_content=["json"],
+        task_default_queue="default",
+        task_routes={
+            "mail.*": {"queue": "mail"},
+            "maintenance.*": {"queue": "maintenance"},
+            "bulk.*": {"queue": "bulk"},
+        },
+        task_default_priority=5,
+        task_acks_late=True,
+        task_reject_on_worker_lost=True,
+        task_track_started=True,
+        worker_prefetch_multiplier=1,
+        result_expires=Config.CELERY_RESULT_EXPIRES,
+        # a run that waited longer than its interval is dropped, the next one does the same work
+        beat_schedule={
+            "dispatch-mail": {
+                "task": "mail.dispatch",
+                "schedule": Config.MAIL_POLL_INTERVAL,
+                "options": {"expires": Config.MAIL_POLL_INTERVAL},
+            },
+            "delete-accounts": {
+                "task": "maintenance.delete_accounts",
+                "schedule": Config.ACCOUNT_DELETION_POLL_INTERVAL,
+                "options": {"expires": Config.ACCOUNT_DELETION_POLL_INTERVAL},
+            },
+            "archive-reviews": {
+                "task": "maintenance.archive_reviews",
+                "schedule": Config.REVIEW_ARCHIVE_INTERVAL,
+                "options": {"expires": Config.REVIEW_ARCHIVE_INTERVAL},
+            },
+        },
+    )
+    # resolved when the configuration is first read, by the worker or the
+    # first submit: the API imports this module and must start without a
+    # broker, which Redis Cluster has to get from CELERY_BROKER_URL
+    app.add_defaults(lambda: {
+        "broker_url": Config.CELERY_BROKER_URL or ("memory://" if eager else redis_url(1)),
+        "result_backend": Config.CELERY_RESULT_BACKEND or ("cache+memory://" if eager else redis_url(2)),
+    })
+    return app
+
+
+celery_app = create_app()
+
+
+class BookstoreTask(Task):
+    autoretry_for = TRANSIENT_ERRORS
+    retry_backoff = True
+    retry_backoff_max = Config.CELERY_RETRY_BACKOFF_MAX
+    retry_jitter = True
+    max_retries = Config.CELERY_TASK_MAX_RETRIES
+
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_coroutines: Dict[str, Callable[..., Awaitable]] = {}
+
+
+def run_async(awaitable: Awaitable) -> Any:
+    """
+    Run a coroutine on the event loop of this worker process
+    """
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+    return _loop.run_until_complete(awaitable)
+
+
+def async_task(name: str, **options):
+    """
+    Register a coroutine function as the task `name`, options are the ones
+    of `Celery.task`
+    """
+    def decorator(function: Callable[..., Awaitable]) -> Task:
+        _coroutines[name] = function
+
+        @functools.wraps(function)
+        def run(*args, **kwargs):
+            with traced(f"task {name}", {"messaging.system": "celery"}):
+                return run_async(function(*args, **kwargs))
+
+        return celery_app.task(run, name=name, base=BookstoreTask, **options)
+    return decorator
+
+
+async def submit(task: Task, *args, **options) -> str:
+    """
+    Queue a task from async code
+
+    Args:
+        task: one of the tasks of this module
+        args: arguments of the task, json serializable
+        options: `apply_async` options such as priority or countdown
+    Returns:
+        the job id
+    """
+    if not celery_app.conf.task_always_eager:
+        # publishing blocks on the broker connection
+        result = await asyncio.to_thread(task.apply_async, args, **options)
+        return result.id
+
+    # run on the loop of the caller, which owns the pooled connections, with
+    # the result stored the way a worker would
+    job_id = str(uuid.uuid4())
+    try:
+        value = await _coroutines[task.name](*args)
+    except Exception as exc:
+        celery_app.backend.mark_as_failure(job_id, exc)
+        raise
+    celery_app.backend.mark_as_done(job_id, value)
+    return job_id
+
+
+_dispatcher: Optional[OutboxDispatcher] = None
+
+
+@async_task("mail.dispatch", priority=0)
+async def dispatch_mail(max_batches: int = 50) -> int:
+    """
+    Send pending outbox emails until a batch comes back short
+    Returns:
+        number of emails processed
+    """
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = OutboxDispatcher()
+    processed = 0
+    for _ in range(max_batches):
+        count = await _dispatcher.run_once()
+        processed += count
+        if count < Config.MAIL_BATCH_SIZE:
+            break
+    return processed
+
+
+@async_task("maintenance.delete_accounts")
+async def delete_accounts(limit: int = 10) -> int:
+    """
+    Remove the data of the oldest accounts marked for deletion
+    Returns:
+        number of accounts deleted
+    """
+    return await AccountDeleter().run_once(limit)
+
+
+@async_task("maintenance.archive_reviews", priority=9)
+async def archive_reviews() -> dict:
+    """
+    Create the coming review partitions and archive the old ones
+    """
+    return await review_archive.run_once()
+
+
+@async_task("maintenance.book_duplicates", priority=9)
+async def book_duplicates() -> List[List[str]]:
+    """
+    Rebuild the clusters of near duplicate books from the whole table
+    Returns:
+        List of clusters, each a list of book uids ordered by creation
+    """
+    async with AsyncSession(engine) as session:
+        return await find_duplicate_clusters(session)
+
+
+@async_task("bulk.export_books")
+async def export_books() -> dict:
+    """
+    Write every book to BOOK_EXPORT_DIR as gzipped json lines
+    Returns:
+        path of the export and number of books
+    """
+    os.makedirs(Config.BOOK_EXPORT_DIR, exist_ok=True)
+    path = os.path.join(Config.BOOK_EXPORT_DIR, f"books-{datetime.now():%Y%m%dT%H%M%S%f}.jsonl.gz")
+    partial = f"{path}.partial"
+    statement = (
+        select(
+            Book.uid, Book.title, Book.author, Book.publisher, Book.published_date,
+            Book.page_count, Book.language, Book.user_uid, Book.created_at, Book.updated_at
+        )
+        .where(Book.deleted_at.is_(None))
+        .order_by(Book.created_at)
+        .execution_options(yield_per=1000)
+    )
+    rows = 0
+    async with AsyncSession(engine) as session:
+        result = await session.stream(statement)
+        with gzip.open(partial, "wb") as out:
+            async for row in result:
+                out.write(orjson.dumps(row._asdict()) + b"\n")
+                rows += 1
+    os.replace(partial, path)
+    return {"path": path, "rows": rows}
+
+
+@async_task("bulk.import_books")
+async def import_books(import_id: str, books: List[dict], user_uid: Optional[str] = None) -> dict:
+    """
+    Insert books in batches of IMPORT_BATCH_SIZE. The uid of every book is
+    derived from the import id and its position, so a retried import skips
+    the rows already inserted. With BOOK_DEDUP_ENABLED the exact duplicates of
+    existing books, or of books earlier in the import, are skipped; near
+    duplicates are imported, the book_duplicates job reports them.
+
+    Args:
+        import_id(str): uuid identifying the import
+        books: BookCreateModel fields of each book
+        user_uid(str): user the books are attributed to
+    Returns:
+        number of books imported and skipped
+    """
+    namespace = uuid.UUID(import_id)
+    index = BookDedupIndex() if Config.BOOK_DEDUP_ENABLED else None
+    imported = skipped = 0
+    async with AsyncSession(engine) as session:
+        if index is not None:
+            await index.ensure_loaded(session)
+        for start in range(0, len(books), IMPORT_BATCH_SIZE):
+            rows = []
+            for position, data in enumerate(books[start:start + IMPORT_BATCH_SIZE], start):
+                fields = BookCreateModel(**data).model_dump()
+                book = Book(**fields, uid=uuid.uuid5(namespace, str(position)))
+                if index is not None:
+                    if any(match != str(book.uid) for match in index.find_exact_duplicates(book)):
+                        skipped += 1
+                        continue
+                    index.add(book)
+                rows.append({**fields, "uid": book.uid, "user_uid": user_uid})
+            if rows:
+                result = await session.execute(
+                    insert(Book).values(rows).on_conflict_do_nothing(index_elements=["uid"])
+                )
+                await session.commit()
+                imported += result.rowcount
+    return {"imported": imported, "skipped": skipped}
+
+
+@async_task("ping")
+async def ping(value: Any = None) -> Any:
+    """
+    Round trip through the broker and a worker, for checks and the benchmark
+    """
+    return value
+
+
+@worker_process_init.connect
+def _init_worker_process(**_) -> None:
+    # the connections inherited from the parent process belong to it
+    engine.sync_engine.dispose(close=False)
+    redis.use_client(redis.create_client())
+    setup_tracing("bookstore-worker")
+
+
+@worker_process_shutdown.connect
+def _shutdown_worker_process(**_) -> None:
+    async def close() -> None:
+        if _dispatcher is not None:
+            await _dispatcher.pool.close()
+        await engine.dispose()
+
+    if _loop is not None and not _loop.is_closed():
+        run_async(close())
+        _loop.close()
+    shutdown_tracing()